@@ -0,0 +1,167 @@
+"""Reproducible synthetic collections, for benchmarks.
+"""
+
+import os
+import random
+import string
+
+
+# Extensions of generated files, with relative weights.
+_EXTENSIONS = (
+  ('flac', 40),
+  ('mp3', 20),
+  ('jpg', 10),
+  ('png', 5),
+  ('cue', 5),
+  ('txt', 5),
+  ('mkv', 2),
+  )
+
+_WEIGHTED_EXTENSIONS = tuple(
+  extension
+  for extension, weight in _EXTENSIONS
+  for i in range(weight)
+  )
+
+_PLAIN_CHARS = string.ascii_letters + string.digits + ' -_'
+
+# Characters that are either non-ASCII, or forbidden by
+# SanitizeFilenameProfile.
+_UNUSUAL_CHARS = 'éüñ日本:?*"<>|'
+
+
+class Collection():
+  """Parameters of a synthetic collection.
+  """
+
+  def __init__(
+      self,
+      files=2000,
+      fanout=8,
+      depth=2,
+      name_length=24,
+      unusual_fraction=0.1,
+      seed=0,
+      ):
+    """
+    Args:
+        files: Number of files.
+        fanout: Number of subdirectories of each non-leaf directory.
+        depth: Depth of the directory tree. Files are in the leaf
+            directories, spread evenly.
+        name_length: Approximate length of each file and directory
+            name.
+        unusual_fraction: Fraction of names that contain a non-ASCII
+            or forbidden character.
+        seed: Random seed. The same parameters always generate the
+            same collection.
+    """
+
+    self.files = files
+    self.fanout = fanout
+    self.depth = depth
+    self.name_length = name_length
+    self.unusual_fraction = unusual_fraction
+    self.seed = seed
+
+  def params(self):
+    return {
+      'files': self.files,
+      'fanout': self.fanout,
+      'depth': self.depth,
+      'name_length': self.name_length,
+      'unusual_fraction': self.unusual_fraction,
+      'seed': self.seed,
+      }
+
+  def _name(self, rng, index, extension=None):
+    suffix = '-%d' % index
+    if extension is not None:
+      suffix += '.' + extension
+    chars = [
+      rng.choice(_PLAIN_CHARS)
+      for i in range(max(1, self.name_length - len(suffix)))
+      ]
+    # Start with a letter, so that names are never '.' or '..' and
+    # don't look like Windows's reserved names after sanitizing.
+    chars[0] = rng.choice(string.ascii_letters)
+    if len(chars) > 1 and rng.random() < self.unusual_fraction:
+      chars[rng.randrange(1, len(chars))] = rng.choice(_UNUSUAL_CHARS)
+    return ''.join(chars) + suffix
+
+  def _extension(self, rng):
+    return rng.choice(_WEIGHTED_EXTENSIONS)
+
+  def generate(self, top_dir):
+    """Generate the collection in an existing, empty directory.
+
+    Returns:
+        A sorted list of relative paths of the files.
+    """
+
+    rng = random.Random(self.seed)
+
+    leaves = ['']
+    for level in range(self.depth):
+      leaves = [
+        os.path.join(parent, self._name(rng, index))
+        for parent in leaves
+        for index in range(self.fanout)
+        ]
+
+    relpaths = []
+    for index in range(self.files):
+      relpaths.append(os.path.join(
+        leaves[index % len(leaves)],
+        self._name(rng, index, self._extension(rng)),
+        ))
+
+    for leaf in leaves:
+      os.makedirs(os.path.join(top_dir, leaf), exist_ok=True)
+    for relpath in relpaths:
+      with open(os.path.join(top_dir, relpath), 'w') as f:
+        f.write(relpath)
+
+    return sorted(relpaths)
+
+  def change(self, top_dir, relpaths, fraction=0.01):
+    """Make a reproducible incremental change to a generated collection.
+
+    About a third of the changed files are modified, a third are
+    deleted, and a third get a new file added next to them.
+
+    Args:
+        top_dir: Where the collection was generated.
+        relpaths: What generate() returned.
+        fraction: Fraction of files to change.
+
+    Returns:
+        A sorted list of the relative paths that were changed.
+    """
+
+    rng = random.Random(self.seed + 1)
+
+    changed = rng.sample(relpaths, max(1, int(len(relpaths) * fraction)))
+
+    result = []
+    for index, relpath in enumerate(changed):
+      path = os.path.join(top_dir, relpath)
+      if index % 3 == 0:
+        with open(path, 'a') as f:
+          f.write(' changed')
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        result.append(relpath)
+      elif index % 3 == 1:
+        os.remove(path)
+        result.append(relpath)
+      else:
+        new_relpath = os.path.join(
+          os.path.dirname(relpath),
+          self._name(rng, self.files + index, self._extension(rng)),
+          )
+        with open(os.path.join(top_dir, new_relpath), 'w') as f:
+          f.write(new_relpath)
+        result.append(new_relpath)
+
+    return sorted(result)
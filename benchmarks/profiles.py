@@ -0,0 +1,314 @@
+"""Benchmark the profile engines on a synthetic collection.
+
+Each benchmark is run on a collection generated by
+benchmarks.collection, in these scenarios:
+
+  cold: generating into an empty destination.
+  noop: generating again, with nothing changed.
+  incremental: generating after a small change to the source.
+  scoped: like incremental, but passing the changed paths to
+      generate().
+
+The best wall time of several runs is reported, along with the peak
+memory allocated by Python (from tracemalloc, in a separate run).
+
+Run from the top of the repository:
+
+  python -m benchmarks.profiles [--files N] [--fanout N] [--depth N]
+      [--name-length N] [--unusual-fraction F] [--seed N] [--repeat N]
+      [--only NAME ...] [--save-baseline PATH] [--baseline PATH]
+      [--tolerance F]
+
+With --baseline, results are compared with a file written by
+--save-baseline, and the exit status is non-zero if anything got
+slower (or used more memory) by more than the tolerance.
+"""
+
+import argparse
+import collections
+import functools
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import collection
+from cohydra import profile
+from cohydra import util
+
+
+def keep_all_select_cb(profile, src_relpath, dst_relpath, contents):
+  return contents
+
+def flac_select_cb(profile, src_relpath):
+  if src_relpath.endswith('.flac'):
+    return src_relpath + '.ogg'
+  return None
+
+def copy_convert_cb(profile, src, dst):
+  shutil.copyfile(src, dst)
+
+
+class Workspace():
+  """Source and destination directories for a benchmark.
+  """
+
+  def __init__(self, top_dir, coll):
+    self.coll = coll
+
+    self.pristine = os.path.join(top_dir, 'pristine')
+    os.mkdir(self.pristine)
+    self.relpaths = coll.generate(self.pristine)
+
+    self.src = os.path.join(top_dir, 'src')
+    self.dst = os.path.join(top_dir, 'dst')
+
+  def reset_src(self):
+    if os.path.exists(self.src):
+      shutil.rmtree(self.src)
+    shutil.copytree(self.pristine, self.src, symlinks=True)
+
+  def reset_dst(self):
+    if os.path.exists(self.dst):
+      shutil.rmtree(self.dst)
+    os.mkdir(self.dst)
+
+  def change_src(self):
+    return self.coll.change(self.src, self.relpaths)
+
+
+def _profile_benchmarks(name, make_profile):
+  """Get the benchmarks for each scenario, for a type of profile.
+
+  Args:
+      name: Name of the profile type.
+      make_profile: Function from a RootProfile and a destination
+          directory to a profile.
+
+  Returns:
+      A list of (name, setup) tuples. setup takes a Workspace and
+      returns the function to measure.
+  """
+
+  def make(ws):
+    ws.reset_src()
+    ws.reset_dst()
+    return make_profile(profile.RootProfile(top_dir=ws.src), ws.dst)
+
+  def setup_cold(ws):
+    return make(ws).generate
+
+  def setup_noop(ws):
+    p = make(ws)
+    p.generate()
+    return p.generate
+
+  def setup_incremental(ws):
+    p = make(ws)
+    p.generate()
+    ws.change_src()
+    return p.generate
+
+  def setup_scoped(ws):
+    p = make(ws)
+    p.generate()
+    relpaths = ws.change_src()
+    return functools.partial(p.generate, relpaths=relpaths)
+
+  return [
+    ('%s.cold' % name, setup_cold),
+    ('%s.noop' % name, setup_noop),
+    ('%s.incremental' % name, setup_incremental),
+    ('%s.scoped' % name, setup_scoped),
+    ]
+
+
+def _make_filter(root, dst):
+  return profile.FilterProfile(
+    top_dir=dst,
+    parent=root,
+    select_cb=keep_all_select_cb,
+    )
+
+def _make_convert(root, dst):
+  return profile.ConvertProfile(
+    top_dir=dst,
+    parent=root,
+    select_cb=flac_select_cb,
+    convert_cb=copy_convert_cb,
+    )
+
+def _make_sanitize(root, dst):
+  return profile.SanitizeFilenameProfile(top_dir=dst, parent=root)
+
+
+def _util_benchmarks():
+  def setup_scandir(ws):
+    ws.reset_src()
+    def run():
+      for relpath, entry in util.recursive_scandir(ws.src):
+        pass
+    return run
+
+  def setup_fix_dir_stats(ws):
+    ws.reset_src()
+    ws.reset_dst()
+    p = _make_convert(profile.RootProfile(top_dir=ws.src), ws.dst)
+    p.generate()
+    return functools.partial(util.fix_dir_stats, p)
+
+  return [
+    ('recursive_scandir', setup_scandir),
+    ('fix_dir_stats', setup_fix_dir_stats),
+    ]
+
+
+def all_benchmarks():
+  return (
+    _profile_benchmarks('FilterProfile', _make_filter) +
+    _profile_benchmarks('ConvertProfile', _make_convert) +
+    _profile_benchmarks('SanitizeFilenameProfile', _make_sanitize) +
+    _util_benchmarks()
+    )
+
+
+def measure(ws, setup, repeat):
+  """Measure a benchmark.
+
+  Returns:
+      A dict with the best wall time in seconds, and the peak memory
+      allocated by Python in bytes.
+  """
+
+  times = []
+  for i in range(repeat):
+    run = setup(ws)
+    start = time.perf_counter()
+    run()
+    times.append(time.perf_counter() - start)
+
+  # tracemalloc slows things down, so memory is measured separately.
+  run = setup(ws)
+  tracemalloc.start()
+  try:
+    run()
+    current, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+
+  return collections.OrderedDict((
+    ('seconds', min(times)),
+    ('peak_bytes', peak),
+    ))
+
+
+def compare(results, baseline, tolerance):
+  """Print results, compared with a baseline.
+
+  Returns:
+      A list of names of benchmarks that regressed.
+  """
+
+  regressions = []
+
+  print('%-34s %10s %8s %12s %8s' % (
+    'benchmark', 'ms', 'vs base', 'peak KiB', 'vs base'))
+  for name, result in results.items():
+    base = baseline.get(name)
+    ratios = []
+    for key in ('seconds', 'peak_bytes'):
+      if base is None or not base.get(key):
+        ratios.append(None)
+      else:
+        ratios.append(result[key] / base[key])
+    regressed = any(
+      ratio is not None and ratio > 1 + tolerance for ratio in ratios)
+    if regressed:
+      regressions.append(name)
+    print('%-34s %10.2f %8s %12.1f %8s%s' % (
+      name,
+      result['seconds'] * 1e3,
+      '' if ratios[0] is None else '%.2fx' % ratios[0],
+      result['peak_bytes'] / 1024,
+      '' if ratios[1] is None else '%.2fx' % ratios[1],
+      '  REGRESSED' if regressed else '',
+      ))
+
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+  parser.add_argument('--files', type=int, default=2000)
+  parser.add_argument('--fanout', type=int, default=8)
+  parser.add_argument('--depth', type=int, default=2)
+  parser.add_argument('--name-length', type=int, default=24)
+  parser.add_argument('--unusual-fraction', type=float, default=0.1)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument(
+    '--only',
+    nargs='+',
+    metavar='NAME',
+    help='Run only benchmarks whose names start with one of these.',
+    )
+  parser.add_argument('--save-baseline', metavar='PATH')
+  parser.add_argument('--baseline', metavar='PATH')
+  parser.add_argument('--tolerance', type=float, default=0.2)
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+
+  coll = collection.Collection(
+    files=args.files,
+    fanout=args.fanout,
+    depth=args.depth,
+    name_length=args.name_length,
+    unusual_fraction=args.unusual_fraction,
+    seed=args.seed,
+    )
+
+  baseline = {}
+  if args.baseline is not None:
+    data = util.load_json(args.baseline)
+    if data is None:
+      parser.error('No baseline at %r' % args.baseline)
+    if data['params'] != coll.params():
+      print(
+        'Warning: baseline was measured with different parameters: %r' %
+          data['params'],
+        file=sys.stderr,
+        )
+    baseline = data['results']
+
+  results = collections.OrderedDict()
+  with tempfile.TemporaryDirectory() as top_dir:
+    ws = Workspace(top_dir, coll)
+    for name, setup in all_benchmarks():
+      if args.only and not any(name.startswith(x) for x in args.only):
+        continue
+      results[name] = measure(ws, setup, args.repeat)
+
+  regressions = compare(results, baseline, args.tolerance)
+
+  if args.save_baseline is not None:
+    util.save_json(
+      args.save_baseline,
+      collections.OrderedDict((
+        ('params', coll.params()),
+        ('results', results),
+        )),
+      )
+
+  if regressions:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
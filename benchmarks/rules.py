@@ -0,0 +1,65 @@
+"""Benchmark cohydra.rules against the equivalent hand-written select_cb.
+
+Run from the top of the repository:
+
+  python -m benchmarks.rules [--dirs N] [--files-per-dir N] [--repeat N]
+"""
+
+import argparse
+import os
+import tempfile
+import timeit
+
+from cohydra import readme_example
+
+
+_NAMES = (
+  '%02d - track.flac',
+  '%02d - track.mp3',
+  '%02d - track.cue',
+  '%02d - notes.txt',
+  'front.jpg',
+  'back.jpg',
+  'cd%d.png',
+  'booklet%02d.tif',
+  'video%d.mkv',
+  )
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--dirs', type=int, default=200)
+  parser.add_argument('--files-per-dir', type=int, default=30)
+  parser.add_argument('--repeat', type=int, default=5)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as top:
+    listings = []
+    for d in range(args.dirs):
+      dir_path = os.path.join(top, str(d))
+      os.mkdir(dir_path)
+      for f in range(args.files_per_dir):
+        name = _NAMES[f % len(_NAMES)]
+        if '%' in name:
+          name = name % f
+        open(os.path.join(dir_path, name), 'w').close()
+      listings.append(list(os.scandir(dir_path)))
+
+    n_files = args.dirs * args.files_per_dir
+    for label, select_cb in (
+        ('hand-written', readme_example.select_cb),
+        ('rules', readme_example.select_rules),
+        ):
+      def run():
+        for contents in listings:
+          select_cb(None, '', '', contents)
+      best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+      print('%-12s %8.3f ms  %6.2f us/file' % (
+        label,
+        best * 1e3,
+        best * 1e6 / n_files,
+        ))
+
+
+if __name__ == '__main__':
+  main()
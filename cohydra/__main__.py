@@ -0,0 +1,4 @@
+from cohydra import cli
+
+
+cli.main()
@@ -0,0 +1,243 @@
+"""Journals of the changes that generating a profile makes.
+
+A journal is a file of JSON lines, appended to after each run of
+Profile.generate_all() on a profile that has one. Each run starts with
+a header line, followed by one line per changed path:
+
+  {"seq": 12, "time": 1500000000.0, "complete": true, "count": 2}
+  {"seq": 12, "change": "added", "type": "symlink", "path": "a/b"}
+  {"seq": 12, "change": "removed", "type": "dir", "path": "c"}
+
+seq increases by one for each run, across rotations. complete is false
+if the run raised an exception, in which case the changes up to that
+point are listed. Changes are net changes for the run, e.g., a
+directory that was removed and recreated with the same contents is not
+listed. Paths are relative to the profile's top directory, and types
+are 'file', 'dir', or 'symlink'. Files that were replaced (e.g.,
+reconverted) are 'modified', as are symlinks whose targets changed.
+
+When the journal grows past a size limit, it is rotated to
+<path>.1, <path>.2, etc., before the next run is appended. Consumers
+can use read() with the last seq they processed to get only newer
+runs.
+"""
+
+import json
+import os
+import stat
+import time
+
+from . import util
+
+
+# Kinds of changes.
+ADDED = 'added'
+MODIFIED = 'modified'
+REMOVED = 'removed'
+
+# Types of paths.
+FILE = 'file'
+DIR = 'dir'
+SYMLINK = 'symlink'
+
+
+def describe(path):
+  """Get the type and details of a path, for recording its removal.
+
+  Returns:
+      A tuple of (type, details), where details is the target of a
+      symlink, or None.
+  """
+
+  path_stat = os.lstat(path)
+  if stat.S_ISLNK(path_stat.st_mode):
+    return SYMLINK, os.readlink(path)
+  elif stat.S_ISDIR(path_stat.st_mode):
+    return DIR, None
+  else:
+    return FILE, None
+
+
+class ChangeSet():
+  """Net changes to paths, as they're made.
+  """
+
+  def __init__(self):
+    # Map from relpath to [state before, state after], where each state
+    # is None for nothing, or a tuple of (type, details). Details of
+    # files are unique objects, since replaced files are always
+    # considered modified.
+    self._states = {}
+
+  def __bool__(self):
+    return bool(self._states)
+
+  def added(self, relpath, path_type, details=None):
+    if path_type == FILE:
+      details = object()
+    self._states.setdefault(relpath, [None, None])[1] = (
+      path_type, details)
+
+  def removed(self, relpath, path_type, details=None):
+    if path_type == FILE:
+      details = object()
+    states = self._states.get(relpath)
+    if states is None:
+      self._states[relpath] = [(path_type, details), None]
+    else:
+      states[1] = None
+
+  def changes(self):
+    """Get the net changes.
+
+    Returns:
+        A sorted list of (relpath, kind of change, type) tuples.
+    """
+
+    result = []
+    for relpath, (before, after) in sorted(self._states.items()):
+      if before == after:
+        continue
+      elif before is None:
+        result.append((relpath, ADDED, after[0]))
+      elif after is None:
+        result.append((relpath, REMOVED, before[0]))
+      elif before[0] != after[0]:
+        result.append((relpath, REMOVED, before[0]))
+        result.append((relpath, ADDED, after[0]))
+      else:
+        result.append((relpath, MODIFIED, after[0]))
+    return result
+
+
+class Journal():
+  """Append-only journal file, with rotation.
+  """
+
+  def __init__(self, path, max_bytes=16 * 1024 * 1024, backups=3):
+    """
+    Args:
+        path: Path of the journal file. The last sequence number is
+            kept in <path>.seq.
+        max_bytes: Size after which the journal is rotated.
+        backups: Number of rotated journals to keep.
+    """
+
+    self.path = path
+    self.max_bytes = max_bytes
+    self.backups = backups
+
+  def _rotate(self):
+    try:
+      size = os.path.getsize(self.path)
+    except FileNotFoundError:
+      return
+    if size < self.max_bytes:
+      return
+
+    for index in range(self.backups, 0, -1):
+      src = self.path if index == 1 else '%s.%d' % (self.path, index - 1)
+      try:
+        os.replace(src, '%s.%d' % (self.path, index))
+      except FileNotFoundError:
+        pass
+    if self.backups == 0:
+      os.remove(self.path)
+
+  def write_run(self, changes, complete=True):
+    """Append a run.
+
+    Args:
+        changes: List of changes, as returned by ChangeSet.changes().
+        complete: Whether the run finished successfully.
+
+    Returns:
+        The run's sequence number.
+    """
+
+    seq_path = self.path + '.seq'
+    seq = util.load_json(seq_path, 0) + 1
+    # Save the sequence number before appending the run, so a crash in
+    # between leaves a gap instead of a number used twice, which
+    # readers that already saw the first run would skip.
+    util.save_json(seq_path, seq)
+
+    self._rotate()
+
+    lines = [json.dumps(
+      {
+        'seq': seq,
+        'time': time.time(),
+        'complete': complete,
+        'count': len(changes),
+        },
+      sort_keys=True,
+      )]
+    for relpath, change, path_type in changes:
+      lines.append(json.dumps(
+        {
+          'seq': seq,
+          'change': change,
+          'type': path_type,
+          'path': relpath,
+          },
+        sort_keys=True,
+        ))
+
+    with open(self.path, 'ab+') as f:
+      # Don't append to a line that was partially written by an
+      # interrupted run.
+      if f.tell() > 0:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+          lines.insert(0, '')
+      f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+      f.flush()
+      os.fsync(f.fileno())
+
+    return seq
+
+
+def read(path, since=0):
+  """Read runs from a journal, including rotated files.
+
+  Args:
+      path: Path of the journal file.
+      since: Only runs with a greater sequence number are read.
+
+  Returns:
+      A generator of (header, list of changes) tuples, oldest first,
+      where header and the changes are dicts as in the file.
+  """
+
+  paths = []
+  index = 1
+  while os.path.exists('%s.%d' % (path, index)):
+    paths.append('%s.%d' % (path, index))
+    index += 1
+  paths.reverse()
+  if os.path.exists(path):
+    paths.append(path)
+
+  header = None
+  changes = []
+  for journal_path in paths:
+    with open(journal_path) as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # Partially written by an interrupted run.
+          continue
+        if record['seq'] <= since:
+          continue
+        if 'change' in record:
+          if header is not None and record['seq'] == header['seq']:
+            changes.append(record)
+          continue
+        if header is not None:
+          yield header, changes
+        header = record
+        changes = []
+  if header is not None:
+    yield header, changes
@@ -0,0 +1,395 @@
+"""Command line interface for profile definitions.
+
+A profile definition is a python file that builds a tree of profiles
+at module level, like the example in the README. Each module-level
+variable that refers to a profile can be selected by its name.
+
+Run:
+
+  python -m cohydra [--stamp PATH] [--check {files,dirs}] [-v]
+      DEFINITION {generate,plan,stats,failures,serve,print} ...
+
+With --stamp, a successful, complete generate records the state of
+the root profiles' directories, and the next generate exits without
+loading the definition if nothing changed. With --check files (the
+default), the state includes the size and modification time of every
+file; --check dirs only looks at directories, which is faster but
+misses files that are modified in place. Changes to modules that the
+definition imports aren't detected either; use generate --force after
+changing them.
+
+This module imports the rest of cohydra, and the definition, only when
+they're needed, so that the quick check is fast.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+
+def _signature(top_dirs, check):
+  """Get a digest of the state of directory trees.
+
+  Args:
+      top_dirs: List of directories.
+      check: 'files' to include the size and modification time of
+          every file and directory, or 'dirs' to include only
+          directories' modification times.
+
+  Returns:
+      A hex digest.
+  """
+
+  digest = hashlib.sha256()
+
+  def visit(path, relpath):
+    names = []
+    for entry in os.scandir(path):
+      names.append((entry.name, entry))
+    names.sort(key=lambda item: item[0])
+    for name, entry in names:
+      entry_relpath = os.path.join(relpath, name)
+      if entry.is_dir(follow_symlinks=False):
+        stat = entry.stat(follow_symlinks=False)
+        digest.update(
+          ('d %s %d\0' % (entry_relpath, stat.st_mtime_ns)).encode(
+            'utf-8', 'surrogateescape'))
+        visit(entry.path, entry_relpath)
+      elif check == 'files':
+        stat = entry.stat(follow_symlinks=False)
+        digest.update(
+          ('f %s %d %d\0' % (
+            entry_relpath, stat.st_size, stat.st_mtime_ns)).encode(
+              'utf-8', 'surrogateescape'))
+
+  for top_dir in top_dirs:
+    stat = os.stat(top_dir)
+    digest.update(
+      ('t %s %d\0' % (top_dir, stat.st_mtime_ns)).encode(
+        'utf-8', 'surrogateescape'))
+    visit(top_dir, '')
+
+  return digest.hexdigest()
+
+
+def _definition_stat(path):
+  stat = os.stat(path)
+  return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def _up_to_date(stamp_path, definition_path, check):
+  """Check whether anything changed since the stamp was saved.
+  """
+
+  try:
+    with open(stamp_path) as f:
+      stamp = json.load(f)
+    return (
+      stamp['definition'] == _definition_stat(definition_path)
+      and stamp['check'] == check
+      and stamp['signature'] == _signature(stamp['top_dirs'], check)
+      )
+  except (OSError, ValueError, KeyError):
+    return False
+
+
+def _save_stamp(stamp_path, definition_stat, check, top_dirs, signature):
+  from . import util
+
+  util.save_json(stamp_path, {
+    'definition': definition_stat,
+    'check': check,
+    'top_dirs': top_dirs,
+    'signature': signature,
+    })
+
+
+def _remove_stamp(stamp_path):
+  try:
+    os.remove(stamp_path)
+  except FileNotFoundError:
+    pass
+
+
+class Definition():
+  """Profiles from a definition file.
+
+  Attributes:
+      module: The loaded module.
+      profiles: Map from variable name to profile.
+  """
+
+  def __init__(self, path):
+    import importlib.util
+
+    from . import profile
+
+    # Make the definition importable by name, so that callbacks
+    # defined in it can be pickled for conversion processes.
+    dirname, basename = os.path.split(os.path.abspath(path))
+    name = os.path.splitext(basename)[0]
+    sys.path.insert(0, dirname)
+    spec = importlib.util.spec_from_file_location(name, path)
+    self.module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = self.module
+    spec.loader.exec_module(self.module)
+
+    self.profiles = {
+      var_name: value
+      for var_name, value in vars(self.module).items()
+      if isinstance(value, profile.Profile)
+      }
+
+  def roots(self):
+    """Get the root profiles, sorted by variable name.
+    """
+
+    roots = []
+    for name, p in sorted(self.profiles.items()):
+      if p._parent is None and p not in roots:
+        roots.append(p)
+    return roots
+
+  def select(self, names):
+    """Get profiles by variable name, or the roots if names is empty.
+    """
+
+    if not names:
+      return self.roots()
+    return [self.profiles[name] for name in names]
+
+
+def _walk(profiles):
+  for p in profiles:
+    yield p
+    yield from _walk(p._children)
+
+
+def _generate(args, definition):
+  targets = definition.select(args.profile)
+  complete = not args.profile and not args.relpath
+
+  if args.stamp is not None:
+    # Until this run finishes, the destinations may be out of date.
+    _remove_stamp(args.stamp)
+    # Anything that changes during the run is caught by the next one.
+    definition_stat = _definition_stat(args.definition)
+    top_dirs = [os.path.abspath(p.dst_path()) for p in targets]
+    signature = _signature(top_dirs, args.check)
+
+  for p in targets:
+    p.generate_all(
+      resume=args.resume,
+      time_budget=args.time_budget,
+      relpaths=args.relpath or None,
+      )
+
+  pending = any(getattr(p, 'pending', None) for p in _walk(targets))
+  if args.stamp is not None and complete and not pending:
+    _save_stamp(args.stamp, definition_stat, args.check, top_dirs, signature)
+
+
+def _plan(args, definition):
+  from . import planning
+
+  plans = []
+  for p in definition.select(args.profile):
+    plans.extend(p.plan_all())
+
+  if args.json:
+    print(planning.to_json(plans, indent=2))
+    return
+
+  for plan in plans:
+    summary = [
+      '%s %d' % (key, value)
+      for key, value in plan.totals().items()
+      if value
+      ]
+    seconds = plan.estimated_seconds()
+    if seconds:
+      summary.append('about %.0f seconds' % seconds)
+    print('%s: %s' % (plan.profile, ', '.join(summary) or 'nothing to do'))
+
+
+def _stats(args, definition):
+  from . import profile
+
+  stats = {}
+  for p in _walk(definition.select(args.profile)):
+    if isinstance(p, profile.ConvertProfile):
+      stats[str(p)] = p.load_stats()
+  print(json.dumps(stats, indent=2, sort_keys=True))
+
+
+def _failures(args, definition):
+  from . import profile
+
+  if args.clear and args.stamp is not None:
+    # Make the next generate retry the cleared failures.
+    _remove_stamp(args.stamp)
+
+  failures = {}
+  for p in _walk(definition.select(args.profile)):
+    if isinstance(p, profile.ConvertProfile) and p.remember_failures:
+      if args.clear:
+        failures[str(p)] = p.clear_failures(args.relpath or None)
+      else:
+        failures[str(p)] = p.load_failures()
+  print(json.dumps(failures, indent=2, sort_keys=True))
+
+
+def _serve(args, definition):
+  from . import profile
+  from . import serve
+
+  if len(args.profile) != 1 \
+      or not isinstance(
+        definition.profiles[args.profile[0]], profile.ConvertProfile):
+    raise SystemExit('serve needs a single --profile of a ConvertProfile')
+
+  host, port = args.address.rsplit(':', 1)
+  converter = serve.LazyConverter(
+    definition.profiles[args.profile[0]],
+    args.cache_dir,
+    args.max_bytes,
+    concurrency=args.concurrency,
+    )
+  with serve.Server(converter, (host, int(port))) as server:
+    print(
+      'Serving on http://%s:%d/' % server.server_address[:2],
+      file=sys.stderr,
+      )
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+
+
+def _print(args, definition):
+  for p in definition.select(args.profile):
+    p.print_all()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog='python -m cohydra',
+    description=__doc__,
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+  parser.add_argument(
+    '--stamp',
+    metavar='PATH',
+    help='File to record the state of the sources in, for the quick '
+      'check.',
+    )
+  parser.add_argument(
+    '--check',
+    choices=('files', 'dirs'),
+    default='files',
+    help='What the quick check looks at.',
+    )
+  parser.add_argument('-v', '--verbose', action='count', default=0)
+  parser.add_argument('definition', metavar='DEFINITION')
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+
+  def add_command(name, func, help):
+    subparser = subparsers.add_parser(name, help=help)
+    subparser.set_defaults(func=func)
+    subparser.add_argument(
+      '--profile',
+      action='append',
+      default=[],
+      metavar='NAME',
+      help='Variable name of a profile to use, with its descendants. '
+        'Defaults to all root profiles.',
+      )
+    return subparser
+
+  generate_parser = add_command(
+    'generate', _generate, 'Generate profiles.')
+  generate_parser.add_argument(
+    '--relpath',
+    action='append',
+    default=[],
+    metavar='PATH',
+    help='Generate only this path, relative to the selected profiles.',
+    )
+  generate_parser.add_argument(
+    '--time-budget', type=float, metavar='SECONDS')
+  generate_parser.add_argument('--resume', action='store_true')
+  generate_parser.add_argument(
+    '--force',
+    action='store_true',
+    help='Skip the quick check.',
+    )
+
+  plan_parser = add_command(
+    'plan', _plan, 'Show what generate would do.')
+  plan_parser.add_argument('--json', action='store_true')
+
+  add_command('stats', _stats, 'Show conversion statistics.')
+
+  failures_parser = add_command(
+    'failures', _failures, 'Show or clear recorded conversion failures.')
+  failures_parser.add_argument(
+    '--clear',
+    action='store_true',
+    help='Forget the failures, so the next generate retries them.',
+    )
+  failures_parser.add_argument(
+    '--relpath',
+    action='append',
+    default=[],
+    metavar='PATH',
+    help='With --clear, forget only this destination path, relative '
+      'to its profile.',
+    )
+  serve_parser = add_command(
+    'serve',
+    _serve,
+    'Serve a ConvertProfile over HTTP, converting files on demand.',
+    )
+  serve_parser.add_argument('--cache-dir', required=True, metavar='DIR')
+  serve_parser.add_argument(
+    '--max-bytes',
+    type=int,
+    default=1024 ** 3,
+    help='Size limit of the cache directory.',
+    )
+  serve_parser.add_argument(
+    '--address',
+    default='127.0.0.1:8000',
+    metavar='HOST:PORT',
+    )
+  serve_parser.add_argument(
+    '--concurrency',
+    type=int,
+    metavar='N',
+    help='Maximum number of conversions at once.',
+    )
+
+  add_command('print', _print, 'List profiles.')
+
+  args = parser.parse_args(argv)
+
+  if args.command == 'generate' and args.stamp is not None \
+      and not args.force and not args.profile and not args.relpath \
+      and _up_to_date(args.stamp, args.definition, args.check):
+    if args.verbose:
+      print('Nothing changed since the last run', file=sys.stderr)
+    return
+
+  import logging
+  logging.basicConfig(
+    level=(logging.WARNING, logging.INFO, logging.DEBUG)[
+      min(args.verbose, 2)])
+
+  definition = Definition(args.definition)
+  for name in args.profile:
+    if name not in definition.profiles:
+      parser.error('Unknown profile %r' % name)
+  args.func(args, definition)
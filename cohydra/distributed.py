@@ -0,0 +1,614 @@
+"""Distributed conversion over TCP.
+
+A Coordinator runs in the process that generates profiles, and is
+passed to a ConvertProfile as its executor, instead of the local
+multiprocessing.Pool. Workers, on other hosts or the same one, connect
+to the coordinator, pull jobs, run them, and report the results. Jobs
+that were pulled by a worker that disconnects or stops sending
+heartbeats are requeued for other workers, a limited number of times,
+so a job that kills its workers doesn't kill all of them.
+
+All hosts must see the profiles' directories at the same paths (e.g.,
+on shared storage), and have the same version of cohydra and of any
+modules that callbacks are defined in. Jobs and results are pickled,
+so the coordinator and workers must trust each other: each side proves
+that it knows a shared key before the other unpickles anything from it,
+and every pickle is authenticated with a key for the connection.
+
+The protocol is newline-delimited JSON over TCP. Digests and MACs are
+hex HMAC-SHA256, see _digest():
+
+  coordinator -> worker: {"type": "challenge", "nonce": <hex>}
+  worker -> coordinator: {"type": "register", "name": <str>,
+                          "nonce": <hex>,
+                          "digest": <digest of both nonces>}
+  coordinator -> worker: {"type": "registered",
+                          "digest": <digest of both nonces>}
+
+Then, repeatedly:
+
+  worker -> coordinator: {"type": "pull"}
+  coordinator -> worker: {"type": "job", "job_id": <int>,
+                          "payload": <base64 pickle of (func, args)>,
+                          "mac": <MAC of job_id and payload>},
+                         {"type": "wait"} if there are no jobs, or
+                         {"type": "shutdown"}
+  worker -> coordinator: {"type": "result", "job_id": <int>,
+                          "payload": <base64 pickle of (success, value)>,
+                          "mac": <MAC of job_id and payload>}
+
+And at any time after registering:
+
+  worker -> coordinator: {"type": "heartbeat"}
+
+To run workers, set COHYDRA_AUTHKEY in the environment, and run:
+
+  python -m cohydra.distributed HOST:PORT [--processes N]
+"""
+
+import argparse
+import base64
+import binascii
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import socket
+import socketserver
+import threading
+import time
+
+
+def _send(f, message):
+  f.write(json.dumps(message).encode('utf-8') + b'\n')
+  f.flush()
+
+
+def _receive(f):
+  line = f.readline()
+  if not line:
+    raise EOFError('Connection closed')
+  return json.loads(line.decode('utf-8'))
+
+
+def _nonce():
+  return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+def _digest(key, *parts):
+  """Get the hex HMAC-SHA256 of JSON-serializable parts.
+
+  The first part should say what the digest is for, so that a digest
+  sent by one side can't be replayed as one from the other.
+  """
+
+  return hmac.new(
+    key,
+    json.dumps(parts).encode('utf-8'),
+    hashlib.sha256,
+    ).hexdigest()
+
+
+def _verify(digest, expected):
+  """Check a received digest, in constant time.
+  """
+
+  return isinstance(digest, str) and hmac.compare_digest(
+    digest.encode('utf-8'), expected.encode('ascii'))
+
+
+def _session_key(authkey, coordinator_nonce, worker_nonce):
+  """Get the key for MACs on one connection.
+  """
+
+  return hmac.new(
+    authkey,
+    json.dumps(['session', coordinator_nonce, worker_nonce]).encode('utf-8'),
+    hashlib.sha256,
+    ).digest()
+
+
+def _encode(obj):
+  return base64.b64encode(pickle.dumps(obj)).decode('ascii')
+
+
+def _decode(payload):
+  return pickle.loads(base64.b64decode(payload))
+
+
+class RemoteResult():
+  """Like multiprocessing.pool.AsyncResult, for a job run by a worker.
+  """
+
+  def __init__(self):
+    self._event = threading.Event()
+    self._success = None
+    self._value = None
+
+  def ready(self):
+    return self._event.is_set()
+
+  def wait(self, timeout=None):
+    self._event.wait(timeout)
+
+  def get(self, timeout=None):
+    if not self._event.wait(timeout):
+      raise TimeoutError()
+    if self._success:
+      return self._value
+    raise self._value
+
+  def _set(self, success, value):
+    self._success = success
+    self._value = value
+    self._event.set()
+
+
+class _Job():
+  def __init__(self, job_id, payload, callback, error_callback):
+    self.job_id = job_id
+    self.payload = payload
+    self.callback = callback
+    self.error_callback = error_callback
+    self.result = RemoteResult()
+
+    # Number of times the job was sent to a worker.
+    self.attempts = 0
+
+
+class _Worker():
+  def __init__(self, name, sock):
+    self.name = name
+    self.sock = sock
+    self.last_seen = time.monotonic()
+    self.dead = False
+
+    # IDs of jobs pulled by this worker, that it hasn't finished.
+    self.job_ids = set()
+
+
+class _Server(socketserver.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+
+class _Handler(socketserver.BaseRequestHandler):
+  def handle(self):
+    self.server.coordinator._handle(self.request, self.client_address)
+
+
+class Coordinator():
+  """Server that hands out jobs to remote workers.
+
+  This has the subset of multiprocessing.Pool's interface that
+  schedule.Dispatcher uses, so it can be used as a ConvertProfile's
+  executor. The profile's concurrency should then be the total number
+  of worker processes.
+  """
+
+  def __init__(
+      self,
+      authkey,
+      address=('', 0),
+      heartbeat_timeout=30.0,
+      poll_interval=1.0,
+      max_attempts=3,
+      ):
+    """
+    Args:
+        authkey: Key (bytes) that workers must know.
+        address: (host, port) to listen on. The default is an
+            arbitrary port on all interfaces.
+        heartbeat_timeout: Seconds after which a worker that hasn't
+            sent anything is considered dead, and its jobs requeued.
+            Workers send heartbeats more often than this while running
+            jobs.
+        poll_interval: Maximum seconds that a worker's pull waits for
+            a job before being told to ask again.
+        max_attempts: Number of workers that a job is sent to, at
+            most. If the last of them is lost before finishing the
+            job, the job fails.
+    """
+
+    self._authkey = authkey
+    self._heartbeat_timeout = heartbeat_timeout
+    self._poll_interval = poll_interval
+    self._max_attempts = max_attempts
+
+    self._cond = threading.Condition()
+    self._closed = False
+
+    # Map from job ID to _Job, for unfinished jobs.
+    self._jobs = {}
+    self._next_job_id = 0
+
+    # IDs of jobs that are waiting for a worker.
+    self._queue = collections.deque()
+
+    self._workers = set()
+
+    self._server = _Server(address, _Handler)
+    self._server.coordinator = self
+
+    self._threads = [
+      threading.Thread(target=self._server.serve_forever, daemon=True),
+      threading.Thread(target=self._reap, daemon=True),
+      ]
+    for thread in self._threads:
+      thread.start()
+
+  @property
+  def address(self):
+    """The (host, port) that the coordinator is listening on.
+    """
+
+    return self._server.server_address[:2]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def workers(self):
+    """Get the names of the connected workers.
+    """
+
+    with self._cond:
+      return sorted(worker.name for worker in self._workers)
+
+  def apply_async(self, func, args=(), callback=None, error_callback=None):
+    """Queue a job.
+
+    Returns:
+        A RemoteResult.
+    """
+
+    with self._cond:
+      if self._closed:
+        raise ValueError('Coordinator is closed')
+      job_id = self._next_job_id
+      self._next_job_id += 1
+      job = _Job(
+        job_id,
+        _encode((func, args)),
+        callback,
+        error_callback,
+        )
+      self._jobs[job_id] = job
+      self._queue.append(job_id)
+      self._cond.notify()
+    return job.result
+
+  def close(self):
+    """Stop serving, and fail any unfinished jobs.
+    """
+
+    with self._cond:
+      if self._closed:
+        return
+      self._closed = True
+      jobs = list(self._jobs.values())
+      self._jobs.clear()
+      self._queue.clear()
+      workers = list(self._workers)
+      self._cond.notify_all()
+
+    self._server.shutdown()
+    self._server.server_close()
+    for worker in workers:
+      self._disconnect(worker)
+
+    for job in jobs:
+      self._complete(job, False, RuntimeError('Coordinator closed'))
+
+  def _handle(self, sock, client_address):
+    f = sock.makefile('rwb')
+
+    nonce = _nonce()
+    try:
+      _send(f, {'type': 'challenge', 'nonce': nonce})
+      message = _receive(f)
+    except (EOFError, OSError, ValueError):
+      return
+    worker_nonce = message.get('nonce')
+    if message.get('type') != 'register' \
+        or not isinstance(worker_nonce, str) \
+        or not _verify(
+          message.get('digest'),
+          _digest(self._authkey, 'register', nonce, worker_nonce),
+          ):
+      logging.warning('Rejected worker from %r', client_address)
+      return
+    session_key = _session_key(self._authkey, nonce, worker_nonce)
+
+    worker = _Worker(
+      '%s (%s)' % (message.get('name'), client_address[0]),
+      sock,
+      )
+    with self._cond:
+      if self._closed:
+        return
+      self._workers.add(worker)
+    logging.info('Worker %s registered', worker.name)
+
+    try:
+      _send(f, {
+        'type': 'registered',
+        'digest': _digest(self._authkey, 'registered', nonce, worker_nonce),
+        })
+      while True:
+        message = _receive(f)
+        worker.last_seen = time.monotonic()
+        if message['type'] == 'pull':
+          job = self._next_job(worker)
+          if job is None:
+            _send(f, {'type': 'shutdown' if self._closed else 'wait'})
+          else:
+            _send(f, {
+              'type': 'job',
+              'job_id': job.job_id,
+              'payload': job.payload,
+              'mac': _digest(session_key, 'job', job.job_id, job.payload),
+              })
+        elif message['type'] == 'result':
+          if not _verify(
+              message.get('mac'),
+              _digest(
+                session_key,
+                'result',
+                message['job_id'],
+                message['payload'],
+                ),
+              ):
+            raise ValueError('Result with a bad MAC')
+          self._finish(worker, message['job_id'], message['payload'])
+        elif message['type'] != 'heartbeat':
+          raise ValueError('Unknown message type %r' % message['type'])
+    except (EOFError, OSError, ValueError, KeyError) as e:
+      logging.debug('Worker %s disconnected: %s', worker.name, e)
+    finally:
+      self._lose(worker)
+
+  def _next_job(self, worker):
+    """Assign the next job to a worker, waiting a bit for one.
+
+    Returns:
+        The _Job, or None.
+    """
+
+    deadline = time.monotonic() + self._poll_interval
+    with self._cond:
+      while not self._closed and not worker.dead:
+        while self._queue:
+          job = self._jobs.get(self._queue.popleft())
+          if job is not None:
+            worker.job_ids.add(job.job_id)
+            job.attempts += 1
+            return job
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        self._cond.wait(remaining)
+    return None
+
+  def _finish(self, worker, job_id, payload):
+    with self._cond:
+      worker.job_ids.discard(job_id)
+      # The job may have been finished by another worker after being
+      # requeued.
+      job = self._jobs.pop(job_id, None)
+    if job is None:
+      return
+
+    try:
+      success, value = _decode(payload)
+    except Exception as e:
+      success, value = False, e
+    self._complete(job, success, value)
+
+  def _complete(self, job, success, value):
+    job.result._set(success, value)
+    if success:
+      if job.callback is not None:
+        job.callback(value)
+    elif job.error_callback is not None:
+      job.error_callback(value)
+
+  def _lose(self, worker):
+    """Forget a worker, and requeue its unfinished jobs.
+
+    Jobs that were already sent to max_attempts workers fail instead.
+    """
+
+    requeue = []
+    failed = []
+    with self._cond:
+      self._workers.discard(worker)
+      worker.dead = True
+      for job_id in sorted(worker.job_ids):
+        job = self._jobs.get(job_id)
+        if job is None:
+          continue
+        if job.attempts >= self._max_attempts:
+          del self._jobs[job_id]
+          failed.append(job)
+        else:
+          requeue.append(job_id)
+      worker.job_ids.clear()
+      self._queue.extendleft(reversed(requeue))
+      self._cond.notify_all()
+
+    if requeue:
+      logging.warning(
+        'Requeuing %d jobs from worker %s',
+        len(requeue),
+        worker.name,
+        )
+    for job in failed:
+      logging.error(
+        'Job %d was lost by %d workers, the last was %s',
+        job.job_id,
+        job.attempts,
+        worker.name,
+        )
+      self._complete(
+        job,
+        False,
+        RuntimeError(
+          'Job lost by %d workers, the last was %s' % (
+            job.attempts, worker.name)),
+        )
+
+  def _disconnect(self, worker):
+    try:
+      worker.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+
+  def _reap(self):
+    """Disconnect workers that stopped sending heartbeats.
+    """
+
+    interval = min(1.0, self._heartbeat_timeout / 4)
+    while True:
+      time.sleep(interval)
+      now = time.monotonic()
+      with self._cond:
+        if self._closed:
+          return
+        dead = [
+          worker for worker in self._workers
+          if now - worker.last_seen > self._heartbeat_timeout
+          ]
+      for worker in dead:
+        logging.warning('Worker %s timed out', worker.name)
+        self._lose(worker)
+        self._disconnect(worker)
+
+
+def run_worker(address, authkey, name=None, heartbeat_interval=5.0):
+  """Connect to a coordinator, and run jobs until it shuts down.
+
+  Args:
+      address: (host, port) of the coordinator.
+      authkey: Key (bytes) shared with the coordinator.
+      name: Name of this worker, for logging. Defaults to the host
+          name and process ID.
+      heartbeat_interval: Seconds between heartbeats.
+  """
+
+  if name is None:
+    name = '%s:%d' % (socket.gethostname(), os.getpid())
+
+  sock = socket.create_connection(address)
+  f = sock.makefile('rwb')
+
+  # Lock for sending messages, which the heartbeat thread also does.
+  send_lock = threading.Lock()
+  stop = threading.Event()
+
+  def heartbeat():
+    while not stop.wait(heartbeat_interval):
+      try:
+        with send_lock:
+          _send(f, {'type': 'heartbeat'})
+      except OSError:
+        return
+
+  try:
+    coordinator_nonce = _receive(f)['nonce']
+    nonce = _nonce()
+    _send(f, {
+      'type': 'register',
+      'name': name,
+      'nonce': nonce,
+      'digest': _digest(authkey, 'register', coordinator_nonce, nonce),
+      })
+    try:
+      message = _receive(f)
+    except EOFError:
+      message = {}
+    # Nothing from the coordinator is unpickled unless it knows the key
+    # too.
+    if message.get('type') != 'registered' or not _verify(
+        message.get('digest'),
+        _digest(authkey, 'registered', coordinator_nonce, nonce),
+        ):
+      raise RuntimeError('Not registered by coordinator')
+    session_key = _session_key(authkey, coordinator_nonce, nonce)
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    while True:
+      with send_lock:
+        _send(f, {'type': 'pull'})
+      message = _receive(f)
+      if message['type'] == 'wait':
+        continue
+      elif message['type'] == 'shutdown':
+        return
+
+      if not _verify(
+          message.get('mac'),
+          _digest(session_key, 'job', message['job_id'], message['payload']),
+          ):
+        raise RuntimeError('Job with a bad MAC from coordinator')
+      func, args = _decode(message['payload'])
+      try:
+        result = (True, func(*args))
+      except Exception as e:
+        result = (False, e)
+      try:
+        payload = _encode(result)
+      except Exception as e:
+        payload = _encode(
+          (False, RuntimeError('Cannot pickle result: %s' % e)))
+
+      with send_lock:
+        _send(f, {
+          'type': 'result',
+          'job_id': message['job_id'],
+          'payload': payload,
+          'mac': _digest(session_key, 'result', message['job_id'], payload),
+          })
+  except EOFError:
+    logging.info('Coordinator closed the connection')
+  finally:
+    stop.set()
+    sock.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Run conversion workers for a cohydra coordinator.')
+  parser.add_argument('address', metavar='HOST:PORT')
+  parser.add_argument('--processes', type=int, default=os.cpu_count())
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+
+  host, port = args.address.rsplit(':', 1)
+  authkey = os.environ.get('COHYDRA_AUTHKEY')
+  if not authkey:
+    parser.error('COHYDRA_AUTHKEY must be set')
+
+  processes = [
+    multiprocessing.Process(
+      target=run_worker,
+      args=((host, int(port)), authkey.encode('utf-8')),
+      )
+    for i in range(args.processes)
+    ]
+  for process in processes:
+    process.start()
+  for process in processes:
+    process.join()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,102 @@
+"""Plans of what generating profiles would do, without doing it.
+"""
+
+import collections
+import json
+
+
+# Actions in a plan.
+MKDIR = 'mkdir'
+RMDIR = 'rmdir'
+LINK = 'link'
+REMOVE = 'remove'
+CONVERT = 'convert'
+COPYSTAT = 'copystat'
+COPY = 'copy'
+
+
+class Plan():
+  """Actions that generating a single profile would take.
+
+  Attributes:
+      profile: The profile, as a string.
+      actions: List of (action, relative destination path, details)
+          tuples, where details is a dict, e.g., with the relative
+          source path and size of a file to convert.
+      bytes_per_second: Measured conversion throughput of the profile
+          in bytes of source per second of wall time, or None.
+  """
+
+  def __init__(self, profile, bytes_per_second=None):
+    self.profile = str(profile)
+    self.actions = []
+    self.bytes_per_second = bytes_per_second
+
+  def add(self, action, relpath, **details):
+    self.actions.append((action, relpath, details))
+
+  def totals(self):
+    """Get a dict of the number of each action, and total sizes.
+    """
+
+    totals = collections.OrderedDict(
+      (action, 0)
+      for action in (MKDIR, RMDIR, LINK, REMOVE, CONVERT, COPYSTAT, COPY))
+    totals['convert_bytes'] = 0
+    totals['copy_bytes'] = 0
+    for action, relpath, details in self.actions:
+      totals[action] += 1
+      if action == CONVERT:
+        totals['convert_bytes'] += details.get('size', 0)
+      elif action == COPY:
+        totals['copy_bytes'] += details.get('size', 0)
+    return totals
+
+  def estimated_seconds(self):
+    """Estimate how long conversions would take, or None if unknown.
+    """
+
+    convert_bytes = self.totals()['convert_bytes']
+    if not convert_bytes:
+      return 0.0
+    if not self.bytes_per_second:
+      return None
+    return convert_bytes / self.bytes_per_second
+
+  def to_dict(self):
+    return collections.OrderedDict((
+      ('profile', self.profile),
+      ('totals', self.totals()),
+      ('estimated_seconds', self.estimated_seconds()),
+      ('actions', [
+        collections.OrderedDict(
+          [('action', action), ('path', relpath)] +
+          sorted(details.items()))
+        for action, relpath, details in self.actions
+        ]),
+      ))
+
+
+def to_json(plans, indent=None):
+  """Convert a list of plans to JSON, with grand totals.
+  """
+
+  totals = collections.OrderedDict()
+  estimated_seconds = 0.0
+  for plan in plans:
+    for key, value in plan.totals().items():
+      totals[key] = totals.get(key, 0) + value
+    if estimated_seconds is not None:
+      plan_seconds = plan.estimated_seconds()
+      estimated_seconds = (
+        None if plan_seconds is None
+        else estimated_seconds + plan_seconds)
+
+  return json.dumps(
+    collections.OrderedDict((
+      ('totals', totals),
+      ('estimated_seconds', estimated_seconds),
+      ('profiles', [plan.to_dict() for plan in plans]),
+      )),
+    indent=indent,
+    )
@@ -0,0 +1,216 @@
+"""Persistent cache for file probes.
+
+A probe is a function that takes a path and returns information about
+the file, e.g., its mime type from magic bytes, or audio tags read by
+an external tool. Probe results must be JSON-serializable.
+"""
+
+import binascii
+import logging
+import os
+import threading
+
+from . import util
+
+
+# Magic byte signatures, as (offset, bytes, mime type).
+_MAGIC = (
+  (0, b'fLaC', 'audio/flac'),
+  (0, b'OggS', 'application/ogg'),
+  (0, b'ID3', 'audio/mpeg'),
+  (0, b'\xff\xfb', 'audio/mpeg'),
+  (0, b'\xff\xf3', 'audio/mpeg'),
+  (0, b'\xff\xf2', 'audio/mpeg'),
+  (8, b'WAVE', 'audio/x-wav'),
+  (8, b'AVI ', 'video/x-msvideo'),
+  (8, b'WEBP', 'image/webp'),
+  (4, b'ftyp', 'video/mp4'),
+  (0, b'\x1a\x45\xdf\xa3', 'video/x-matroska'),
+  (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+  (0, b'\xff\xd8\xff', 'image/jpeg'),
+  (0, b'GIF87a', 'image/gif'),
+  (0, b'GIF89a', 'image/gif'),
+  (0, b'II*\x00', 'image/tiff'),
+  (0, b'MM\x00*', 'image/tiff'),
+  (0, b'BM', 'image/bmp'),
+  (0, b'%PDF-', 'application/pdf'),
+  (0, b'PK\x03\x04', 'application/zip'),
+  (32769, b'CD001', 'application/x-iso9660-image'),
+  )
+
+
+def magic_bytes(path, size=16):
+  """Probe that returns the first bytes of a file, as hex.
+  """
+
+  with open(path, 'rb') as f:
+    return binascii.hexlify(f.read(size)).decode('ascii')
+
+
+def sniff_mime(path):
+  """Probe that guesses a file's mime type from its magic bytes.
+
+  Returns:
+      The mime type, or None if it is not recognized.
+  """
+
+  with open(path, 'rb') as f:
+    head = f.read(64)
+    for offset, magic, mime in _MAGIC:
+      if offset + len(magic) <= len(head):
+        data = head[offset:offset + len(magic)]
+      else:
+        f.seek(offset)
+        data = f.read(len(magic))
+      if data == magic:
+        return mime
+  return None
+
+
+def _probe_name(probe_cb):
+  return '%s.%s' % (
+    getattr(probe_cb, '__module__', None),
+    getattr(probe_cb, '__qualname__', type(probe_cb).__qualname__),
+    )
+
+
+class ProbeCache():
+  """Cache of probe results, shared by a tree of profiles.
+
+  Results are keyed by the probe's name, and the (device, inode, size,
+  mtime_ns) of the file, so a file that is reachable through several
+  symlinks (e.g., from sibling profiles) is probed only once, and a
+  file that changes is probed again.
+
+  Results computed in other processes (e.g., in ConvertProfile's
+  convert_cb) are not added to this process's cache. Pickled copies,
+  which are sent to those processes with the profiles, start empty and
+  are never saved, so that the cache isn't copied to every job.
+  """
+
+  _VERSION = 1
+
+  def __init__(self, path=None):
+    """
+    Args:
+        path: File to persist the cache in, or None to keep it in
+            memory only.
+    """
+
+    self._path = path
+
+    self._lock = threading.Lock()
+
+    # Map from key to [path, result], where path is the real path of
+    # the file when it was probed.
+    self._entries = {}
+
+    # Keys that were used since the cache was loaded.
+    self._used = set()
+
+    self._load()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_lock']
+    state['_path'] = None
+    state['_entries'] = {}
+    state['_used'] = set()
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def _load(self):
+    if self._path is None:
+      return
+
+    data = util.load_json(self._path)
+    if data is None:
+      return
+    if data.get('version') != ProbeCache._VERSION:
+      logging.info('Ignoring probe cache %r with old version', self._path)
+      return
+
+    for name, dev, ino, size, mtime_ns, path, result in data['entries']:
+      self._entries[(name, dev, ino, size, mtime_ns)] = [path, result]
+
+  def probe(self, path, probe_cb, name=None):
+    """Get the result of a probe, from the cache if possible.
+
+    Args:
+        path: File to probe. Symlinks are followed.
+        probe_cb: Function that takes a path and returns a
+            JSON-serializable result.
+        name: Name of the probe, used as part of the cache key.
+            Defaults to the qualified name of probe_cb. If the probe
+            changes in a way that affects its results, its name should
+            change too.
+    """
+
+    if name is None:
+      name = _probe_name(probe_cb)
+
+    stat = os.stat(path)
+    key = (name, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    with self._lock:
+      self._used.add(key)
+      entry = self._entries.get(key)
+    if entry is not None:
+      return entry[1]
+
+    result = probe_cb(path)
+
+    with self._lock:
+      self._entries[key] = [os.path.realpath(path), result]
+
+    return result
+
+  def evict(self):
+    """Evict entries for files that no longer exist or have changed.
+
+    Entries used since the cache was loaded are always kept. Others
+    are kept only if the path they were probed at still has the same
+    signature.
+    """
+
+    with self._lock:
+      for key in list(self._entries):
+        if key in self._used:
+          continue
+        name, dev, ino, size, mtime_ns = key
+        try:
+          stat = os.stat(self._entries[key][0])
+        except FileNotFoundError:
+          del self._entries[key]
+          continue
+        if (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns) \
+            != (dev, ino, size, mtime_ns):
+          del self._entries[key]
+
+  def save(self):
+    """Evict stale entries, and save the cache if it is persistent.
+    """
+
+    self.evict()
+
+    if self._path is None:
+      return
+
+    with self._lock:
+      entries = [
+        list(key) + entry
+        for key, entry in self._entries.items()
+        ]
+    util.save_json(
+      self._path,
+      {
+        'version': ProbeCache._VERSION,
+        'entries': entries,
+        },
+      )
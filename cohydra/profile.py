@@ -1,15 +1,33 @@
 import abc
+import concurrent.futures
+import contextlib
+import errno
+import heapq
+import itertools
+import json
 import logging
 import multiprocessing
 import os
 import shutil
 import stat
+import tempfile
+import threading
+import time
+import uuid
 
 import six
 
+from . import changelog
+from . import planning
+from . import probe
+from . import schedule
 from . import util
 
 
+# Prefix of temporary files in profiles.
+_TMP_PREFIX = '.cohydra-tmp-'
+
+
 class Profile(six.with_metaclass(abc.ABCMeta)):
   """Base class for all collection profiles.
 
@@ -21,9 +39,33 @@ class Profile(six.with_metaclass(abc.ABCMeta)):
     _parent: The profile from which this profile is derived, or
         None for a root profile.
     _children: List of child profiles.
+    _state_dir: Directory for persistent state about this profile
+        (e.g., caches), or None. It must not be inside any profile's
+        _top_dir.
+    journal: changelog.Journal that each generate_all() run appends
+        this profile's changes to, or None.
+    trash_dir: Directory to move removed directory trees to, which a
+        background thread then deletes, or None to delete them in
+        place. This keeps large deletions from delaying generate().
+        It must be on the same filesystem as _top_dir (or trees are
+        deleted in place, with a warning), and must not be inside
+        any profile's _top_dir or be shared with another profile.
   """
 
-  def __init__(self, top_dir, parent):
+  # Whether files that aren't symlinks or directories are deleted from
+  # the trash. Profiles that consist only of symlinks and directories
+  # leave anything else there, with an error, instead of deleting
+  # files they didn't create.
+  _trash_files = True
+
+  def __init__(
+      self,
+      top_dir,
+      parent,
+      state_dir=None,
+      journal=None,
+      trash_dir=None,
+      ):
     """Create a profile.
     """
 
@@ -33,9 +75,39 @@ class Profile(six.with_metaclass(abc.ABCMeta)):
 
     self._children = []
 
+    self._state_dir = state_dir
+
+    self._probe_cache = None
+
+    self.journal = journal
+
+    # Token of the generate_all() call that is generating this profile,
+    # or None.
+    self._run = None
+
+    # changelog.ChangeSet of changes since the journal was last
+    # written, or None if there's no journal.
+    self._changes = None if journal is None else changelog.ChangeSet()
+
+    # Protects _changes from threads that filter in parallel.
+    self._changes_lock = threading.Lock()
+
+    self._trash = (
+      None if trash_dir is None
+      else _Trash(trash_dir, self._trash_files, self.log))
+
     if self._parent is not None:
       self._parent._children.append(self)
 
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    # Changes are only recorded, and trees only removed, by the
+    # generating process.
+    state['_changes'] = None
+    state['_changes_lock'] = None
+    state['_trash'] = None
+    return state
+
   def __str__(self):
     return '%s.%s(top_dir=%r, parent=%r)' % (
       self.__class__.__module__,
@@ -44,25 +116,293 @@ class Profile(six.with_metaclass(abc.ABCMeta)):
       None if self._parent is None else self._parent._top_dir,
       )
 
-  def generate_all(self, depth=0):
+  def generate_all(
+      self,
+      depth=0,
+      resume=False,
+      time_budget=None,
+      relpaths=None,
+      ):
     """Generate this profile and all of its children.
+
+    If this profile has a state directory, a checkpoint of which
+    profiles were generated is kept there until all of them are done.
+
+    Args:
+        depth: Depth of this profile, for logging.
+        resume: If true, skip profiles that were already generated by
+            a previous, interrupted call. Note that those profiles are
+            not updated for any changes to their sources since then.
+            This requires a state directory, to keep the checkpoint in.
+        time_budget: If not None, the number of seconds that
+            generating all the profiles should take, at most. See
+            generate().
+        relpaths: If not None, a list of paths relative to this
+            profile's top directory. Only those files and directories
+            (recursively) are generated in this profile, and the
+            corresponding paths in each of its descendants. E.g.,
+            ['Artist/Album'] after adding an album to a root profile.
+            Not supported with resume.
+    """
+
+    if resume and self._state_dir is None:
+      raise ValueError('resume requires a state_dir')
+
+    if relpaths is not None:
+      if resume:
+        raise ValueError('resume is not supported with relpaths')
+      relpaths = util.normalize_relpaths(relpaths)
+
+    deadline = (
+      None if time_budget is None else time.monotonic() + time_budget)
+
+    checkpoint = _RunCheckpoint(
+      None if relpaths is not None
+      else self.state_path('generate_all-checkpoint.json'),
+      resume,
+      )
+
+    walk = self._walk(depth)
+    run = object()
+    # Map from profile to the relative paths it generated, or None for
+    # everything.
+    generated = {}
+    try:
+      for profile, profile_depth in walk:
+        if profile is self or relpaths is None:
+          profile_relpaths = relpaths
+        else:
+          profile_relpaths = util.normalize_relpaths(
+            itertools.chain.from_iterable(
+              generated[parent] for parent in profile._all_parents()
+              if parent in generated))
+        profile._run = run
+        generated[profile] = profile._generate_one(
+          profile_depth, checkpoint, deadline, profile_relpaths)
+    finally:
+      for profile, profile_depth in walk:
+        profile._run = None
+
+    checkpoint.finish()
+
+    root = self.root()
+    if root._probe_cache is not None:
+      root._probe_cache.save()
+
+  def _generate_one(self, depth, checkpoint, deadline, relpaths):
+    """Generate this profile, as part of generate_all().
+
+    Returns:
+        The relative paths that were generated, for the children, or
+        None if relpaths is None.
+    """
+
+    if checkpoint.is_done(self):
+      logging.info(
+        '%sAlready generated %s, resuming',
+        '  ' * depth,
+        self,
+        )
+    else:
+      logging.info('%sGenerating %s', '  ' * depth, self)
+      kwargs = {}
+      if deadline is not None:
+        kwargs['time_budget'] = max(0.0, deadline - time.monotonic())
+      if relpaths is not None:
+        kwargs['relpaths'] = relpaths
+      if self._trash is not None:
+        # Finish deleting anything left by a previous run.
+        self._trash.empty()
+      try:
+        dst_relpaths = self.generate(**kwargs)
+      except BaseException:
+        self.write_journal(complete=False)
+        raise
+      self.write_journal()
+      if relpaths is not None:
+        relpaths = util.normalize_relpaths(dst_relpaths)
+      checkpoint.mark_done(self)
+
+    return relpaths
+
+  def _all_parents(self):
+    """Get the profiles this profile is a child of.
+    """
+
+    return [] if self._parent is None else [self._parent]
+
+  def _walk(self, depth=0):
+    """Get this profile and its descendants, in the order to generate them.
+
+    The order is depth first, except that a profile with several
+    parents (see UnionProfile) comes only once, right after the last of
+    its parents that is also a descendant of this profile.
+
+    Args:
+        depth: Depth of this profile.
+
+    Returns:
+        A list of (profile, depth) tuples.
+    """
+
+    descendants = set()
+    stack = [self]
+    while stack:
+      profile = stack.pop()
+      if profile not in descendants:
+        descendants.add(profile)
+        stack.extend(profile._children)
+
+    # Map from profile to the number of its parents in descendants that
+    # haven't been walked yet.
+    waiting = {}
+    result = []
+
+    def walk(profile, depth):
+      result.append((profile, depth))
+      for child in profile._children:
+        if child not in waiting:
+          waiting[child] = sum(
+            1 for parent in child._all_parents() if parent in descendants)
+        waiting[child] -= 1
+        if waiting[child] == 0:
+          walk(child, depth + 1)
+
+    walk(self, depth)
+    return result
+
+  def plan_all(self):
+    """Plan this profile and all of its children, without writing.
+
+    Each profile is planned against the current contents of its
+    parent, so the plans for descendants of profiles that have changes
+    planned may be incomplete.
+
+    Returns:
+        A list of planning.Plan objects.
     """
 
-    logging.info('%sGenerating %s', '  ' * depth, self)
-    self.generate()
+    return [profile.plan() for profile, depth in self._walk()]
+
+  def plan(self):
+    """Plan what generate() would do, without writing anything.
+
+    Returns:
+        A planning.Plan.
+    """
 
-    # TODO: parallelize?
-    for child in self._children:
-      child.generate_all(depth + 1)
+    return planning.Plan(self)
 
   def print_all(self, depth=0):
     """List all profiles, for debugging.
     """
 
-    print('  ' * depth + str(self))
+    for profile, profile_depth in self._walk(depth):
+      print('  ' * profile_depth + str(profile))
+
+  def write_journal(self, complete=True):
+    """Append the changes since the last call to the journal, if any.
+
+    generate_all() calls this after generating each profile.
+
+    Args:
+        complete: Whether the changes are from a successful run.
+
+    Returns:
+        The run's sequence number in the journal, or None.
+    """
+
+    if self.journal is None:
+      return None
+
+    changes = self._changes.changes()
+    self._changes = changelog.ChangeSet()
+    return self.journal.write_run(changes, complete=complete)
+
+  def record_added(self, relpath, path_type, details=None):
+    """Record that a path was created, for the journal.
+
+    Args:
+        relpath: Path relative to this profile's top directory.
+        path_type: changelog.FILE, DIR, or SYMLINK.
+        details: Target of a symlink, or None.
+    """
+
+    if self._changes is not None \
+        and not os.path.basename(relpath).startswith(_TMP_PREFIX):
+      with self._changes_lock:
+        self._changes.added(relpath, path_type, details)
+
+  def record_removed(self, relpath):
+    """Record that a path is about to be removed, for the journal.
+
+    This must be called before the path is removed. For a directory,
+    its contents are recorded too.
+    """
+
+    if self._changes is None \
+        or os.path.basename(relpath).startswith(_TMP_PREFIX):
+      return
+
+    path = self.dst_path(relpath)
+    path_type, details = changelog.describe(path)
+    removed = []
+    if path_type == changelog.DIR:
+      for entry_relpath, entry in util.recursive_scandir(
+          path, dir_first=False):
+        removed.append(
+          (os.path.join(relpath, entry_relpath),)
+          + changelog.describe(entry.path))
+    removed.append((relpath, path_type, details))
+    with self._changes_lock:
+      for change in removed:
+        self._changes.removed(*change)
+
+  def makedirs(self, relpath):
+    """Create a destination directory and its parents, if needed.
+
+    Any directories that are created are recorded for the journal.
+    This function is multi-threading safe.
+    """
+
+    path = self.dst_path(relpath)
+    if self._changes is None or os.path.isdir(path):
+      os.makedirs(path, exist_ok=True)
+      return
+
+    # Otherwise, two threads could both find the same directory
+    # missing, and both record it.
+    with self._changes_lock:
+      missing = []
+      parent_relpath = relpath
+      while parent_relpath \
+          and not os.path.isdir(self.dst_path(parent_relpath)):
+        missing.append(parent_relpath)
+        parent_relpath = os.path.dirname(parent_relpath)
+      os.makedirs(path, exist_ok=True)
+      for dir_relpath in reversed(missing):
+        self._changes.added(dir_relpath, changelog.DIR)
+
+  def discard(self, relpath):
+    """Move a destination directory tree to the trash, if possible.
+
+    The tree is then deleted in the background. See trash_dir.
+
+    Returns:
+        True if it was moved, or False if the caller must delete it.
+    """
+
+    if self._trash is None or not self._trash.enabled:
+      return False
+    self.record_removed(relpath)
+    return self._trash.add(self.dst_path(relpath))
+
+  def wait_for_trash(self):
+    """Wait until everything that was moved to the trash is deleted.
+    """
 
-    for child in self._children:
-      child.print_all(depth + 1)
+    if self._trash is not None:
+      self._trash.wait()
 
   def log(self, level, msg, *args, **kwargs):
     """Log, with additional info about the profile.
@@ -74,6 +414,51 @@ class Profile(six.with_metaclass(abc.ABCMeta)):
       *args,
       **kwargs)
 
+  def root(self):
+    """Get the root profile of the tree this profile is in.
+    """
+
+    profile = self
+    while profile._parent is not None:
+      profile = profile._parent
+    return profile
+
+  def state_path(self, name):
+    """Get the path of a file in this profile's state directory.
+
+    Returns:
+        The path, or None if this profile has no state directory.
+    """
+
+    if self._state_dir is None:
+      return None
+
+    return os.path.join(self._state_dir, name)
+
+  @property
+  def probe_cache(self):
+    """The probe.ProbeCache shared by the whole tree of profiles.
+
+    It is stored in the root profile's state directory, if it has one,
+    and saved at the end of generate_all().
+    """
+
+    root = self.root()
+    if root._probe_cache is None:
+      root._probe_cache = probe.ProbeCache(
+        root.state_path('probe-cache.json'))
+    return root._probe_cache
+
+  def probe(self, path, probe_cb, name=None):
+    """Probe a file, using the tree's probe cache.
+
+    This is intended for use by callbacks, e.g.,
+    profile.probe(src_path, cohydra.probe.sniff_mime). See
+    probe.ProbeCache.probe() for the arguments.
+    """
+
+    return self.probe_cache.probe(path, probe_cb, name=name)
+
   def src_path(self, relpath=''):
     """Given a relative path, return the absolute path for reading.
 
@@ -112,15 +497,221 @@ class Profile(six.with_metaclass(abc.ABCMeta)):
     return os.path.abspath(os.path.join(self._top_dir, relpath))
 
   @abc.abstractmethod
-  def generate(self):
+  def generate(self, time_budget=None, relpaths=None):
     """Generate this profile from its parent.
 
     This method assumes that the parent is up-to-date.
+
+    Args:
+        time_budget: If not None, the number of seconds that
+            generation should take, at most. Profiles that can't
+            finish in time should leave their destination in a usable
+            state, and finish on a later call. Profiles that don't do
+            any expensive work may ignore this.
+        relpaths: If not None, a list of paths relative to the
+            parent's top directory. Only those files and directories
+            (recursively) are generated, and everything else is
+            assumed to be up to date. The paths need not exist, e.g.,
+            if they were deleted from the parent.
+
+    Returns:
+        If relpaths is not None, a list of the paths relative to this
+        profile's top directory that correspond to relpaths, for
+        generating the children. Otherwise, None.
     """
 
     pass
 
 
+class _Trash():
+  """Directory of removed trees, which a background thread deletes.
+
+  Each tree is moved to a unique name in the trash, so that trees with
+  the same name don't collide. Anything left from a previous process is
+  deleted too.
+  """
+
+  def __init__(self, path, delete_files, log):
+    """
+    Args:
+        path: The trash directory. It's created if needed.
+        delete_files: Whether to delete files that aren't symlinks or
+            directories. If not, they're left in the trash, and an
+            error is logged.
+        log: Profile.log() of the profile that the trash is for.
+    """
+
+    self.path = path
+    self.delete_files = delete_files
+    self.log = log
+
+    # False after moving a tree failed because the trash is on another
+    # filesystem.
+    self.enabled = True
+
+    # Protects _thread and _dirty.
+    self._lock = threading.Lock()
+
+    # Thread that's deleting the trash, or None.
+    self._thread = None
+
+    # Whether the trash changed since the thread last listed it.
+    self._dirty = False
+
+    # Names of entries in the trash that have files that are kept.
+    self._kept = set()
+
+  def add(self, path):
+    """Move a tree to the trash, and start deleting it.
+
+    Returns:
+        True if the tree was moved, or False if it's on another
+        filesystem.
+    """
+
+    os.makedirs(self.path, exist_ok=True)
+    # Anything in the trash may be deleted by the background thread at
+    # any time, so the tree is moved directly to its final name.
+    try:
+      os.rename(path, os.path.join(self.path, uuid.uuid4().hex))
+    except OSError as e:
+      if e.errno != errno.EXDEV:
+        raise
+      self.log(
+        logging.WARNING,
+        'Trash %r is on another filesystem, deleting in place',
+        self.path,
+        )
+      self.enabled = False
+      return False
+
+    self.empty()
+    return True
+
+  def empty(self):
+    """Start deleting everything in the trash, in the background.
+    """
+
+    with self._lock:
+      self._dirty = True
+      if self._thread is None:
+        self._thread = threading.Thread(
+          target=self._run,
+          name='cohydra-trash',
+          )
+        self._thread.start()
+
+  def wait(self):
+    """Wait for the background thread, if any.
+    """
+
+    with self._lock:
+      thread = self._thread
+    if thread is not None:
+      thread.join()
+
+  def _run(self):
+    while True:
+      with self._lock:
+        if not self._dirty:
+          self._thread = None
+          return
+        self._dirty = False
+
+      try:
+        names = os.listdir(self.path)
+      except FileNotFoundError:
+        names = []
+
+      for name in names:
+        if name in self._kept:
+          continue
+        try:
+          self._delete(name)
+        except OSError as e:
+          self.log(logging.ERROR, 'Failed to empty trash %r: %s', name, e)
+          self._kept.add(name)
+
+  def _delete(self, name):
+    path = os.path.join(self.path, name)
+    if self.delete_files:
+      shutil.rmtree(path)
+      return
+
+    def delete_tree(path):
+      """Delete symlinks and directories, and return whether any
+      other files were kept.
+      """
+
+      kept = False
+      for entry in os.scandir(path):
+        if entry.is_symlink():
+          os.remove(entry.path)
+        elif entry.is_dir(follow_symlinks=False):
+          if delete_tree(entry.path):
+            kept = True
+          else:
+            os.rmdir(entry.path)
+        else:
+          self.log(
+            logging.ERROR,
+            'Keeping non-symlink non-directory %r in the trash',
+            entry.path,
+            )
+          kept = True
+      return kept
+
+    if delete_tree(path):
+      self._kept.add(name)
+    else:
+      os.rmdir(path)
+
+
+class _RunCheckpoint():
+  """Record of which profiles were generated in a generate_all() run.
+  """
+
+  def __init__(self, path, resume):
+    """
+    Args:
+        path: File to keep the checkpoint in, or None.
+        resume: Whether to load a checkpoint from a previous run.
+    """
+
+    self._path = path
+
+    # Top directories of profiles generated by a previous run.
+    self._resumed = set()
+    if path is not None and resume:
+      self._resumed.update(util.load_json(path, []))
+
+    # Top directories of profiles generated so far, including by a
+    # previous run.
+    self._done = set(self._resumed)
+
+  def _key(self, profile):
+    return os.path.abspath(profile._top_dir)
+
+  def is_done(self, profile):
+    return self._key(profile) in self._resumed
+
+  def mark_done(self, profile):
+    self._done.add(self._key(profile))
+    if self._path is not None:
+      util.save_json(self._path, sorted(self._done))
+
+  def finish(self):
+    """Remove the checkpoint, after a successful run.
+    """
+
+    if self._path is None:
+      return
+    try:
+      os.remove(self._path)
+    except FileNotFoundError:
+      pass
+
+
 class RootProfile(Profile):
   """Root profile.
 
@@ -128,11 +719,11 @@ class RootProfile(Profile):
   instead of a profile derived from another profile's files.
   """
 
-  def __init__(self, top_dir):
-    Profile.__init__(self, top_dir, None)
+  def __init__(self, top_dir, state_dir=None):
+    Profile.__init__(self, top_dir, None, state_dir=state_dir)
 
-  def generate(self):
-    pass
+  def generate(self, time_budget=None, relpaths=None):
+    return relpaths
 
 
 class FilterProfile(Profile):
@@ -145,7 +736,9 @@ class FilterProfile(Profile):
   profile's files.
   """
 
-  def __init__(self, select_cb, **kwargs):
+  _trash_files = False
+
+  def __init__(self, select_cb, threads=None, **kwargs):
     """
     Args:
         select_cb: Callback to select which files/directories in a
@@ -163,13 +756,26 @@ class FilterProfile(Profile):
             must be within dst_relpath.) Directories in the keep-list
             are recursed into; anything else is symlinked. Anything
             not in the keep-list is ignored.
+        threads: If not None, the number of threads to filter
+            independent directories with concurrently, which helps on
+            filesystems with high latency (e.g., NFS). select_cb must
+            then be thread-safe. The result is the same as with the
+            default, serial traversal.
     """
 
     super(FilterProfile, self).__init__(**kwargs)
 
     self.select_cb = select_cb
 
-  def generate(self):
+    self.threads = threads
+
+  def generate(self, time_budget=None, relpaths=None):
+    if relpaths is not None:
+      return [
+        self.filter_path(relpath)
+        for relpath in util.normalize_relpaths(relpaths)
+        ]
+
     # Everything in the profile dir is going to be a symlink or
     # directory, so preserving files from a previous run shouldn't
     # help performance enough to be worth the complicated logic of
@@ -186,16 +792,21 @@ class FilterProfile(Profile):
 
     dst_path = self.dst_path(relpath)
     for dst_entry in os.scandir(dst_path):
+      dst_entry_relpath = os.path.join(relpath, dst_entry.name)
       if dst_entry.is_symlink():
         self.log(logging.DEBUG, 'Deleting symlink %r', dst_entry.path)
+        self.record_removed(dst_entry_relpath)
         os.remove(dst_entry.path)
       elif dst_entry.is_dir():
-        self.clean(os.path.join(relpath, dst_entry.name))
+        if self.discard(dst_entry_relpath):
+          continue
+        self.clean(dst_entry_relpath)
         self.log(
           logging.DEBUG,
           'Deleting directory %r',
           dst_entry.path,
           )
+        self.record_removed(dst_entry_relpath)
         os.rmdir(dst_entry.path)
       else:
         self.log(
@@ -205,24 +816,41 @@ class FilterProfile(Profile):
           )
         raise RuntimeError('Cannot clean %r' % relpath)
 
-  def filter_dir(self, src_relpath, dst_relpath):
-    """Filter a single directory, recursively.
-
-    If any files are included in the filter, this will create the
-    directory (if needed) and symlink the files. Otherwise, this will
-    do nothing.
+  def _remove(self, dst_relpath):
+    """Remove a symlink or directory tree, if it exists.
     """
 
-    src_path = self.src_path(src_relpath)
     dst_path = self.dst_path(dst_relpath)
+    if os.path.islink(dst_path):
+      self.log(logging.DEBUG, 'Deleting symlink %r', dst_path)
+      self.record_removed(dst_relpath)
+      os.remove(dst_path)
+    elif os.path.isdir(dst_path):
+      if self.discard(dst_relpath):
+        return
+      self.clean(dst_relpath)
+      self.log(logging.DEBUG, 'Deleting directory %r', dst_path)
+      self.record_removed(dst_relpath)
+      os.rmdir(dst_path)
+    elif os.path.lexists(dst_path):
+      raise RuntimeError('Cannot clean %r' % dst_relpath)
+
+  def select_dir(self, src_relpath, dst_relpath):
+    """Select which entries in a single directory to keep.
+
+    Returns:
+        A list of (os.DirEntry from the source, relative source path,
+        relative destination path) tuples.
+    """
 
     src_keep = self.select_cb(
       self,
       src_relpath,
       dst_relpath,
-      list(os.scandir(src_path)),
+      list(os.scandir(self.src_path(src_relpath))),
       )
 
+    selected = []
     for src_entry in src_keep:
       if isinstance(src_entry, tuple):
         # Keep and rename.
@@ -245,24 +873,264 @@ class FilterProfile(Profile):
             )
           )
 
+      selected.append((src_direntry, src_entry_relpath, dst_entry_relpath))
+
+    return selected
+
+  def filter_dir(self, src_relpath, dst_relpath):
+    """Filter a single directory, recursively.
+
+    If any files are included in the filter, this will create the
+    directory (if needed) and symlink the files. Otherwise, this will
+    do nothing.
+    """
+
+    if self.threads is None:
+      self._filter_dir_serial(src_relpath, dst_relpath)
+    else:
+      self._filter_dir_parallel(src_relpath, dst_relpath)
+
+  def _filter_dir_serial(self, src_relpath, dst_relpath):
+    src_path = self.src_path(src_relpath)
+    dst_path = self.dst_path(dst_relpath)
+
+    for src_direntry, src_entry_relpath, dst_entry_relpath \
+        in self.select_dir(src_relpath, dst_relpath):
       if src_direntry.is_dir():
-        self.filter_dir(src_entry_relpath, dst_entry_relpath)
+        self._filter_dir_serial(src_entry_relpath, dst_entry_relpath)
       else:
-        os.makedirs(dst_path, exist_ok=True)
-        self.log(
-          logging.DEBUG,
-          'Linking %r -> %r',
-          dst_entry_relpath,
-          src_entry_relpath,
-          )
-        os.symlink(
-          os.path.relpath(self.src_path(src_entry_relpath), dst_path),
-          self.dst_path(dst_entry_relpath),
-          )
+        self._link(src_entry_relpath, dst_entry_relpath)
 
     if dst_relpath and os.path.isdir(dst_path):
       shutil.copystat(src_path, dst_path)
 
+  def _filter_dir_parallel(self, src_relpath, dst_relpath):
+    """Like _filter_dir_serial(), but one level of the tree at a time.
+
+    Each directory is still selected by a single select_cb call, so
+    checks across a directory's entries (e.g., for duplicate names)
+    work the same as in serial mode.
+    """
+
+    # List of (src relpath, dst relpath) of all directories, parents
+    # before children.
+    dirs = []
+
+    with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+      level = [(src_relpath, dst_relpath)]
+      while level:
+        dirs.extend(level)
+        next_level = []
+        for subdirs in executor.map(
+            lambda relpaths: self._filter_dir_contents(*relpaths),
+            level):
+          next_level.extend(subdirs)
+        level = next_level
+
+    # Linking files and creating subdirectories changes a directory's
+    # stats, so they're copied after everything else, deepest first.
+    for src_dir_relpath, dst_dir_relpath in reversed(dirs):
+      dst_path = self.dst_path(dst_dir_relpath)
+      if dst_dir_relpath and os.path.isdir(dst_path):
+        shutil.copystat(self.src_path(src_dir_relpath), dst_path)
+
+  def _filter_dir_contents(self, src_relpath, dst_relpath):
+    """Link the selected files in a single directory.
+
+    Returns:
+        A list of (src relpath, dst relpath) of the selected
+        subdirectories.
+    """
+
+    subdirs = []
+    for src_direntry, src_entry_relpath, dst_entry_relpath \
+        in self.select_dir(src_relpath, dst_relpath):
+      if src_direntry.is_dir():
+        subdirs.append((src_entry_relpath, dst_entry_relpath))
+      else:
+        self._link(src_entry_relpath, dst_entry_relpath)
+    return subdirs
+
+  def _link(self, src_relpath, dst_relpath):
+    """Symlink a file, creating the destination directory if needed.
+    """
+
+    dst_dirpath = os.path.dirname(self.dst_path(dst_relpath))
+    self.makedirs(os.path.dirname(dst_relpath))
+    self.log(
+      logging.DEBUG,
+      'Linking %r -> %r',
+      dst_relpath,
+      src_relpath,
+      )
+    target = os.path.relpath(self.src_path(src_relpath), dst_dirpath)
+    os.symlink(target, self.dst_path(dst_relpath))
+    self.record_added(dst_relpath, changelog.SYMLINK, target)
+
+  def filter_path(self, src_relpath):
+    """Filter a single file or directory, recursively.
+
+    This updates only src_relpath and the entries in its parent
+    directory: anything there that is no longer selected is removed,
+    e.g., if src_relpath was deleted from the source. Directories that
+    are left empty are removed.
+
+    Returns:
+        The relative destination path that src_relpath maps to. If it
+        isn't selected, this is the path it would map to if it were
+        not renamed.
+    """
+
+    if not src_relpath:
+      self.clean('')
+      self.filter_dir('', '')
+      return ''
+
+    components = src_relpath.split(os.sep)
+
+    # List of (src relpath, dst relpath) of the directories containing
+    # src_relpath, shallowest first.
+    parents = []
+
+    src_dir_relpath = ''
+    dst_dir_relpath = ''
+    for index, name in enumerate(components):
+      src_entry_relpath = os.path.join(src_dir_relpath, name)
+
+      if os.path.isdir(self.src_path(src_dir_relpath)):
+        selected = self.select_dir(src_dir_relpath, dst_dir_relpath)
+      else:
+        selected = []
+      match = None
+      for item in selected:
+        if item[1] == src_entry_relpath:
+          match = item
+
+      if match is not None and match[0].is_dir() \
+          and index < len(components) - 1:
+        src_dir_relpath, dst_dir_relpath = match[1], match[2]
+        parents.append((src_dir_relpath, dst_dir_relpath))
+        continue
+
+      # This is the entry to update. Anything else in the same
+      # directory that isn't selected is stale.
+      dst_dir_path = self.dst_path(dst_dir_relpath)
+      if os.path.isdir(dst_dir_path):
+        selected_dst_relpaths = {item[2] for item in selected}
+        for dst_entry in os.scandir(dst_dir_path):
+          dst_entry_relpath = os.path.join(dst_dir_relpath, dst_entry.name)
+          if dst_entry_relpath not in selected_dst_relpaths:
+            self._remove(dst_entry_relpath)
+
+      if match is None:
+        dst_entry_relpath = os.path.join(dst_dir_relpath, name)
+      else:
+        dst_entry_relpath = match[2]
+        self._remove(dst_entry_relpath)
+        if match[0].is_dir():
+          self.filter_dir(match[1], match[2])
+        else:
+          self._link(match[1], match[2])
+      break
+
+    for src_dir_relpath, dst_dir_relpath in reversed(parents):
+      dst_dir_path = self.dst_path(dst_dir_relpath)
+      if not os.path.isdir(dst_dir_path):
+        continue
+      if os.listdir(dst_dir_path):
+        shutil.copystat(self.src_path(src_dir_relpath), dst_dir_path)
+      else:
+        self.log(logging.DEBUG, 'Deleting directory %r', dst_dir_path)
+        self.record_removed(dst_dir_relpath)
+        os.rmdir(dst_dir_path)
+
+    return os.path.join(dst_entry_relpath, *components[index + 1:])
+
+  def plan(self):
+    """Plan the net effect of generate().
+
+    Although generate() removes everything and then recreates it, the
+    plan lists only links and directories that would be different
+    afterwards.
+    """
+
+    plan = planning.Plan(self)
+
+    # Map from dst relpath to link target, or None for directories.
+    wanted = {}
+    # Map from dst relpath to src relpath, for directories.
+    wanted_dirs = {}
+    self._plan_dir('', '', wanted, wanted_dirs)
+
+    existing = {}
+    for dst_relpath, dst_entry \
+        in util.recursive_scandir(self.dst_path(), dir_first=False):
+      if dst_entry.is_symlink():
+        existing[dst_relpath] = os.readlink(dst_entry.path)
+      elif dst_entry.is_dir():
+        existing[dst_relpath] = None
+      else:
+        raise RuntimeError(
+          'Cannot clean %r' % os.path.dirname(dst_relpath))
+
+    # Removals, deepest first.
+    for dst_relpath, target in existing.items():
+      if dst_relpath in wanted and wanted[dst_relpath] == target:
+        continue
+      plan.add(
+        planning.RMDIR if target is None else planning.REMOVE,
+        dst_relpath,
+        )
+
+    # Additions, shallowest first.
+    for dst_relpath, target in sorted(wanted.items()):
+      if dst_relpath in existing and existing[dst_relpath] == target:
+        continue
+      if target is None:
+        plan.add(planning.MKDIR, dst_relpath)
+      else:
+        plan.add(planning.LINK, dst_relpath, target=target)
+
+    for dst_relpath, src_relpath in sorted(wanted_dirs.items()):
+      if not util.stats_match(
+          self.src_path(src_relpath),
+          self.dst_path(dst_relpath)):
+        plan.add(planning.COPYSTAT, dst_relpath)
+
+    return plan
+
+  def _plan_dir(self, src_relpath, dst_relpath, wanted, wanted_dirs):
+    """Like filter_dir(), but record what it would create.
+
+    Returns:
+        True if the directory would be created.
+    """
+
+    dst_path = self.dst_path(dst_relpath)
+    has_contents = False
+
+    for src_direntry, src_entry_relpath, dst_entry_relpath \
+        in self.select_dir(src_relpath, dst_relpath):
+      if src_direntry.is_dir():
+        if self._plan_dir(
+            src_entry_relpath,
+            dst_entry_relpath,
+            wanted,
+            wanted_dirs):
+          has_contents = True
+      else:
+        has_contents = True
+        wanted[dst_entry_relpath] = os.path.relpath(
+          self.src_path(src_entry_relpath),
+          dst_path,
+          )
+
+    if has_contents and dst_relpath:
+      wanted[dst_relpath] = None
+      wanted_dirs[dst_relpath] = src_relpath
+
+    return has_contents
+
 
 class ConvertProfile(Profile):
   """Profile in which every file is either symlinked or converted.
@@ -279,7 +1147,27 @@ class ConvertProfile(Profile):
   particular device.
   """
 
-  def __init__(self, select_cb, convert_cb, **kwargs):
+  # Action for conversions in plans.
+  plan_action = planning.CONVERT
+
+  def __init__(
+      self,
+      select_cb,
+      convert_cb=None,
+      batch_convert_cb=None,
+      batch_size=None,
+      batch_bytes=None,
+      convert_group=None,
+      fingerprint=None,
+      placeholder_cb=None,
+      concurrency=None,
+      nice=None,
+      ionice=None,
+      executor=None,
+      dedup=None,
+      remember_failures=False,
+      failure_backoff=None,
+      **kwargs):
     """
     Args:
         select_cb: Callback to select which files to convert. Its
@@ -290,95 +1178,902 @@ class ConvertProfile(Profile):
             None, and the file is symlinked with the same relative
             filename. This callback must ensure that no two source
             files are mapped (via symlinking or conversion) to the
-            same destination filename.
+            same destination filename. Instead of a relative
+            destination filename, it may return a tuple of that and a
+            fingerprint for the file, which overrides the profile's
+            fingerprint.
         convert_cb: Callback to convert a file. Its arguments (in
             order) are the profile, the source filename, and the
-            destination filename. This callback must be
+            destination filename. The destination filename is a
+            temporary name in the destination directory, with the
+            same extension, which is renamed into place after the
+            conversion succeeds. This callback must be
             multi-threading and multi-processing safe.
+        batch_convert_cb: Alternative to convert_cb, for converters
+            that can handle many files per invocation. Its arguments
+            (in order) are the profile, and a list of (source
+            filename, destination filename) tuples, all with
+            destinations in the same directory. It may return a dict
+            mapping destination filenames that failed to convert to
+            the exceptions describing the failures, or raise an
+            exception if the entire batch failed. This callback must
+            be multi-threading and multi-processing safe.
+        batch_size: Maximum number of files per batch. Defaults to 1
+            with convert_cb, and 32 with batch_convert_cb.
+        batch_bytes: If not None, a batch is also limited to this
+            many bytes of source files (but always has at least one
+            file).
+        convert_group: ConvertGroup that this profile is a member of,
+            or None.
+        fingerprint: JSON-serializable description of the converter
+            and its settings, e.g., ['oggenc', '-q', '8'], or None.
+            Converted files are considered out of date if they were
+            converted with a different fingerprint, so changing the
+            settings reconverts exactly the affected files.
+            Fingerprints are stored in the profile's state directory,
+            so one is required when fingerprints are used.
+        placeholder_cb: Callback to decide what to do with a file that
+            can't be converted within the time budget of generate().
+            Its arguments (in order) are the profile, and a relative
+            source filename. If it returns true (or if placeholder_cb
+            is None), the destination is temporarily a symlink to the
+            source. Otherwise, the destination is temporarily
+            missing. E.g., this should return false if the source
+            format is not supported by the device this profile is for.
+        concurrency: Maximum number of concurrent conversion jobs, or
+            a schedule.AdaptiveConcurrency to adjust the number based
+            on the system's load. Defaults to the number of CPUs.
+        nice: Niceness increment for conversion processes, or None.
+        ionice: I/O priority for conversion processes, as a tuple of
+            (class, level), or None. See schedule.init_worker().
+        executor: Object to run conversions with instead of a local
+            multiprocessing.Pool, e.g., a distributed.Coordinator, or
+            None. It must have a multiprocessing.Pool-like
+            apply_async(), and concurrency should match the number of
+            jobs it can run at once. nice and ionice don't apply to
+            it.
+        dedup: None to convert every source, or 'hardlink' or 'copy'
+            to convert identical sources (with the same fingerprint
+            and destination extension) only once per run. The other
+            destinations are then hardlinked to the converted file
+            (if their sources also have the same permissions and
+            modification time) or copied from it. This requires that
+            conversions depend only on the contents of sources.
+        remember_failures: If true, failed conversions are logged and
+            recorded in the state directory (which is required),
+            instead of raising an exception. Later runs skip them,
+            with a warning, until the source file or its fingerprint
+            changes. See load_failures() and clear_failures().
+        failure_backoff: If not None, number of seconds after which a
+            recorded failure is retried anyway. The wait doubles after
+            each retry that fails again.
     """
 
     super(ConvertProfile, self).__init__(**kwargs)
 
     self.select_cb = select_cb
 
-    self.convert_cb = convert_cb
+    if batch_convert_cb is None:
+      self.convert_cb = convert_cb
+      self.batch_convert_cb = PerFileConverter(convert_cb)
+      default_batch_size = 1
+    elif convert_cb is None:
+      self.convert_cb = None
+      self.batch_convert_cb = batch_convert_cb
+      default_batch_size = 32
+    else:
+      raise ValueError(
+        'convert_cb and batch_convert_cb are mutually exclusive')
 
-  def generate(self):
-    dst_keep = self.convert()
+    self.batch_size = (
+      default_batch_size if batch_size is None else batch_size)
 
-    self.clean(dst_keep)
+    self.batch_bytes = batch_bytes
 
-    util.fix_dir_stats(self)
+    self.convert_group = convert_group
+    if self.convert_group is not None:
+      self.convert_group.add(self)
 
-  def convert(self):
-    """Convert or symlink files.
+    self.fingerprint = fingerprint
+    if self.fingerprint is not None and self._state_dir is None:
+      raise ValueError('Fingerprints require a state_dir')
 
-    Returns:
-        A set of relative destination paths of all converted or
-        symlinked files, and all directories.
-    """
+    # Map from dst relpath to the fingerprint of the converted file,
+    # loaded lazily from the state directory.
+    self._fingerprints = None
 
-    # Map from dst relpath to src relpath.
-    relpath_dst_to_src = {}
+    # Map from dst relpath to the fingerprint that a file being
+    # converted will have.
+    self._pending_fingerprints = {}
 
-    with multiprocessing.Pool() as pool:
-      results = []
+    self.placeholder_cb = placeholder_cb
 
-      for src_relpath, dst_relpath, convert \
-          in self.select_and_symlink():
-        if dst_relpath in relpath_dst_to_src:
-          self.log(
-            logging.ERROR,
-            'Found duplicate destination %r from sources %r and %r',
-            dst_relpath,
-            relpath_dst_to_src[dst_relpath],
-            src_relpath,
+    # List of dst relpaths of conversions that didn't finish in the
+    # time budget of the last generate().
+    self.pending = []
+
+    if concurrency is None or isinstance(concurrency, int):
+      self.concurrency = schedule.FixedConcurrency(concurrency)
+    else:
+      self.concurrency = concurrency
+
+    self.nice = nice
+
+    self.ionice = ionice
+
+    self.executor = executor
+
+    if dedup not in (None, 'hardlink', 'copy'):
+      raise ValueError('Unknown dedup %r' % dedup)
+    self.dedup = dedup
+
+    # Map from '<st_dev>:<st_ino>' of sources to [st_size, st_mtime_ns,
+    # digest], loaded lazily from the state directory.
+    self._digests = None
+
+    # Entries of _digests that were used in the current run.
+    self._used_digests = {}
+
+    # Savings from dedup in the last run, as a dict with the number of
+    # 'duplicates', their 'src_bytes', the estimated conversion
+    # 'seconds' saved, and the destination 'bytes' saved by
+    # hardlinking.
+    self.dedup_savings = None
+
+    self.remember_failures = remember_failures
+    if self.remember_failures and self._state_dir is None:
+      raise ValueError('remember_failures requires a state_dir')
+
+    self.failure_backoff = failure_backoff
+
+    # Map from dst relpath to a dict describing the last failed
+    # conversion, loaded lazily from the state directory.
+    self._failures = None
+
+    # List of dst relpaths that the last generate() didn't convert
+    # because they failed before.
+    self.skipped_failures = []
+
+  def __getstate__(self):
+    state = super(ConvertProfile, self).__getstate__()
+    # These are only used by the generating process. The executor is
+    # usually not picklable, and the rest can be large, and would be
+    # pickled for every job.
+    state['executor'] = None
+    state['_fingerprints'] = None
+    state['_pending_fingerprints'] = {}
+    state['_digests'] = None
+    state['_used_digests'] = {}
+    state['_failures'] = None
+    return state
+
+  def generate(self, time_budget=None, relpaths=None):
+    if relpaths is not None:
+      relpaths = self.scope_relpaths(relpaths)
+
+    if self.convert_group is not None:
+      return self.convert_group.generate(
+        self, time_budget=time_budget, relpaths=relpaths)
+
+    deadline = (
+      None if time_budget is None else time.monotonic() + time_budget)
+
+    scope = None if relpaths == [''] else relpaths
+
+    dst_keep = self.convert(deadline=deadline, relpaths=scope)
+
+    self.clean(dst_keep, relpaths=scope)
+
+    util.fix_dir_stats(self, relpaths=scope, copystat=self.copy_stats)
+
+    return self.map_relpaths(relpaths)
+
+  def scope_relpaths(self, relpaths):
+    """Normalize relative source paths that scope generate().
+
+    Paths within directories that don't exist in the source are
+    replaced by the missing directories, so that their destinations
+    are cleaned.
+    """
+
+    return util.normalize_relpaths(
+      util.truncate_to_existing(self.src_path(), relpath)
+      for relpath in util.normalize_relpaths(relpaths)
+      )
+
+  def map_relpaths(self, relpaths):
+    """Map relative source paths to relative destination paths.
+
+    Returns:
+        A list of the destination paths, or None if relpaths is None.
+    """
+
+    if relpaths is None:
+      return None
+
+    return [self.map_relpath(relpath) for relpath in relpaths]
+
+  def map_relpath(self, src_relpath):
+    """Get the relative destination path for a relative source path.
+
+    Directories, and paths that don't exist, map to the same path.
+    """
+
+    src_path = self.src_path(src_relpath)
+    if not src_relpath or os.path.isdir(src_path) \
+        or not os.path.lexists(src_path):
+      return src_relpath
+
+    dst_relpath = self.select_cb(self, src_relpath)
+    if isinstance(dst_relpath, tuple):
+      dst_relpath = dst_relpath[0]
+    return src_relpath if dst_relpath is None else dst_relpath
+
+  @contextlib.contextmanager
+  def _pool(self):
+    """Get the executor, or a local pool, to run conversions with.
+    """
+
+    if self.executor is not None:
+      yield self.executor
+      return
+
+    with multiprocessing.Pool(
+        processes=self.concurrency.max_jobs,
+        initializer=schedule.init_worker,
+        initargs=(self.nice, self.ionice),
+        ) as pool:
+      yield pool
+
+  def convert(self, deadline=None, relpaths=None):
+    """Convert or symlink files.
+
+    Args:
+        deadline: If not None, the time.monotonic() value at which to
+            stop converting. Conversions that are not done by then
+            are abandoned, and get placeholders instead (see
+            placeholder_cb), until a later call converts them.
+        relpaths: See select_and_symlink().
+
+    Returns:
+        A set of relative destination paths of all converted or
+        symlinked files, and all directories.
+    """
+
+    self.pending = []
+
+    start_time = time.monotonic()
+
+    deduplicator = (
+      None if self.dedup is None else _Deduplicator(self.source_digest))
+
+    # Batches that were not converted in time.
+    late = []
+
+    def remove_tmp_files(batch, result):
+      tmp_paths, errors = result
+      for tmp_path in tmp_paths:
+        try:
+          os.remove(tmp_path)
+        except FileNotFoundError:
+          pass
+
+    with self._pool() as pool:
+      # Jobs only convert to temporary files, which are renamed into
+      # place by this process as the jobs finish, so a job that
+      # finishes too late can't race with its placeholders. Local jobs
+      # are terminated when the with statement exits, but an
+      # executor's jobs can't be, so their temporary files are removed
+      # when they finish.
+      dispatcher = schedule.Dispatcher(
+        pool,
+        self.concurrency,
+        deadline,
+        finished_cb=lambda batch, result: self.finish_batch(
+          batch, result[1], result[0]),
+        abandoned_cb=None if self.executor is None else remove_tmp_files,
+        )
+
+      def submit(batch):
+        if not dispatcher.submit(batch, self.convert_to_tmp, (batch,)):
+          late.append(batch)
+
+      batcher = _Batcher(self.batch_size, self.batch_bytes)
+
+      def convert_cb(src_relpath, dst_relpath):
+        if self.skip_failure(src_relpath, dst_relpath):
+          return
+        size = (
+          0 if self.batch_bytes is None and deduplicator is None
+          else os.stat(self.src_path(src_relpath)).st_size)
+        if deduplicator is not None and deduplicator.add(
+            src_relpath,
+            dst_relpath,
+            size,
+            (
+              json.dumps(
+                self._pending_fingerprints.get(dst_relpath),
+                sort_keys=True,
+                ),
+              os.path.splitext(dst_relpath)[1],
+              ),
+            ):
+          return
+        for batch in batcher.add(src_relpath, dst_relpath, size):
+          submit(batch)
+
+      dst_keep = self.select(convert_cb, relpaths=relpaths)
+
+      for batch in batcher.flush():
+        submit(batch)
+
+      finished, abandoned = dispatcher.finish()
+      late.extend(abandoned)
+
+    # Temporary files of terminated local conversions are removed by
+    # clean().
+    for batch in late:
+      self.make_placeholders(batch)
+
+    if self.pending:
+      self.log(
+        logging.INFO,
+        'Out of time, %d conversions pending',
+        len(self.pending),
+        )
+
+    results = [item for batch, results in finished for item in results]
+
+    self.record_throughput(results, time.monotonic() - start_time)
+
+    if deduplicator is not None:
+      results.extend(self.fill_duplicates(deduplicator.duplicates, results))
+
+    self.check_results(results)
+
+    return dst_keep
+
+  def source_digest(self, src_relpath):
+    """Get the digest of a source file's contents.
+
+    Digests are cached in the state directory (if any), by inode and
+    modification time.
+    """
+
+    if self._digests is None:
+      path = self.state_path('digests.json')
+      self._digests = {} if path is None else util.load_json(path, {})
+
+    src_path = self.src_path(src_relpath)
+    src_stat = os.stat(src_path)
+    key = '%d:%d' % (src_stat.st_dev, src_stat.st_ino)
+    entry = self._digests.get(key)
+    if entry is None or entry[:2] != [
+        src_stat.st_size, src_stat.st_mtime_ns]:
+      entry = [
+        src_stat.st_size,
+        src_stat.st_mtime_ns,
+        util.file_digest(src_path),
+        ]
+      self._digests[key] = entry
+    self._used_digests[key] = entry
+    return entry[2]
+
+  def fill_duplicates(self, duplicates, results):
+    """Fill the destinations of duplicate sources from conversions.
+
+    Args:
+        duplicates: Map from relative destination paths of conversions
+            to lists of (relative source path, relative destination
+            path) tuples of their duplicates.
+        results: Results of the conversions, as returned by
+            convert_batch().
+
+    Returns:
+        A list of results for the duplicates, like convert_batch().
+    """
+
+    primaries = {
+      dst_relpath: (src_relpath, error)
+      for src_relpath, dst_relpath, error in results
+      }
+
+    savings = {
+      'duplicates': 0,
+      'src_bytes': 0,
+      'seconds': 0.0,
+      'bytes': 0,
+      }
+    dup_results = []
+    for primary_dst_relpath, dups in sorted(duplicates.items()):
+      if primary_dst_relpath not in primaries:
+        # The conversion was abandoned, so its duplicates are too.
+        self.make_placeholders(dups)
+        continue
+
+      primary_src_relpath, error = primaries[primary_dst_relpath]
+      primary_dst_path = self.dst_path(primary_dst_relpath)
+      for src_relpath, dst_relpath in dups:
+        if error is None:
+          linked, dup_error = self._fill_duplicate(
+            primary_src_relpath,
+            primary_dst_path,
+            src_relpath,
+            dst_relpath,
             )
-          raise RuntimeError(
-            'Duplicate destination path %r' % dst_relpath)
         else:
-          relpath_dst_to_src[dst_relpath] = src_relpath
+          linked, dup_error = False, error
+        if dup_error is None:
+          self.log(
+            logging.DEBUG,
+            '%s %r from duplicate %r',
+            'Linked' if linked else 'Copied',
+            dst_relpath,
+            primary_dst_relpath,
+            )
+          savings['duplicates'] += 1
+          savings['src_bytes'] += os.stat(self.src_path(src_relpath)).st_size
+          if linked:
+            savings['bytes'] += os.stat(primary_dst_path).st_size
+        dup_results.append((src_relpath, dst_relpath, dup_error))
+
+    self._save_digests()
+
+    bytes_per_second = self.load_stats().get('convert_bytes_per_second')
+    if bytes_per_second:
+      savings['seconds'] = savings['src_bytes'] / bytes_per_second
+    self.dedup_savings = savings
+    if savings['duplicates']:
+      self.log(
+        logging.INFO,
+        'Deduplicated %d conversions, saving about %.1f seconds and %d '
+          'bytes',
+        savings['duplicates'],
+        savings['seconds'],
+        savings['bytes'],
+        )
+
+    return dup_results
+
+  def _fill_duplicate(
+      self,
+      primary_src_relpath,
+      primary_dst_path,
+      src_relpath,
+      dst_relpath,
+      ):
+    """Hardlink or copy one duplicate.
 
-        if not convert:
-          continue
+    Returns:
+        A tuple of (whether it was hardlinked, exception or None).
+    """
 
-        results.append(
-          pool.apply_async(
-            self.convert_one,
-            (src_relpath, dst_relpath),
-            )
+    src_path = self.src_path(src_relpath)
+    tmp_path = self.tmp_dst_path(dst_relpath)
+    linked = False
+    try:
+      if self.dedup == 'hardlink' and util.stats_match(
+          self.src_path(primary_src_relpath), src_path):
+        try:
+          os.link(primary_dst_path, tmp_path)
+          linked = True
+        except OSError as e:
+          if e.errno not in util.FALLBACK_ERRNOS:
+            raise
+      if not linked:
+        util.copy_file_data(primary_dst_path, tmp_path)
+        self.copy_stats(src_path, tmp_path)
+      os.replace(tmp_path, self.dst_path(dst_relpath))
+    except OSError as e:
+      try:
+        os.remove(tmp_path)
+      except FileNotFoundError:
+        pass
+      return False, e
+    return linked, None
+
+  def _save_digests(self):
+    """Save the digests used in this run to the state directory.
+    """
+
+    path = self.state_path('digests.json')
+    if path is not None and self._used_digests:
+      util.save_json(path, self._used_digests)
+    self._digests = None
+    self._used_digests = {}
+
+  def make_placeholders(self, batch):
+    """Make placeholders for conversions that didn't happen in time.
+
+    The placeholder for each file is a symlink to the source, or
+    nothing, depending on placeholder_cb. Either way, the file is
+    converted by a later call to generate().
+
+    Args:
+        batch: List of (relative source path, relative destination
+            path) tuples.
+    """
+
+    for src_relpath, dst_relpath in batch:
+      self.pending.append(dst_relpath)
+      self._pending_fingerprints.pop(dst_relpath, None)
+
+      if self.placeholder_cb is not None \
+          and not self.placeholder_cb(self, src_relpath):
+        continue
+
+      dst_path = self.dst_path(dst_relpath)
+      self.log(logging.DEBUG, 'Linking placeholder %r', dst_relpath)
+      target = os.path.relpath(
+        self.src_path(src_relpath),
+        os.path.dirname(dst_path))
+      os.symlink(target, dst_path)
+      self.record_added(dst_relpath, changelog.SYMLINK, target)
+
+  def select(self, convert_cb, plan=None, relpaths=None):
+    """Select files, and symlink the ones that aren't converted.
+
+    Args:
+        convert_cb: Called with the relative source path and relative
+            destination path of each file that needs conversion.
+        plan, relpaths: See select_and_symlink().
+
+    Returns:
+        A set of relative destination paths of all converted or
+        symlinked files, and all directories.
+    """
+
+    if plan is None:
+      self.skipped_failures = []
+
+    # Map from dst relpath to src relpath.
+    relpath_dst_to_src = {}
+
+    for src_relpath, dst_relpath, convert \
+        in self.select_and_symlink(plan=plan, relpaths=relpaths):
+      if dst_relpath in relpath_dst_to_src:
+        self.log(
+          logging.ERROR,
+          'Found duplicate destination %r from sources %r and %r',
+          dst_relpath,
+          relpath_dst_to_src[dst_relpath],
+          src_relpath,
           )
+        raise RuntimeError(
+          'Duplicate destination path %r' % dst_relpath)
+      else:
+        relpath_dst_to_src[dst_relpath] = src_relpath
 
-      for result in results:
-        result.get()
+      if convert:
+        convert_cb(src_relpath, dst_relpath)
 
     return frozenset(relpath_dst_to_src.keys())
 
+  def check_results(self, results):
+    """Log failed conversions, and raise the first failure, if any.
+
+    Args:
+        results: Iterable of results, as returned by convert_batch().
+    """
+
+    fingerprints = self.fingerprints()
+
+    failures = []
+    for src_relpath, dst_relpath, error in results:
+      fingerprint = self._pending_fingerprints.pop(dst_relpath, None)
+      if error is not None:
+        self.log(
+          logging.ERROR,
+          'Failed to convert %r to %r: %s',
+          src_relpath,
+          dst_relpath,
+          error,
+          )
+        failures.append(error)
+        if self.remember_failures:
+          self._record_failure(src_relpath, dst_relpath, fingerprint, error)
+      else:
+        self.record_added(dst_relpath, changelog.FILE)
+        if fingerprint is not None:
+          fingerprints[dst_relpath] = fingerprint
+        if self.remember_failures:
+          self.load_failures().pop(dst_relpath, None)
+
+    self.save_fingerprints()
+
+    if self.skipped_failures:
+      self.log(
+        logging.WARNING,
+        'Skipped %d files that failed to convert before',
+        len(self.skipped_failures),
+        )
+
+    if self.remember_failures:
+      self.save_failures()
+      if failures:
+        self.log(
+          logging.WARNING,
+          '%d files failed to convert, and are skipped until their '
+            'sources change',
+          len(failures),
+          )
+    elif failures:
+      raise failures[0]
+
+  def load_failures(self):
+    """Get recorded conversion failures.
+
+    Returns:
+        A dict mapping relative destination paths to dicts with the
+        relative source path ('src'), the source's 'size' and
+        'mtime_ns', the 'fingerprint', the 'error', the 'time' of the
+        last failure, and the 'count' of failures in a row.
+    """
+
+    if self._failures is None:
+      path = self.state_path('failures.json')
+      self._failures = {} if path is None else util.load_json(path, {})
+    return self._failures
+
+  def save_failures(self):
+    """Save recorded conversion failures to the state directory.
+    """
+
+    if self._failures is None:
+      return
+
+    path = self.state_path('failures.json')
+    if path is not None:
+      util.save_json(path, self._failures)
+
+  def clear_failures(self, dst_relpaths=None):
+    """Forget conversion failures, so they're retried by generate().
+
+    Args:
+        dst_relpaths: Relative destination paths to forget, or None to
+            forget all failures.
+
+    Returns:
+        The relative destination paths that were forgotten.
+    """
+
+    failures = self.load_failures()
+    if dst_relpaths is None:
+      dst_relpaths = list(failures)
+    cleared = [
+      dst_relpath for dst_relpath in dst_relpaths
+      if failures.pop(dst_relpath, None) is not None
+      ]
+    self.save_failures()
+    return cleared
+
+  def skip_failure(self, src_relpath, dst_relpath):
+    """Check whether to skip converting a file that failed before.
+
+    If the file is skipped, it's added to skipped_failures.
+
+    Returns:
+        True if the conversion should be skipped.
+    """
+
+    if not self.remember_failures:
+      return False
+
+    failure = self.load_failures().get(dst_relpath)
+    if failure is None:
+      return False
+
+    src_stat = os.stat(self.src_path(src_relpath))
+    if [failure['src'], failure['size'], failure['mtime_ns']] \
+        != [src_relpath, src_stat.st_size, src_stat.st_mtime_ns] \
+        or failure['fingerprint'] != util.json_round_trip(
+          self._pending_fingerprints.get(dst_relpath)):
+      return False
+
+    if self.failure_backoff is not None and time.time() >= (
+        failure['time']
+        + self.failure_backoff * 2 ** (failure['count'] - 1)):
+      return False
+
+    self.log(logging.DEBUG, 'Skipping failed %r', dst_relpath)
+    self._pending_fingerprints.pop(dst_relpath, None)
+    self.skipped_failures.append(dst_relpath)
+    return True
+
+  def _record_failure(self, src_relpath, dst_relpath, fingerprint, error):
+    """Record a failed conversion, for skip_failure().
+    """
+
+    failures = self.load_failures()
+    try:
+      src_stat = os.stat(self.src_path(src_relpath))
+    except FileNotFoundError:
+      failures.pop(dst_relpath, None)
+      return
+
+    failure = {
+      'src': src_relpath,
+      'size': src_stat.st_size,
+      'mtime_ns': src_stat.st_mtime_ns,
+      'fingerprint': fingerprint,
+      }
+    previous = failures.get(dst_relpath)
+    if previous is not None and all(
+        previous.get(key) == value for key, value in failure.items()):
+      failure['count'] = previous['count'] + 1
+    else:
+      failure['count'] = 1
+    failure['time'] = time.time()
+    failure['error'] = '%s: %s' % (type(error).__name__, error)
+    failures[dst_relpath] = failure
+
   def convert_one(self, src_relpath, dst_relpath):
     """Convert a single file.
 
     This function must be multi-threading and multi-processing safe.
     """
 
-    src_path = self.src_path(src_relpath)
-    dst_path = self.dst_path(dst_relpath)
+    for src_relpath, dst_relpath, error \
+        in self.convert_batch([(src_relpath, dst_relpath)]):
+      if error is not None:
+        raise error
+
+  def convert_batch(self, batch):
+    """Convert a batch of files.
+
+    This function must be multi-threading and multi-processing safe.
+
+    Args:
+        batch: List of (relative source path, relative destination
+            path) tuples.
+
+    Returns:
+        A list of (relative source path, relative destination path,
+        exception or None) tuples, one for each item in the batch.
+    """
+
+    tmp_paths, errors = self.convert_to_tmp(batch)
+    return self.finish_batch(batch, errors, tmp_paths)
+
+  def convert_to_tmp(self, batch):
+    """Convert a batch of files to temporary paths.
+
+    This function must be multi-threading and multi-processing safe.
+
+    Args:
+        batch: See convert_batch().
+
+    Returns:
+        A tuple of (list of absolute temporary destination paths, one
+        for each item in the batch, map from absolute temporary
+        destination paths to exceptions), to pass to finish_batch().
+    """
+
+    pairs = []
+    for src_relpath, dst_relpath in batch:
+      self.log(
+        logging.DEBUG,
+        'Converting %r to %r',
+        src_relpath,
+        dst_relpath,
+        )
+      pairs.append(
+        (self.src_path(src_relpath), self.tmp_dst_path(dst_relpath)))
+
+    try:
+      errors = self.batch_convert_cb(self, pairs) or {}
+    except Exception as e:
+      errors = {dst_path: e for src_path, dst_path in pairs}
+
+    return [dst_path for src_path, dst_path in pairs], errors
+
+  def finish_batch(self, batch, errors, tmp_paths=None):
+    """Finish converting a batch of files, after the callback is done.
+
+    This function must be multi-threading and multi-processing safe.
+
+    Each file was converted to a temporary path (see tmp_dst_path()),
+    which is renamed to the real destination path only after its stats
+    are copied from the source. So an interrupted conversion never
+    leaves a partial file that looks up to date.
+
+    Args:
+        batch: See convert_batch().
+        errors: Map from absolute temporary destination paths to
+            exceptions, for files that failed to convert.
+        tmp_paths: List of absolute temporary destination paths, one
+            for each item in the batch, if they were chosen by another
+            process. Defaults to tmp_dst_path() of each item.
+
+    Returns:
+        See convert_batch().
+    """
+
+    if tmp_paths is None:
+      tmp_paths = [
+        self.tmp_dst_path(dst_relpath) for src_relpath, dst_relpath in batch]
+
+    results = []
+    for (src_relpath, dst_relpath), tmp_path in zip(batch, tmp_paths):
+      src_path = self.src_path(src_relpath)
+      error = errors.get(tmp_path)
+      if error is None:
+        try:
+          # The temporary file may be a hardlink to the source (see
+          # MaterializeProfile), which already has the right stats.
+          if not os.path.samefile(src_path, tmp_path):
+            self.copy_stats(src_path, tmp_path)
+          os.replace(tmp_path, self.dst_path(dst_relpath))
+        except OSError as e:
+          error = e
+      if error is not None:
+        try:
+          os.remove(tmp_path)
+        except FileNotFoundError:
+          pass
+      results.append((src_relpath, dst_relpath, error))
+
+    return results
+
+  def copy_stats(self, src_path, dst_path):
+    """Copy stats from a source file or directory to its destination.
+
+    This function must be multi-threading and multi-processing safe.
+    """
 
-    self.log(
-      logging.DEBUG,
-      'Converting %r to %r',
-      src_relpath,
-      dst_relpath,
-      )
-    self.convert_cb(self, src_path, dst_path)
     shutil.copystat(src_path, dst_path)
 
-  def select_and_symlink(self):
+  def tmp_dst_path(self, dst_relpath):
+    """Get the temporary path that a file is converted to.
+
+    The temporary file is in the same directory as the destination,
+    and has the same extension, for converters that look at it. If a
+    temporary file is left behind (e.g., by a killed process), clean()
+    removes it.
+    """
+
+    dirname, basename = os.path.split(self.dst_path(dst_relpath))
+    return os.path.join(
+      dirname,
+      '%s%d-%s' % (_TMP_PREFIX, os.getpid(), basename),
+      )
+
+  def fingerprints(self):
+    """Get the map from dst relpath to fingerprint of converted files.
+    """
+
+    if self._fingerprints is None:
+      path = self.state_path('fingerprints.json')
+      self._fingerprints = (
+        {} if path is None else util.load_json(path, {}))
+    return self._fingerprints
+
+  def save_fingerprints(self):
+    """Save fingerprints to the state directory, if there are any.
+    """
+
+    if self._fingerprints is None:
+      return
+
+    path = self.state_path('fingerprints.json')
+    if path is not None:
+      util.save_json(path, self._fingerprints)
+
+  def select_and_symlink(self, plan=None, relpaths=None):
     """Select which files to convert, and handle symlinks.
 
     This function selects wich files to convert, but does not do any
     conversion. It does create all the directories, and creates
     symlinks for files that are not to be converted.
 
+    Args:
+        plan: If not None, a planning.Plan to record the actions in,
+            instead of doing them.
+        relpaths: If not None, a list of normalized relative source
+            paths (see util.normalize_relpaths()). Only those files and
+            directories, recursively, and the directories containing
+            them are selected.
+
     Returns:
         A generator of tuples. The first item in a tuple is the
         relative source path of each file or directory. The second
@@ -386,11 +2081,12 @@ class ConvertProfile(Profile):
         conversion is needed, False otherwise.
     """
 
-    for src_relpath, src_entry \
-        in util.recursive_scandir(
-          self.src_path(),
-          dir_first=True,
-          ):
+    if relpaths is None:
+      src_entries = util.recursive_scandir(self.src_path(), dir_first=True)
+    else:
+      src_entries = self._scoped_scandir(relpaths)
+
+    for src_relpath, src_entry in src_entries:
       if src_entry.is_dir():
         dst_relpath = src_relpath
         dst_path = self.dst_path(dst_relpath)
@@ -398,17 +2094,31 @@ class ConvertProfile(Profile):
         # Get rid of any non-directory where this directory should be.
         if os.path.lexists(dst_path):
           if not os.path.isdir(dst_path) or os.path.islink(dst_path):
-            self.log(logging.DEBUG, 'Removing %r', dst_relpath)
-            os.remove(dst_path)
+            self._remove(dst_relpath, plan)
 
         # Create the directory if needed.
-        self.log(logging.DEBUG, 'Creating directory %r', dst_relpath)
-        os.makedirs(dst_path, exist_ok=True)
+        if plan is None:
+          self.log(logging.DEBUG, 'Creating directory %r', dst_relpath)
+          self.makedirs(dst_relpath)
+        else:
+          if not os.path.isdir(dst_path) or os.path.islink(dst_path):
+            plan.add(planning.MKDIR, dst_relpath)
+          if not util.stats_match(src_entry.path, dst_path):
+            plan.add(planning.COPYSTAT, dst_relpath)
 
         yield src_relpath, dst_relpath, False
         continue
 
       dst_relpath = self.select_cb(self, src_relpath)
+      if isinstance(dst_relpath, tuple):
+        dst_relpath, fingerprint = dst_relpath
+      else:
+        fingerprint = self.fingerprint
+      if fingerprint is not None and self._state_dir is None:
+        raise RuntimeError(
+          'Fingerprints require a state_dir for %s' % self)
+      # Compare it the way it's saved, e.g., with tuples as lists.
+      fingerprint = util.json_round_trip(fingerprint)
 
       if dst_relpath is None:
         # Remove anything already in this profile, and replace it with
@@ -417,22 +2127,26 @@ class ConvertProfile(Profile):
         dst_relpath = src_relpath
         dst_path = self.dst_path(dst_relpath)
         dst_dirpath = os.path.dirname(dst_path)
+        target = os.path.relpath(
+          os.path.abspath(src_entry.path),
+          dst_dirpath)
+
+        if plan is not None \
+            and os.path.islink(dst_path) \
+            and os.readlink(dst_path) == target:
+          # Unchanged, so the plan doesn't need to include it.
+          yield src_relpath, dst_relpath, False
+          continue
 
-        if os.path.isdir(dst_path) \
-            and not os.path.islink(dst_path):
-          self.log(logging.DEBUG, 'Removing %r', dst_relpath)
-          shutil.rmtree(dst_path)
-        elif os.path.lexists(dst_path):
-          self.log(logging.DEBUG, 'Removing %r', dst_relpath)
-          os.remove(dst_path)
+        if os.path.lexists(dst_path):
+          self._remove(dst_relpath, plan)
 
-        self.log(logging.DEBUG, 'Linking %r', dst_relpath)
-        os.symlink(
-          os.path.relpath(
-            os.path.abspath(src_entry.path),
-            dst_dirpath),
-          dst_path,
-          )
+        if plan is None:
+          self.log(logging.DEBUG, 'Linking %r', dst_relpath)
+          os.symlink(target, dst_path)
+          self.record_added(dst_relpath, changelog.SYMLINK, target)
+        else:
+          plan.add(planning.LINK, dst_relpath, target=target)
 
         yield src_relpath, dst_relpath, False
 
@@ -442,29 +2156,96 @@ class ConvertProfile(Profile):
 
         dst_path = self.dst_path(dst_relpath)
 
+        if plan is None:
+          self._pending_fingerprints[dst_relpath] = fingerprint
+          old_fingerprint = self.fingerprints().pop(dst_relpath, None)
+        else:
+          old_fingerprint = self.fingerprints().get(dst_relpath)
+
         if not os.path.lexists(dst_path):
           yield src_relpath, dst_relpath, True
           continue
 
         src_stat = os.stat(src_entry.path)
-        src_mtime = (src_stat.st_mtime, src_stat.st_mtime_ns)
         dst_stat = os.lstat(dst_path)
-        dst_mtime = (dst_stat.st_mtime, dst_stat.st_mtime_ns)
 
-        if stat.S_ISDIR(dst_stat.st_mode):
-          self.log(logging.DEBUG, 'Removing %r', dst_relpath)
-          shutil.rmtree(dst_path)
-          yield src_relpath, dst_relpath, True
-        elif stat.S_ISREG(dst_stat.st_mode) \
-            and src_mtime == dst_mtime:
+        if self.is_up_to_date(src_entry.path, src_stat, dst_path, dst_stat) \
+            and old_fingerprint == fingerprint:
           self.log(logging.DEBUG, 'Up-to-date %r', dst_relpath)
+          if plan is None:
+            del self._pending_fingerprints[dst_relpath]
+            if fingerprint is not None:
+              self.fingerprints()[dst_relpath] = fingerprint
           yield src_relpath, dst_relpath, False
         else:
-          self.log(logging.DEBUG, 'Removing %r', dst_relpath)
-          os.remove(dst_path)
+          self._remove(dst_relpath, plan)
           yield src_relpath, dst_relpath, True
 
-  def clean(self, dst_keep):
+  def is_up_to_date(self, src_path, src_stat, dst_path, dst_stat):
+    """Check whether a converted file is up to date with its source.
+
+    Fingerprints are checked separately.
+
+    Args:
+        src_path: Path of the source.
+        src_stat: os.stat() of the source.
+        dst_path: Path of the converted file.
+        dst_stat: os.lstat() of the converted file.
+    """
+
+    return (
+      stat.S_ISREG(dst_stat.st_mode)
+      and (src_stat.st_mtime, src_stat.st_mtime_ns)
+        == (dst_stat.st_mtime, dst_stat.st_mtime_ns)
+      )
+
+  def _scoped_scandir(self, relpaths):
+    """Like util.recursive_scandir() on the source, limited to relpaths.
+
+    This yields the directories containing each path in relpaths, then
+    the path itself, then its contents. Paths that don't exist are
+    skipped.
+    """
+
+    seen = set()
+    for relpath in relpaths:
+      src_entry = None
+      for src_relpath in util.ancestors(relpath) + [relpath]:
+        src_entry = util.scandir_entry(
+          self.src_path(os.path.dirname(src_relpath)),
+          os.path.basename(src_relpath),
+          )
+        if src_entry is None:
+          break
+        if src_relpath not in seen:
+          seen.add(src_relpath)
+          yield src_relpath, src_entry
+
+      if src_entry is not None and src_entry.is_dir():
+        for src_entry_relpath, src_entry \
+            in util.recursive_scandir(src_entry.path, dir_first=True):
+          yield os.path.join(relpath, src_entry_relpath), src_entry
+
+  def _remove(self, dst_relpath, plan=None):
+    """Remove a file, symlink, or directory tree.
+    """
+
+    dst_path = self.dst_path(dst_relpath)
+
+    if plan is not None:
+      plan.add(planning.REMOVE, dst_relpath)
+      return
+
+    self.log(logging.DEBUG, 'Removing %r', dst_relpath)
+    if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+      if not self.discard(dst_relpath):
+        self.record_removed(dst_relpath)
+        shutil.rmtree(dst_path)
+    else:
+      self.record_removed(dst_relpath)
+      os.remove(dst_path)
+
+  def clean(self, dst_keep, plan=None, relpaths=None):
     """Clean the destination directory.
 
     Delete everything in dst_path(), except for the specified files.
@@ -472,18 +2253,535 @@ class ConvertProfile(Profile):
     Args:
         dst_keep: A set of relative destination paths that should not
             be deleted.
+        plan: If not None, a planning.Plan to record the actions in,
+            instead of doing them.
+        relpaths: If not None, a list of normalized relative source
+            paths. Only the destinations of those paths, recursively,
+            and stale entries in the directories containing them are
+            deleted. dst_keep must be from select() with the same
+            relpaths.
     """
 
-    for dst_relpath, dst_entry \
-        in util.recursive_scandir(self.dst_path(), dir_first=False):
+    # Relative destination paths that were removed.
+    removed = []
+
+    if relpaths is None:
+      dst_entries = util.recursive_scandir(self.dst_path(), dir_first=False)
+    else:
+      dst_entries = []
+      for relpath in relpaths:
+        dst_dir_relpath = os.path.dirname(relpath)
+        if not os.path.isdir(self.dst_path(dst_dir_relpath)):
+          continue
+        expected = self._expected_dst_relpaths(dst_dir_relpath)
+        for dst_entry in os.scandir(self.dst_path(dst_dir_relpath)):
+          dst_relpath = os.path.join(dst_dir_relpath, dst_entry.name)
+          if dst_relpath not in expected and dst_relpath not in dst_keep:
+            self._remove(dst_relpath, plan)
+            removed.append(dst_relpath)
+        dst_path = self.dst_path(relpath)
+        if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+          dst_entries.extend(
+            (os.path.join(relpath, dst_entry_relpath), dst_entry)
+            for dst_entry_relpath, dst_entry
+            in util.recursive_scandir(dst_path, dir_first=False)
+            )
+
+    # Relative destination paths of stale directories that were moved
+    # to the trash, with their contents.
+    discarded = set()
+    if plan is None and self._trash is not None:
+      dst_entries = list(dst_entries)
+      stale_dirs = sorted(
+        dst_relpath for dst_relpath, dst_entry in dst_entries
+        if dst_relpath not in dst_keep
+        and dst_entry.is_dir(follow_symlinks=False)
+        )
+      for dst_relpath in stale_dirs:
+        if not any(
+            ancestor in discarded
+            for ancestor in util.ancestors(dst_relpath)) \
+            and self.discard(dst_relpath):
+          self.log(logging.DEBUG, 'Trashed %r', dst_relpath)
+          discarded.add(dst_relpath)
+          removed.append(dst_relpath)
+    discarded_prefixes = tuple(
+      dst_relpath + os.sep for dst_relpath in discarded)
+
+    for dst_relpath, dst_entry in dst_entries:
+      if discarded and (
+          dst_relpath in discarded
+          or dst_relpath.startswith(discarded_prefixes)):
+        continue
       if dst_relpath not in dst_keep:
+        is_dir = (
+          os.path.isdir(dst_entry.path)
+          and not os.path.islink(dst_entry.path))
+        removed.append(dst_relpath)
+        if plan is not None:
+          plan.add(
+            planning.RMDIR if is_dir else planning.REMOVE,
+            dst_relpath,
+            )
+          continue
         self.log(logging.DEBUG, 'Removing %r', dst_entry.path)
-        if os.path.isdir(dst_entry.path) \
-            and not os.path.islink(dst_entry.path):
+        self.record_removed(dst_relpath)
+        if is_dir:
           os.rmdir(dst_entry.path)
         else:
           os.remove(dst_entry.path)
 
+    if plan is not None:
+      return
+
+    fingerprints = self.fingerprints()
+    if relpaths is None:
+      stale = [
+        dst_relpath for dst_relpath in fingerprints
+        if dst_relpath not in dst_keep
+        ]
+    else:
+      removed_prefixes = tuple(
+        dst_relpath + os.sep for dst_relpath in removed)
+      stale = [
+        dst_relpath for dst_relpath in fingerprints
+        if dst_relpath not in dst_keep and (
+          dst_relpath in removed or dst_relpath.startswith(removed_prefixes))
+        ]
+    for dst_relpath in stale:
+      del fingerprints[dst_relpath]
+    self.save_fingerprints()
+
+    if self.remember_failures:
+      failures = self.load_failures()
+      for dst_relpath in [
+          dst_relpath for dst_relpath in failures
+          if dst_relpath not in dst_keep and (
+            relpaths is None or dst_relpath in removed
+            or dst_relpath.startswith(removed_prefixes))
+          ]:
+        del failures[dst_relpath]
+      self.save_failures()
+
+  def _expected_dst_relpaths(self, src_dir_relpath):
+    """Get the relative destination paths of a source directory's entries.
+    """
+
+    return {
+      src_entry_relpath if src_entry.is_dir()
+      else self.map_relpath(src_entry_relpath)
+      for src_entry, src_entry_relpath in (
+        (src_entry, os.path.join(src_dir_relpath, src_entry.name))
+        for src_entry in os.scandir(self.src_path(src_dir_relpath))
+        )
+      }
+
+  def plan(self):
+    plan = planning.Plan(
+      self,
+      bytes_per_second=self.load_stats().get('convert_bytes_per_second'),
+      )
+
+    def convert_cb(src_relpath, dst_relpath):
+      plan.add(
+        self.plan_action,
+        dst_relpath,
+        src=src_relpath,
+        size=os.stat(self.src_path(src_relpath)).st_size,
+        )
+
+    dst_keep = self.select(convert_cb, plan=plan)
+
+    self.clean(dst_keep, plan=plan)
+
+    return plan
+
+  def load_stats(self):
+    """Load statistics about previous runs from the state directory.
+    """
+
+    path = self.state_path('stats.json')
+    return {} if path is None else util.load_json(path, {})
+
+  def record_throughput(self, results, seconds):
+    """Record the conversion throughput of a run, for planning.
+
+    Args:
+        results: Results of the run's conversions, as returned by
+            convert_batch().
+        seconds: Wall time of the run.
+    """
+
+    path = self.state_path('stats.json')
+    if path is None or seconds <= 0:
+      return
+
+    convert_bytes = sum(
+      os.stat(self.src_path(src_relpath)).st_size
+      for src_relpath, dst_relpath, error in results
+      if error is None
+      )
+    if convert_bytes <= 0:
+      return
+
+    stats = self.load_stats()
+    measured = convert_bytes / seconds
+    previous = stats.get('convert_bytes_per_second')
+    stats['convert_bytes_per_second'] = (
+      measured if previous is None else (previous + measured) / 2)
+    util.save_json(path, stats)
+
+
+class ConvertGroup():
+  """Group of sibling ConvertProfiles that share conversion jobs.
+
+  Each member of the group selects files, symlinks, checks whether
+  converted files are up to date, and cleans its own destination
+  directory, just like any other ConvertProfile. However, the
+  conversions for all members are done together, with one job per
+  source file, so that each source is read (and decoded) only once.
+
+  Calling generate() on any member generates all members. Within the
+  same generate_all() call, generate() on each other member is then a
+  no-op, so generate_all() on the parent generates the group once.
+
+  Jobs are run with the members' concurrency, nice, ionice, and
+  executor, which must be the same for all members. The per-member
+  convert_cb and batch_convert_cb are used only with decode_cb.
+  Batching is not supported, and neither are time budgets.
+  """
+
+  def __init__(
+      self,
+      multi_convert_cb=None,
+      decode_cb=None,
+      intermediate_suffix='',
+      tmp_dir=None,
+      ):
+    """
+    Args:
+        multi_convert_cb: Callback to convert a single source file to
+            multiple destinations. Its arguments (in order) are the
+            source filename, and a list of (profile, destination
+            filename) tuples. It may return a dict mapping destination
+            filenames that failed to convert to the exceptions
+            describing the failures, or raise an exception if all
+            destinations failed. This callback must be
+            multi-threading and multi-processing safe.
+        decode_cb: Alternative to multi_convert_cb. Its arguments (in
+            order) are the source filename, and the filename of an
+            intermediate file to write. The intermediate file is then
+            passed to each member's convert_cb (or batch_convert_cb)
+            in place of the source. This callback must be
+            multi-threading and multi-processing safe.
+        intermediate_suffix: Suffix of intermediate filenames, e.g.,
+            '.wav', for converters that look at the filename.
+        tmp_dir: Directory for intermediate files, or None to use the
+            default temporary directory.
+    """
+
+    if (multi_convert_cb is None) == (decode_cb is None):
+      raise ValueError(
+        'Exactly one of multi_convert_cb and decode_cb is required')
+
+    self.multi_convert_cb = multi_convert_cb
+    self.decode_cb = decode_cb
+    self.intermediate_suffix = intermediate_suffix
+    self.tmp_dir = tmp_dir
+
+    self._members = []
+
+    # Tuple of the generate_all() token of the last run (see
+    # Profile._run), and a map from indexes of members that were
+    # generated as part of another member's generate() in that run, to
+    # what their generate() returns.
+    self._generated = (None, {})
+
+  def add(self, profile):
+    """Add a member.
+    """
+
+    if self._members and profile._parent is not self._members[0]._parent:
+      raise ValueError(
+        '%s is not a sibling of %s' % (profile, self._members[0]))
+
+    self._members.append(profile)
+
+  def generate(self, profile, time_budget=None, relpaths=None):
+    """Generate all members, unless it was already done in this run.
+
+    Args:
+        profile: The member whose generate() was called.
+        time_budget: Must be None.
+        relpaths: Normalized relative source paths, or None. See
+            ConvertProfile.generate().
+
+    Returns:
+        What profile's generate() returns.
+    """
+
+    index = self._members.index(profile)
+    run, generated = self._generated
+    if profile._run is not None and profile._run is run \
+        and index in generated:
+      return generated.pop(index)
+
+    if time_budget is not None:
+      raise ValueError('ConvertGroup does not support time budgets')
+    settings = self._settings(self._members[0])
+    for member in self._members[1:]:
+      if self._settings(member) != settings:
+        raise ValueError(
+          '%s and %s are in the same ConvertGroup, but have different '
+          'concurrency, nice, ionice, or executor' % (
+            self._members[0], member))
+
+    scope = None if relpaths == [''] else relpaths
+
+    # Map from src relpath to list of (member index, dst relpath).
+    jobs = {}
+    dst_keeps = []
+    for member_index, member in enumerate(self._members):
+      def convert_cb(src_relpath, dst_relpath):
+        if not member.skip_failure(src_relpath, dst_relpath):
+          jobs.setdefault(src_relpath, []).append(
+            (member_index, dst_relpath))
+      dst_keeps.append(member.select(convert_cb, relpaths=scope))
+
+    with self._members[0]._pool() as pool:
+      dispatcher = schedule.Dispatcher(pool, self._members[0].concurrency)
+      for src_relpath, outputs in jobs.items():
+        dispatcher.submit(
+          src_relpath, self.convert_source, (src_relpath, outputs))
+      finished, abandoned = dispatcher.finish()
+
+    # List of results for each member.
+    member_results = [[] for member in self._members]
+    for src_relpath, results in finished:
+      for member_index, item in results:
+        member_results[member_index].append(item)
+
+    for member, results in zip(self._members, member_results):
+      member.check_results(results)
+
+    for member, dst_keep in zip(self._members, dst_keeps):
+      member.clean(dst_keep, relpaths=scope)
+      util.fix_dir_stats(member, relpaths=scope, copystat=member.copy_stats)
+
+    self._generated = (
+      profile._run,
+      {
+        member_index: member.map_relpaths(relpaths)
+        for member_index, member in enumerate(self._members)
+        if member_index != index
+        },
+      )
+
+    return profile.map_relpaths(relpaths)
+
+  def _settings(self, member):
+    """Get what a member's jobs would be run with, for comparison.
+    """
+
+    concurrency = member.concurrency
+    if isinstance(concurrency, schedule.FixedConcurrency):
+      concurrency = concurrency.max_jobs
+    return concurrency, member.nice, member.ionice, member.executor
+
+  def convert_source(self, src_relpath, outputs):
+    """Convert a single source file for multiple members.
+
+    This function must be multi-threading and multi-processing safe.
+
+    Args:
+        src_relpath: Relative source path.
+        outputs: List of (member index, relative destination path).
+
+    Returns:
+        A list of (member index, result) tuples, where each result is
+        as returned by ConvertProfile.convert_batch().
+    """
+
+    src_path = self._members[0].src_path(src_relpath)
+    dst_paths = [
+      (self._members[member_index], self._members[member_index]
+        .tmp_dst_path(dst_relpath))
+      for member_index, dst_relpath in outputs
+      ]
+
+    for member, dst_path in dst_paths:
+      member.log(
+        logging.DEBUG,
+        'Converting %r to %r',
+        src_relpath,
+        dst_path,
+        )
+
+    if self.multi_convert_cb is not None:
+      try:
+        errors = self.multi_convert_cb(src_path, dst_paths) or {}
+      except Exception as e:
+        errors = {dst_path: e for member, dst_path in dst_paths}
+    else:
+      errors = self._decode_and_convert(src_path, dst_paths)
+
+    return [
+      (
+        member_index,
+        self._members[member_index].finish_batch(
+          [(src_relpath, dst_relpath)],
+          errors,
+          )[0],
+        )
+      for member_index, dst_relpath in outputs
+      ]
+
+  def _decode_and_convert(self, src_path, dst_paths):
+    """Decode to an intermediate file, and convert it for each member.
+
+    Returns:
+        A dict mapping destination paths to exceptions.
+    """
+
+    errors = {}
+
+    with tempfile.TemporaryDirectory(dir=self.tmp_dir) as tmp:
+      intermediate = os.path.join(
+        tmp,
+        'intermediate' + self.intermediate_suffix,
+        )
+
+      try:
+        self.decode_cb(src_path, intermediate)
+      except Exception as e:
+        return {dst_path: e for member, dst_path in dst_paths}
+
+      for member, dst_path in dst_paths:
+        try:
+          member_errors = member.batch_convert_cb(
+            member,
+            [(intermediate, dst_path)],
+            ) or {}
+        except Exception as e:
+          member_errors = {dst_path: e}
+        errors.update(member_errors)
+
+    return errors
+
+
+class PerFileConverter():
+  """Adapter from a per-file convert_cb to a batch_convert_cb.
+  """
+
+  def __init__(self, convert_cb):
+    self.convert_cb = convert_cb
+
+  def __call__(self, profile, pairs):
+    errors = {}
+    for src_path, dst_path in pairs:
+      try:
+        self.convert_cb(profile, src_path, dst_path)
+      except Exception as e:
+        errors[dst_path] = e
+    return errors
+
+
+class _Batcher():
+  """Group conversions into batches, by destination directory.
+  """
+
+  def __init__(self, max_files, max_bytes):
+    self._max_files = max_files
+    self._max_bytes = max_bytes
+
+    # Map from destination directory to ([(src relpath, dst relpath)],
+    # total bytes).
+    self._pending = {}
+
+  def add(self, src_relpath, dst_relpath, size):
+    """Add a file.
+
+    Returns:
+        A list of batches that are ready.
+    """
+
+    dirname = os.path.dirname(dst_relpath)
+    batch, total = self._pending.get(dirname, ([], 0))
+
+    ready = []
+    if batch and self._max_bytes is not None \
+        and total + size > self._max_bytes:
+      ready.append(batch)
+      batch, total = [], 0
+
+    batch.append((src_relpath, dst_relpath))
+    total += size
+
+    if len(batch) >= self._max_files:
+      ready.append(batch)
+      self._pending.pop(dirname, None)
+    else:
+      self._pending[dirname] = (batch, total)
+
+    return ready
+
+  def flush(self):
+    """Get all remaining batches.
+    """
+
+    ready = [batch for batch, total in self._pending.values()]
+    self._pending.clear()
+    return ready
+
+
+class _Deduplicator():
+  """Find conversions of identical sources.
+
+  Sources are compared by size, and then by digest (see
+  ConvertProfile.source_digest()). Digests are only computed for
+  sources whose size matches another source's.
+  """
+
+  def __init__(self, digest_cb):
+    self._digest_cb = digest_cb
+
+    # Map from (size, key) to a list of [src relpath, dst relpath,
+    # digest or None] for conversions that aren't duplicates.
+    self._primaries = {}
+
+    # Map from dst relpath of a conversion to a list of (src relpath,
+    # dst relpath) of its duplicates.
+    self.duplicates = {}
+
+  def add(self, src_relpath, dst_relpath, size, key):
+    """Add a conversion.
+
+    Args:
+        src_relpath, dst_relpath, size: The conversion.
+        key: Anything hashable that must also match for conversions to
+            be duplicates.
+
+    Returns:
+        True if it duplicates an earlier conversion.
+    """
+
+    primaries = self._primaries.setdefault((size, key), [])
+    if not primaries:
+      primaries.append([src_relpath, dst_relpath, None])
+      return False
+
+    digest = self._digest_cb(src_relpath)
+    for primary in primaries:
+      if primary[2] is None:
+        primary[2] = self._digest_cb(primary[0])
+      if primary[2] == digest:
+        self.duplicates.setdefault(primary[1], []).append(
+          (src_relpath, dst_relpath))
+        return True
+
+    primaries.append([src_relpath, dst_relpath, digest])
+    return False
+
 
 class SanitizeFilenameProfile(FilterProfile):
   """Profile to sanitize filenames.
@@ -563,20 +2861,193 @@ class SanitizeFilenameProfile(FilterProfile):
     'LPT9',
     ]}
 
+  # Version of the format of names.json, and of the sanitizing rules in
+  # _sanitize_name(). Bump it when either changes, so old indexes are
+  # dropped.
+  _names_version = 1
+
   def __init__(self, **kwargs):
     super(SanitizeFilenameProfile, self).__init__(
       select_cb=self._sanitize_cb,
       **kwargs,
       )
 
+    # Map from relative source directory path to (relative destination
+    # directory path, {source name: sanitized name}), loaded lazily
+    # from the state directory. Entries are replaced whenever their
+    # directory is filtered.
+    self._names = None
+
+    # Map from relative destination directory path to (relative source
+    # directory path, {casefolded sanitized name: source name}), built
+    # lazily from _names.
+    self._reverse_names = None
+
+    # Relative source directory paths filtered in the current run.
+    self._visited = set()
+
+    self._names_lock = threading.Lock()
+
+  def __getstate__(self):
+    state = super(SanitizeFilenameProfile, self).__getstate__()
+    # The name index is only used by the generating process, and locks
+    # aren't picklable.
+    state['_names'] = None
+    state['_reverse_names'] = None
+    state['_visited'] = set()
+    state['_names_lock'] = None
+    return state
+
+  def generate(self, time_budget=None, relpaths=None):
+    self._visited = set()
+
+    result = super(SanitizeFilenameProfile, self).generate(
+      time_budget=time_budget,
+      relpaths=relpaths,
+      )
+
+    # Forget directories that no longer exist.
+    if relpaths is None:
+      prefixes = ['']
+    else:
+      prefixes = util.normalize_relpaths(relpaths)
+    with self._names_lock:
+      for src_dir_relpath in list(self._load_names()):
+        if src_dir_relpath not in self._visited and any(
+            util.is_within(src_dir_relpath, prefix) for prefix in prefixes):
+          self._forget_dir(src_dir_relpath)
+
+    path = self.state_path('names.json')
+    if path is not None:
+      util.save_json(path, {
+        'version': self._names_version,
+        'settings': self._sanitize_settings(),
+        'names': {
+          src_dir_relpath: [dst_dir_relpath, names]
+          for src_dir_relpath, (dst_dir_relpath, names)
+          in self._names.items()
+          },
+        })
+
+    return result
+
+  def _sanitize_settings(self):
+    """Get the settings that sanitized names depend on, as JSON data.
+    """
+
+    return util.json_round_trip({
+      'forbidden_chars': sorted(self._forbidden_chars_map.items()),
+      'reserved_names': sorted(self._reserved_names),
+      })
+
+  def src_to_dst(self, src_relpath):
+    """Get the sanitized path of a source path, from the last run.
+
+    Returns:
+        The relative destination path, or None if src_relpath was not
+        seen by the last run that included it.
+    """
+
+    if not src_relpath:
+      return ''
+
+    src_dir_relpath, name = os.path.split(src_relpath)
+    with self._names_lock:
+      entry = self._load_names().get(src_dir_relpath)
+    if entry is None or name not in entry[1]:
+      return None
+    return os.path.join(entry[0], entry[1][name])
+
+  def dst_to_src(self, dst_relpath):
+    """Get the source path of a sanitized path, from the last run.
+
+    Returns:
+        The relative source path, or None if dst_relpath is not the
+        sanitized path of anything seen by the last run that included
+        it.
+    """
+
+    if not dst_relpath:
+      return ''
+
+    dst_dir_relpath, name = os.path.split(dst_relpath)
+    with self._names_lock:
+      entry = self._load_reverse_names().get(dst_dir_relpath)
+      if entry is None:
+        return None
+      src_dir_relpath, casefolded_names = entry
+      src_name = casefolded_names.get(name.casefold())
+      if src_name is None \
+          or self._names[src_dir_relpath][1][src_name] != name:
+        return None
+    return os.path.join(src_dir_relpath, src_name)
+
+  def _load_names(self):
+    """Get _names, loading it if needed. Requires _names_lock.
+    """
+
+    if self._names is None:
+      path = self.state_path('names.json')
+      data = {} if path is None else util.load_json(path, {})
+      if data.get('version') != self._names_version \
+          or data.get('settings') != self._sanitize_settings():
+        if data:
+          self.log(
+            logging.INFO,
+            'Sanitizing rules changed, dropping the name index',
+            )
+        data = {'names': {}}
+      self._names = {
+        src_dir_relpath: (dst_dir_relpath, names)
+        for src_dir_relpath, (dst_dir_relpath, names)
+        in data['names'].items()
+        }
+    return self._names
+
+  def _load_reverse_names(self):
+    """Get _reverse_names, building it if needed. Requires _names_lock.
+    """
+
+    if self._reverse_names is None:
+      self._reverse_names = {
+        dst_dir_relpath: (
+          src_dir_relpath,
+          {
+            sanitized_name.casefold(): name
+            for name, sanitized_name in names.items()
+            },
+          )
+        for src_dir_relpath, (dst_dir_relpath, names)
+        in self._load_names().items()
+        }
+    return self._reverse_names
+
+  def _forget_dir(self, src_dir_relpath):
+    """Remove a directory from the index. Requires _names_lock.
+    """
+
+    dst_dir_relpath, names = self._names.pop(src_dir_relpath)
+    if self._reverse_names is not None:
+      self._reverse_names.pop(dst_dir_relpath, None)
+
   def _sanitize_cb(self, profile, src_relpath, dst_relpath, contents):
     """select_cb for parent FilterProfile.
+
+    Names in the index from previous runs are reused, so only new
+    entries are sanitized. The casefolded names used to find
+    duplicates become the directory's reverse index.
     """
 
+    with self._names_lock:
+      old_names = self._load_names().get(src_relpath, (None, {}))[1]
+
+    names = {}
+    casefolded_names = {}
     keep = []
-    casefolded_names = set()
     for entry in contents:
-      sanitized_name = self._sanitize_name(entry.name)
+      sanitized_name = old_names.get(entry.name)
+      if sanitized_name is None:
+        sanitized_name = self._sanitize_name(entry.name)
       sanitized_relpath = os.path.join(dst_relpath, sanitized_name)
 
       # Casefold when looking for duplicates, because some filesystems
@@ -588,10 +3059,20 @@ class SanitizeFilenameProfile(FilterProfile):
             sanitized_relpath,
             )
           )
-      casefolded_names.add(casefolded_name)
+      casefolded_names[casefolded_name] = entry.name
+      names[entry.name] = sanitized_name
 
       keep.append((entry, sanitized_relpath))
 
+    with self._names_lock:
+      self._load_names()
+      if src_relpath in self._names:
+        self._forget_dir(src_relpath)
+      self._names[src_relpath] = (dst_relpath, names)
+      if self._reverse_names is not None:
+        self._reverse_names[dst_relpath] = (src_relpath, casefolded_names)
+      self._visited.add(src_relpath)
+
     return keep
 
   def _sanitize_name(self, filename):
@@ -613,3 +3094,468 @@ class SanitizeFilenameProfile(FilterProfile):
       sanitized = sanitized[:-1] + '_'
 
     return sanitized
+
+
+class UnionProfile(Profile):
+  """Profile that merges the trees of several parents.
+
+  Every directory in any parent is a directory in this profile, and
+  every file is a symlink to the file in the parent that takes
+  precedence. The entries of each directory are found with a single
+  merge of the parents' (and this profile's) sorted listings, and only
+  entries that differ are changed, so an update is one pass over the
+  parents, without rebuilding anything.
+
+  This profile is a child of every parent, so generate_all() on any of
+  them updates it (from all of the parents). When several parents are
+  generated by the same generate_all() call (e.g., on a common
+  ancestor), this profile is generated once, after all of them.
+  Methods that use a single parent, like src_path(), use the first.
+  """
+
+  _trash_files = False
+
+  def __init__(self, parents, conflict_cb=None, **kwargs):
+    """
+    Args:
+        parents: List of parent profiles, in order of precedence.
+        conflict_cb: Callback to choose between parents that have the
+            same path, when they're not all directories. Its arguments
+            (in order) are the profile, the relative path, and a list
+            of (parent index, os.DirEntry) tuples for the parents that
+            have the path, in order. It returns the parent index of
+            the one to use. If that's a directory, it's merged with
+            the other parents' directories at the same path; anything
+            else is symlinked. Defaults to the first of them.
+        kwargs: See Profile, except for parent.
+    """
+
+    if not parents:
+      raise ValueError('UnionProfile needs at least one parent')
+
+    super(UnionProfile, self).__init__(parent=parents[0], **kwargs)
+
+    for parent in parents[1:]:
+      parent._children.append(self)
+
+    self._parents = list(parents)
+
+    self.conflict_cb = conflict_cb
+
+  def _all_parents(self):
+    return self._parents
+
+  def parent_path(self, index, relpath=''):
+    """Like src_path(), for any parent.
+
+    Args:
+        index: Index of the parent.
+        relpath: Path, relative to the parent's _top_dir.
+    """
+
+    return os.path.abspath(
+      os.path.join(self._parents[index]._top_dir, relpath))
+
+  def generate(self, time_budget=None, relpaths=None):
+    if relpaths is None:
+      self._merge_dir('')
+      return None
+
+    relpaths = util.normalize_relpaths(relpaths)
+    for relpath in relpaths:
+      # Directories missing from this profile are merged as a whole.
+      relpath = util.truncate_to_existing(self.dst_path(), relpath)
+      if not relpath:
+        self._merge_dir('')
+        continue
+      dirname, name = os.path.split(relpath)
+      candidates = []
+      for index in range(len(self._parents)):
+        entry = util.scandir_entry(self.parent_path(index, dirname), name)
+        if entry is not None:
+          candidates.append((index, entry))
+      self._merge_entry(
+        relpath,
+        candidates,
+        util.scandir_entry(self.dst_path(dirname), name),
+        )
+      for ancestor in reversed(util.ancestors(relpath)):
+        self._copy_dir_stats(ancestor)
+
+    return relpaths
+
+  def plan(self):
+    plan = planning.Plan(self)
+    self._merge_dir('', plan)
+    return plan
+
+  def _listing(self, path, order):
+    """Get a directory's sorted entries, for merging.
+
+    Returns:
+        A list of (name, order, os.DirEntry) tuples, or an empty list
+        if path is not a directory.
+    """
+
+    try:
+      return sorted(
+        (entry.name, order, entry) for entry in os.scandir(path))
+    except (FileNotFoundError, NotADirectoryError):
+      return []
+
+  def _merge_dir(self, relpath, plan=None):
+    """Merge a directory that exists (or is planned) here, recursively.
+    """
+
+    # This profile's listing sorts after the parents' for each name.
+    dst_order = len(self._parents)
+    merged = heapq.merge(
+      *[
+        self._listing(self.parent_path(index, relpath), index)
+        for index in range(len(self._parents))
+        ] + [self._listing(self.dst_path(relpath), dst_order)])
+
+    for name, group in itertools.groupby(merged, key=lambda item: item[0]):
+      candidates = []
+      dst_entry = None
+      for entry_name, order, entry in group:
+        if order == dst_order:
+          dst_entry = entry
+        else:
+          candidates.append((order, entry))
+      self._merge_entry(
+        os.path.join(relpath, name), candidates, dst_entry, plan)
+
+    self._copy_dir_stats(relpath, plan)
+
+  def _merge_entry(self, relpath, candidates, dst_entry, plan=None):
+    """Update a single path, recursively.
+
+    Args:
+        relpath: The path.
+        candidates: List of (parent index, os.DirEntry) tuples for the
+            parents that have the path.
+        dst_entry: os.DirEntry of the path in this profile, or None.
+        plan: If not None, a planning.Plan to record the actions in,
+            instead of doing them.
+    """
+
+    dst_path = self.dst_path(relpath)
+
+    if not candidates:
+      if dst_entry is not None:
+        self._remove(relpath, plan)
+      return
+
+    if all(entry.is_dir() for index, entry in candidates):
+      index = candidates[0][0]
+      is_dir = True
+    else:
+      index = (
+        candidates[0][0] if self.conflict_cb is None
+        else self.conflict_cb(self, relpath, candidates))
+      is_dir = dict(candidates)[index].is_dir()
+
+    if is_dir:
+      if dst_entry is not None and (
+          dst_entry.is_symlink() or not dst_entry.is_dir()):
+        self._remove(relpath, plan)
+        dst_entry = None
+      if dst_entry is None:
+        if plan is None:
+          self.log(logging.DEBUG, 'Creating directory %r', relpath)
+          os.mkdir(dst_path)
+          self.record_added(relpath, changelog.DIR)
+        else:
+          plan.add(planning.MKDIR, relpath)
+      self._merge_dir(relpath, plan)
+      return
+
+    target = os.path.relpath(
+      self.parent_path(index, relpath),
+      os.path.dirname(dst_path),
+      )
+    if dst_entry is not None:
+      if dst_entry.is_symlink() and os.readlink(dst_path) == target:
+        return
+      self._remove(relpath, plan)
+
+    if plan is None:
+      self.log(logging.DEBUG, 'Linking %r -> %r', relpath, target)
+      os.symlink(target, dst_path)
+      self.record_added(relpath, changelog.SYMLINK, target)
+    else:
+      plan.add(planning.LINK, relpath, target=target)
+
+  def _remove(self, relpath, plan=None):
+    """Remove a symlink or directory tree of symlinks.
+    """
+
+    dst_path = self.dst_path(relpath)
+
+    if os.path.islink(dst_path) or not os.path.isdir(dst_path):
+      if not os.path.islink(dst_path):
+        raise RuntimeError('Cannot clean %r' % relpath)
+      if plan is None:
+        self.log(logging.DEBUG, 'Deleting symlink %r', relpath)
+        self.record_removed(relpath)
+        os.remove(dst_path)
+      else:
+        plan.add(planning.REMOVE, relpath)
+      return
+
+    if plan is None and self.discard(relpath):
+      self.log(logging.DEBUG, 'Trashed directory %r', relpath)
+      return
+
+    for entry_relpath, entry in util.recursive_scandir(
+        dst_path, dir_first=False):
+      if not entry.is_symlink() and not entry.is_dir():
+        raise RuntimeError(
+          'Cannot clean %r' % os.path.join(relpath, entry_relpath))
+
+    if plan is None:
+      self.log(logging.DEBUG, 'Deleting directory %r', relpath)
+      self.record_removed(relpath)
+      shutil.rmtree(dst_path)
+    else:
+      plan.add(planning.REMOVE, relpath)
+
+  def _copy_dir_stats(self, relpath, plan=None):
+    """Copy a directory's stats from the first parent that has it.
+    """
+
+    if not relpath:
+      return
+
+    for index in range(len(self._parents)):
+      src_path = self.parent_path(index, relpath)
+      if os.path.isdir(src_path):
+        break
+    else:
+      return
+
+    dst_path = self.dst_path(relpath)
+    if util.stats_match(src_path, dst_path):
+      return
+    if plan is None:
+      shutil.copystat(src_path, dst_path)
+    else:
+      plan.add(planning.COPYSTAT, relpath)
+
+
+class MaterializeProfile(ConvertProfile):
+  """Profile with real files instead of symlinks.
+
+  Every directory and file in the parent is mirrored as a real
+  directory or file, following symlinks. This is useful for exporting
+  a profile to something that doesn't handle symlinks, e.g., a device
+  image or an rsync target.
+
+  Each file is materialized as a hardlink to the parent's file if
+  possible, otherwise as a reflink (a copy-on-write clone, on e.g.
+  btrfs or XFS), and otherwise as a copy made in the kernel where
+  possible. A file is materialized again only if its size or
+  modification time changed, so exporting after a few changes is
+  cheap.
+
+  Hardlinked files share their contents and stats with the source, so
+  they must not be modified in place.
+  """
+
+  plan_action = planning.COPY
+
+  def __init__(self, link_mode='auto', **kwargs):
+    """
+    Args:
+        link_mode: 'auto' to use the first of hardlinking, reflinking,
+            and copying that works; 'reflink' to reflink or copy, so
+            that files never share an inode with the source; or 'copy'
+            to always copy.
+        kwargs: See ConvertProfile, except for select_cb, convert_cb,
+            and batch_convert_cb.
+    """
+
+    if link_mode not in _Materializer.METHODS:
+      raise ValueError('Unknown link_mode %r' % link_mode)
+    self.link_mode = link_mode
+
+    super(MaterializeProfile, self).__init__(
+      select_cb=_materialize_select_cb,
+      batch_convert_cb=_Materializer(link_mode),
+      **kwargs,
+      )
+
+  def is_up_to_date(self, src_path, src_stat, dst_path, dst_stat):
+    if not super(MaterializeProfile, self).is_up_to_date(
+        src_path, src_stat, dst_path, dst_stat):
+      return False
+
+    if src_stat.st_size != dst_stat.st_size:
+      return False
+
+    if self.link_mode != 'auto' \
+        and (src_stat.st_dev, src_stat.st_ino) \
+          == (dst_stat.st_dev, dst_stat.st_ino):
+      # Hardlinked by a previous run with link_mode='auto'.
+      return False
+
+    return True
+
+
+def _materialize_select_cb(profile, src_relpath):
+  return src_relpath
+
+
+class _Materializer():
+  """batch_convert_cb for MaterializeProfile.
+  """
+
+  # Map from link mode to the methods to try, in order.
+  METHODS = {
+    'auto': ('hardlink', 'reflink', 'copy'),
+    'reflink': ('reflink', 'copy'),
+    'copy': ('copy',),
+    }
+
+  def __init__(self, link_mode):
+    self.methods = _Materializer.METHODS[link_mode]
+
+    # Methods that turned out to be unsupported. This is pickled with
+    # every job, so it only lasts for a batch.
+    self._unsupported = set()
+
+  def __call__(self, profile, pairs):
+    errors = {}
+    for src_path, dst_path in pairs:
+      try:
+        self.materialize(src_path, dst_path)
+      except OSError as e:
+        errors[dst_path] = e
+    return errors
+
+  def materialize(self, src_path, dst_path):
+    """Materialize a single file.
+
+    Returns:
+        The method that was used.
+    """
+
+    for method in self.methods:
+      if method in self._unsupported:
+        continue
+      try:
+        if method == 'hardlink':
+          os.link(os.path.realpath(src_path), dst_path)
+        elif method == 'reflink':
+          util.reflink(src_path, dst_path)
+        else:
+          util.copy_file_data(src_path, dst_path)
+        return method
+      except OSError as e:
+        if method == self.methods[-1]:
+          raise
+        if e.errno in util.UNSUPPORTED_ERRNOS:
+          self._unsupported.add(method)
+        try:
+          os.remove(dst_path)
+        except FileNotFoundError:
+          pass
+
+
+class SyncProfile(MaterializeProfile):
+  """Profile that mirrors its parent onto a device or another directory.
+
+  This is a MaterializeProfile that copies by default, and is more
+  lenient about what counts as up to date, for filesystems like FAT:
+
+   * Modification times may differ by up to mtime_tolerance.
+   * With checksum, a file whose size is the same but modification
+     time differs is compared by contents, and if they match, only
+     its modification time is updated instead of copying it again.
+   * If permissions can't be copied, only times are.
+
+  Each file is copied to a temporary name and renamed into place, so an
+  interrupted sync resumes with the files that weren't finished, and
+  the temporary file of an interrupted copy is removed. Pass relpaths
+  to generate() (or generate_all()) to sync only what changed, e.g., a
+  new album, without scanning the whole device.
+  """
+
+  def __init__(
+      self,
+      link_mode='copy',
+      mtime_tolerance=0.0,
+      checksum=False,
+      **kwargs):
+    """
+    Args:
+        link_mode: See MaterializeProfile.
+        mtime_tolerance: Maximum difference in seconds between the
+            modification times of a source and an up-to-date
+            destination, e.g., 2.0 for FAT filesystems.
+        checksum: Whether to compare contents of files whose size is
+            the same but modification time differs.
+        kwargs: See MaterializeProfile.
+    """
+
+    super(SyncProfile, self).__init__(link_mode=link_mode, **kwargs)
+
+    self.mtime_tolerance = mtime_tolerance
+
+    self.checksum = checksum
+
+    # List of (src path, dst path) of files with the same contents,
+    # whose stats need updating.
+    self._touch = []
+
+  def generate(self, time_budget=None, relpaths=None):
+    self._touch = []
+
+    dst_relpaths = super(SyncProfile, self).generate(
+      time_budget=time_budget,
+      relpaths=relpaths,
+      )
+
+    for src_path, dst_path in self._touch:
+      self.log(logging.DEBUG, 'Updating stats of %r', dst_path)
+      self.copy_stats(src_path, dst_path)
+    self._touch = []
+
+    return dst_relpaths
+
+  def plan(self):
+    plan = super(SyncProfile, self).plan()
+    for src_path, dst_path in self._touch:
+      plan.add(
+        planning.COPYSTAT,
+        os.path.relpath(dst_path, self.dst_path()),
+        )
+    self._touch = []
+    return plan
+
+  def is_up_to_date(self, src_path, src_stat, dst_path, dst_stat):
+    if not stat.S_ISREG(dst_stat.st_mode) \
+        or src_stat.st_size != dst_stat.st_size:
+      return False
+
+    if abs(src_stat.st_mtime_ns - dst_stat.st_mtime_ns) \
+        <= self.mtime_tolerance * 1e9:
+      return True
+
+    if self.checksum \
+        and util.file_digest(src_path) == util.file_digest(dst_path):
+      self._touch.append((src_path, dst_path))
+      return True
+
+    return False
+
+  def copy_stats(self, src_path, dst_path):
+    try:
+      shutil.copystat(src_path, dst_path)
+    except OSError as e:
+      if e.errno not in util.FALLBACK_ERRNOS:
+        raise
+      # E.g., FAT doesn't support permissions.
+      src_stat = os.stat(src_path)
+      os.utime(dst_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
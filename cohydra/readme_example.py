@@ -0,0 +1,68 @@
+"""The select_cb example from the README, by hand and as rules.
+
+These are shared by the tests and the benchmarks, to check that the two
+agree and to compare their speed.
+"""
+
+import mimetypes
+
+from . import rules
+
+
+def select_cb(profile, src_relpath, dst_relpath, contents):
+  """The select_cb from the README, without logging.
+  """
+
+  keep = []
+  images = []
+
+  for entry in contents:
+    if entry.is_dir():
+      keep.append(entry)
+      continue
+
+    mime, encoding = mimetypes.guess_type(entry.path, strict=False)
+    if mime is None:
+      keep.append(entry)
+      continue
+
+    mime_major, __discard, __discard = mime.partition('/')
+
+    if mime_major in ('audio',):
+      keep.append(entry)
+    elif mime_major in ('application', 'text', 'video'):
+      continue
+    elif mime_major in ('image',):
+      images.append(entry)
+    else:
+      keep.append(entry)
+
+  for prefix in ('front', 'cover', 'cd', 'back', None):
+    for suffix in ('png', 'tif', 'jpg', 'gif', None):
+      for image in images:
+        if prefix is not None and suffix is not None:
+          if image.name == prefix + '.' + suffix:
+            return keep + [image]
+        elif prefix is not None:
+          if image.name.startswith(prefix + '.'):
+            return keep + [image]
+        elif suffix is not None:
+          if image.name.endswith('.' + suffix):
+            return keep + [image]
+        else:
+          return keep + [image]
+
+  return keep
+
+
+select_rules = rules.FilterRules(
+  [
+    rules.Rule(rules.KEEP, mime_majors=['audio']),
+    rules.Rule(rules.SKIP, mime_majors=['application', 'text', 'video']),
+    rules.Rule(rules.CANDIDATE, mime_majors=['image']),
+    ],
+  preference=rules.Preference(
+    prefixes=['front', 'cover', 'cd', 'back'],
+    suffixes=['png', 'tif', 'jpg', 'gif'],
+    ),
+  )
@@ -0,0 +1,416 @@
+"""Declarative, precompiled selection rules.
+
+The classes in this module can be used as select_cb for FilterProfile
+(FilterRules) and ConvertProfile (ConvertRules), instead of
+hand-written callbacks that call mimetypes.guess_type() on every file.
+All of the name-based conditions of all rules are compiled once, into
+a table keyed by extension and a single combined regex for globs, so
+that evaluating the rules for a file is usually a single dict lookup.
+"""
+
+import mimetypes
+import os
+import re
+
+
+# Actions for FilterRules.
+KEEP = 'keep'
+SKIP = 'skip'
+CANDIDATE = 'candidate'
+
+
+def _glob_to_regex(glob):
+  """Translate an fnmatch-style pattern to a regex, without groups.
+
+  Unlike fnmatch.translate(), the result has no groups or inline flags
+  (which vary between python versions), so it can be embedded in a
+  larger regex.
+  """
+
+  parts = []
+  i = 0
+  n = len(glob)
+  while i < n:
+    c = glob[i]
+    i += 1
+    if c == '*':
+      parts.append('.*')
+    elif c == '?':
+      parts.append('.')
+    elif c == '[':
+      j = i
+      if j < n and glob[j] == '!':
+        j += 1
+      if j < n and glob[j] == ']':
+        j += 1
+      while j < n and glob[j] != ']':
+        j += 1
+      if j >= n:
+        parts.append('\\[')
+      else:
+        chars = glob[i:j].replace('\\', '\\\\')
+        i = j + 1
+        if chars.startswith('!'):
+          chars = '^' + chars[1:]
+        elif chars.startswith('^'):
+          chars = '\\' + chars
+        parts.append('[%s]' % chars)
+    else:
+      parts.append(re.escape(c))
+  return ''.join(parts) + '\\Z'
+
+
+def _extension(name):
+  """Get the extension of a filename, e.g., 'flac'.
+
+  This is equivalent to os.path.splitext(name)[1][1:], but faster.
+  """
+
+  index = name.rfind('.')
+  if index <= 0 or not name[:index].lstrip('.'):
+    return ''
+  return name[index + 1:]
+
+
+class _MimeMajorTable():
+  """Memoized map from extension to the major part of its mime type.
+  """
+
+  def __init__(self):
+    mimetypes.init()
+    self._table = {}
+
+  def __getitem__(self, extension):
+    try:
+      return self._table[extension]
+    except KeyError:
+      pass
+
+    if extension:
+      mime, encoding = mimetypes.guess_type(
+        'x.' + extension, strict=False)
+    else:
+      mime = None
+    major = None if mime is None else mime.partition('/')[0]
+    self._table[extension] = major
+    return major
+
+
+_mime_majors = _MimeMajorTable()
+
+
+class Rule():
+  """A single rule.
+
+  A rule matches a file if all of its conditions are met. Conditions
+  that are None are ignored, so a rule with no conditions matches
+  everything.
+  """
+
+  def __init__(
+      self,
+      action,
+      extensions=None,
+      globs=None,
+      mime_majors=None,
+      min_size=None,
+      max_size=None,
+      min_depth=None,
+      max_depth=None,
+      ):
+    """
+    Args:
+        action: What to do with a matching file. The meaning depends
+            on whether the rule is used by FilterRules or
+            ConvertRules.
+        extensions: Iterable of extensions (without the leading '.'),
+            compared case-insensitively.
+        globs: Iterable of fnmatch-style patterns, matched against
+            the filename (not the full relative path).
+        mime_majors: Iterable of major mime types, e.g., 'audio', as
+            guessed from the extension.
+        min_size, max_size: Inclusive bounds on the file size, in
+            bytes. Using either of these requires a stat() of the
+            file, but only when all other conditions match.
+        min_depth, max_depth: Inclusive bounds on the number of
+            directories between the top of the profile and the file.
+            Files at the top level have depth 0.
+    """
+
+    self.action = action
+    self.extensions = (
+      None if extensions is None
+      else frozenset(e.lower() for e in extensions))
+    self.globs = None if globs is None else tuple(globs)
+    self.mime_majors = (
+      None if mime_majors is None else frozenset(mime_majors))
+    self.min_size = min_size
+    self.max_size = max_size
+    self.min_depth = min_depth
+    self.max_depth = max_depth
+
+  def __repr__(self):
+    return '%s.%s(%r)' % (
+      self.__class__.__module__,
+      self.__class__.__name__,
+      self.action,
+      )
+
+  def matches_extension(self, extension):
+    """Check the extension and mime type conditions.
+    """
+
+    if self.extensions is not None and extension not in self.extensions:
+      return False
+
+    if self.mime_majors is not None \
+        and _mime_majors[extension] not in self.mime_majors:
+      return False
+
+    return True
+
+  def is_unconditional(self):
+    """Whether the extension-based conditions are the only ones.
+    """
+
+    return (
+      self.globs is None and
+      self.min_size is None and
+      self.max_size is None and
+      self.min_depth is None and
+      self.max_depth is None
+      )
+
+
+class _CompiledRules():
+  """A list of rules, compiled for fast first-match evaluation.
+  """
+
+  def __init__(self, rules, default):
+    self._rules = tuple(rules)
+    self._default = default
+
+    # Regex for each rule with globs, by index, and a single regex
+    # that matches if any glob of any rule matches. Each rule gets its
+    # own named group, so the combined match tells which rule's globs
+    # matched first.
+    self._glob_regexes = {}
+    glob_patterns = []
+    for index, rule in enumerate(self._rules):
+      if rule.globs is None:
+        continue
+      pattern = '|'.join(_glob_to_regex(glob) for glob in rule.globs)
+      self._glob_regexes[index] = re.compile(pattern, re.DOTALL)
+      glob_patterns.append('(?P<r%d>%s)' % (index, pattern))
+    self._glob_regex = (
+      re.compile('|'.join(glob_patterns), re.DOTALL)
+      if glob_patterns else None)
+
+    # Map from extension (not case-folded) to either ('action',
+    # action) if the extension alone determines the action, or
+    # ('rules', rules) with the candidate rules to check in order.
+    self._table = {}
+
+  def _candidates(self, extension):
+    try:
+      return self._table[extension]
+    except KeyError:
+      pass
+
+    candidates = self._compute_candidates(extension.lower())
+    self._table[extension] = candidates
+    return candidates
+
+  def _compute_candidates(self, extension):
+    rules = []
+    for index, rule in enumerate(self._rules):
+      if not rule.matches_extension(extension):
+        continue
+      if rule.is_unconditional():
+        if not rules:
+          return ('action', rule.action)
+        rules.append((index, rule))
+        break
+      rules.append((index, rule))
+
+    return ('rules', tuple(rules))
+
+  def evaluate(self, name, depth, stat_cb):
+    """Get the action for a file.
+
+    Args:
+        name: The filename.
+        depth: The depth of the file, see Rule.
+        stat_cb: Callable that returns an os.stat_result for the file.
+            It is called at most once, and only if needed.
+
+    Returns:
+        The action of the first matching rule, or the default action.
+    """
+
+    kind, value = self._candidates(_extension(name))
+    if kind == 'action':
+      return value
+
+    glob_match = None
+    stat_result = None
+    for index, rule in value:
+      if rule.globs is not None:
+        if glob_match is None:
+          glob_match = self._glob_regex.match(name) or False
+        if not glob_match:
+          # No glob of any rule matches.
+          continue
+        first_index = int(glob_match.lastgroup[1:])
+        if first_index > index:
+          # Alternatives are tried in order, so this rule's globs did
+          # not match.
+          continue
+        if first_index < index \
+            and not self._glob_regexes[index].match(name):
+          continue
+      if rule.min_depth is not None and depth < rule.min_depth:
+        continue
+      if rule.max_depth is not None and depth > rule.max_depth:
+        continue
+      if rule.min_size is not None or rule.max_size is not None:
+        if stat_result is None:
+          stat_result = stat_cb()
+        if rule.min_size is not None \
+            and stat_result.st_size < rule.min_size:
+          continue
+        if rule.max_size is not None \
+            and stat_result.st_size > rule.max_size:
+          continue
+      return rule.action
+
+    return self._default
+
+
+class Preference():
+  """Preference order for picking one file out of several candidates.
+
+  The order is the same as in the example in the README: first,
+  filenames with a preferred prefix and a preferred suffix, then with
+  just a preferred prefix, then with just a preferred suffix, and
+  finally anything else. Ties are broken by the order of the
+  candidates.
+  """
+
+  def __init__(self, prefixes=(), suffixes=()):
+    """
+    Args:
+        prefixes: Preferred parts of the filename before the first
+            '.', most preferred first.
+        suffixes: Preferred parts of the filename after the last '.',
+            most preferred first.
+    """
+
+    self._prefixes = {p: i for i, p in reversed(list(enumerate(prefixes)))}
+    self._suffixes = {s: i for i, s in reversed(list(enumerate(suffixes)))}
+
+  def rank(self, name):
+    """Get a sort key for a filename; lower is more preferred.
+    """
+
+    no_prefix = len(self._prefixes)
+    no_suffix = len(self._suffixes)
+
+    head, dot, rest = name.partition('.')
+    prefix_rank = self._prefixes.get(head, no_prefix) if dot else no_prefix
+    if prefix_rank != no_prefix:
+      return (prefix_rank, self._suffixes.get(rest, no_suffix))
+
+    tail = name.rpartition('.')[2]
+    suffix_rank = self._suffixes.get(tail, no_suffix) if dot else no_suffix
+    return (no_prefix, suffix_rank)
+
+  def pick(self, entries):
+    """Pick the most preferred entry, or None if there are none.
+    """
+
+    best = None
+    best_rank = None
+    for entry in entries:
+      rank = self.rank(entry.name)
+      if best_rank is None or rank < best_rank:
+        best = entry
+        best_rank = rank
+    return best
+
+
+def _depth(relpath):
+  return 0 if not relpath else relpath.count(os.sep) + 1
+
+
+class FilterRules():
+  """select_cb for FilterProfile, built from rules.
+
+  Directories are always kept. For each file, the action of the first
+  matching rule is used: KEEP keeps the file, SKIP ignores it, and
+  CANDIDATE makes it a candidate for a single file that is kept per
+  directory, chosen with the preference.
+  """
+
+  def __init__(self, rules, default=KEEP, preference=None):
+    """
+    Args:
+        rules: List of Rule objects.
+        default: Action for files that don't match any rule.
+        preference: Preference used to pick from CANDIDATE files, or
+            None to pick the first one.
+    """
+
+    self._rules = _CompiledRules(rules, default)
+    self._preference = (
+      Preference() if preference is None else preference)
+
+  def __call__(self, profile, src_relpath, dst_relpath, contents):
+    depth = _depth(src_relpath)
+    keep = []
+    candidates = []
+
+    for entry in contents:
+      if entry.is_dir():
+        keep.append(entry)
+        continue
+
+      action = self._rules.evaluate(entry.name, depth, entry.stat)
+      if action == KEEP:
+        keep.append(entry)
+      elif action == CANDIDATE:
+        candidates.append(entry)
+      elif action != SKIP:
+        raise ValueError('Unknown action %r' % (action,))
+
+    if candidates:
+      keep.append(self._preference.pick(candidates))
+
+    return keep
+
+
+class ConvertRules():
+  """select_cb for ConvertProfile, built from rules.
+
+  The action of a rule is either None, meaning the file is symlinked,
+  or a suffix to append to the relative source filename to get the
+  relative destination filename, e.g., '.ogg'.
+  """
+
+  def __init__(self, rules, default=None):
+    """
+    Args:
+        rules: List of Rule objects.
+        default: Action for files that don't match any rule.
+    """
+
+    self._rules = _CompiledRules(rules, default)
+
+  def __call__(self, profile, src_relpath):
+    dirname, name = os.path.split(src_relpath)
+    suffix = self._rules.evaluate(
+      name,
+      _depth(dirname),
+      lambda: os.stat(profile.src_path(src_relpath)),
+      )
+    return None if suffix is None else src_relpath + suffix
@@ -0,0 +1,353 @@
+"""Scheduling of conversion jobs.
+"""
+
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+
+def read_cpu_times(path='/proc/stat'):
+  """Read aggregate CPU times.
+
+  Returns:
+      A tuple of (iowait time, total time), in arbitrary units, or
+      None if they are not available.
+  """
+
+  try:
+    with open(path, 'r') as f:
+      fields = f.readline().split()
+  except OSError:
+    return None
+
+  if not fields or fields[0] != 'cpu' or len(fields) < 6:
+    return None
+
+  times = [int(x) for x in fields[1:]]
+  return times[4], sum(times)
+
+
+def read_load_average():
+  """Get the 1-minute load average, or None if it is not available.
+  """
+
+  try:
+    return os.getloadavg()[0]
+  except OSError:
+    return None
+
+
+class FixedConcurrency():
+  """A fixed number of concurrent jobs.
+  """
+
+  def __init__(self, jobs=None):
+    """
+    Args:
+        jobs: Number of concurrent jobs, defaulting to the number of
+            CPUs.
+    """
+
+    self.max_jobs = (os.cpu_count() or 1) if jobs is None else jobs
+
+  @property
+  def limit(self):
+    return self.max_jobs
+
+  def job_done(self):
+    pass
+
+
+class AdaptiveConcurrency():
+  """Number of concurrent jobs that adapts to the system's load.
+
+  Every interval, this compares the throughput of jobs (completions
+  per second) with the previous interval, and checks the load average
+  and the fraction of CPU time spent waiting for I/O. It then moves
+  the limit up or down by one job:
+
+   * down, if the load average or I/O wait is too high;
+   * otherwise, in the same direction as the last move if that
+     improved throughput, or in the opposite direction if it didn't.
+  """
+
+  def __init__(
+      self,
+      min_jobs=1,
+      max_jobs=None,
+      max_load=None,
+      max_iowait=0.5,
+      interval=10.0,
+      clock=time.monotonic,
+      read_load_average=read_load_average,
+      read_cpu_times=read_cpu_times,
+      ):
+    """
+    Args:
+        min_jobs: Minimum number of concurrent jobs.
+        max_jobs: Maximum number of concurrent jobs, defaulting to the
+            number of CPUs.
+        max_load: Load average above which the limit is reduced,
+            defaulting to the number of CPUs.
+        max_iowait: Fraction of CPU time spent in I/O wait, above
+            which the limit is reduced.
+        interval: Seconds between adjustments.
+        clock, read_load_average, read_cpu_times: For testing.
+    """
+
+    cpus = os.cpu_count() or 1
+
+    self.min_jobs = min_jobs
+    self.max_jobs = cpus if max_jobs is None else max_jobs
+    self.max_load = cpus if max_load is None else max_load
+    self.max_iowait = max_iowait
+    self.interval = interval
+
+    self._clock = clock
+    self._read_load_average = read_load_average
+    self._read_cpu_times = read_cpu_times
+
+    self._limit = max(self.min_jobs, min(self.max_jobs, cpus))
+    self._direction = 1
+
+    self._interval_start = self._clock()
+    self._interval_jobs = 0
+    self._cpu_times = self._read_cpu_times()
+    self._last_throughput = None
+
+  @property
+  def limit(self):
+    now = self._clock()
+    if now - self._interval_start >= self.interval:
+      self._adjust(now)
+    return self._limit
+
+  def job_done(self):
+    self._interval_jobs += 1
+
+  def _adjust(self, now):
+    throughput = self._interval_jobs / (now - self._interval_start)
+
+    iowait = None
+    cpu_times = self._read_cpu_times()
+    if cpu_times is not None and self._cpu_times is not None:
+      total = cpu_times[1] - self._cpu_times[1]
+      if total > 0:
+        iowait = (cpu_times[0] - self._cpu_times[0]) / total
+    self._cpu_times = cpu_times
+
+    load = self._read_load_average()
+
+    if (load is not None and load > self.max_load) \
+        or (iowait is not None and iowait > self.max_iowait):
+      self._direction = -1
+    elif self._last_throughput is not None \
+        and throughput < self._last_throughput:
+      self._direction = -self._direction
+
+    limit = max(
+      self.min_jobs,
+      min(self.max_jobs, self._limit + self._direction))
+    if limit != self._limit:
+      logging.debug(
+        'Concurrency %d -> %d (throughput %.3g/s, load %r, iowait %r)',
+        self._limit,
+        limit,
+        throughput,
+        load,
+        iowait,
+        )
+    self._limit = limit
+
+    self._last_throughput = throughput
+    self._interval_start = now
+    self._interval_jobs = 0
+
+
+def init_worker(nice=None, ionice=None):
+  """Set the priority of a worker process.
+
+  Args:
+      nice: Increment for the process's niceness, or None.
+      ionice: Tuple of (class, level) for ionice(1), e.g., (2, 7) for
+          the lowest best-effort priority, or (3, None) for idle. None
+          to leave the I/O priority unchanged.
+  """
+
+  if nice is not None:
+    os.nice(nice)
+
+  if ionice is not None:
+    ionice_path = shutil.which('ionice')
+    if ionice_path is None:
+      logging.warning('ionice is not available')
+      return
+    io_class, io_level = ionice
+    args = [ionice_path, '-c', str(io_class)]
+    if io_level is not None:
+      args += ['-n', str(io_level)]
+    args += ['-p', str(os.getpid())]
+    subprocess.run(
+      args,
+      stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL,
+      check=False,
+      )
+
+
+class Dispatcher():
+  """Submit jobs to a pool, limiting concurrency and time.
+  """
+
+  def __init__(
+      self,
+      pool,
+      concurrency,
+      deadline=None,
+      finished_cb=None,
+      abandoned_cb=None,
+      ):
+    """
+    Args:
+        pool: multiprocessing.Pool-like object with apply_async().
+        concurrency: FixedConcurrency or AdaptiveConcurrency.
+        deadline: time.monotonic() value after which no new jobs are
+            started and running jobs are abandoned, or None.
+        finished_cb: If not None, called with the key and result of
+            each job that finishes in time, from the thread that calls
+            submit() and finish(). Its return value replaces the
+            job's result.
+        abandoned_cb: If not None, called with the key and result of
+            each abandoned job that still finishes successfully, e.g.,
+            to clean up after it. It's called from a thread of the
+            pool, possibly after finish() returns.
+    """
+
+    self._pool = pool
+    self._concurrency = concurrency
+    self._deadline = deadline
+    self._finished_cb = finished_cb
+    self._abandoned_cb = abandoned_cb
+
+    # Map from job token to (key, AsyncResult) for running jobs.
+    self._running = {}
+    self._next_token = 0
+
+    # Tokens of jobs that finished, put by pool callbacks.
+    self._done = queue.Queue()
+
+    # List of (key, result) for finished jobs.
+    self._finished = []
+
+    # Protects _abandoned, and makes finish() atomic with respect to
+    # pool callbacks.
+    self._lock = threading.Lock()
+
+    # Map from job token to key for abandoned jobs.
+    self._abandoned = {}
+
+  def _job_done(self, token, ok, result):
+    """Pool callback for a finished job.
+    """
+
+    with self._lock:
+      if token not in self._abandoned:
+        self._done.put(token)
+        return
+      key = self._abandoned.pop(token)
+
+    if ok and self._abandoned_cb is not None:
+      self._abandoned_cb(key, result)
+
+  def _remaining(self):
+    if self._deadline is None:
+      return None
+    return max(0.0, self._deadline - time.monotonic())
+
+  def _collect(self, timeout):
+    """Wait up to timeout (None for forever) for a job to finish.
+
+    Returns:
+        True if a job finished.
+    """
+
+    try:
+      token = self._done.get(timeout=timeout)
+    except queue.Empty:
+      return False
+
+    key, result = self._running.pop(token)
+    value = result.get()
+    if self._finished_cb is not None:
+      value = self._finished_cb(key, value)
+    self._finished.append((key, value))
+    self._concurrency.job_done()
+    return True
+
+  def submit(self, key, func, args):
+    """Submit a job, after waiting for a free slot.
+
+    Args:
+        key: Anything, returned with the job's result.
+        func, args: The job.
+
+    Returns:
+        False if the deadline passed before the job could be started,
+        True otherwise.
+    """
+
+    while len(self._running) >= self._concurrency.limit:
+      remaining = self._remaining()
+      if remaining == 0.0:
+        return False
+      # Wake up periodically, in case the limit changes.
+      timeout = 1.0 if remaining is None else min(1.0, remaining)
+      self._collect(timeout)
+
+    if self._remaining() == 0.0:
+      return False
+
+    token = self._next_token
+    self._next_token += 1
+    self._running[token] = (
+      key,
+      self._pool.apply_async(
+        func,
+        args,
+        callback=lambda result: self._job_done(token, True, result),
+        error_callback=lambda error: self._job_done(token, False, error),
+        ),
+      )
+    return True
+
+  def finish(self):
+    """Wait for all jobs, or until the deadline.
+
+    Returns:
+        A tuple of (list of (key, result) for finished jobs, list of
+        keys of abandoned jobs).
+    """
+
+    while self._running:
+      remaining = self._remaining()
+      if remaining == 0.0:
+        break
+      self._collect(remaining)
+
+    # Without the lock, a job could finish after the last check, but
+    # before it's abandoned, and its result would be lost.
+    with self._lock:
+      while self._collect(0):
+        pass
+
+      abandoned = []
+      for token, (key, result) in self._running.items():
+        self._abandoned[token] = key
+        abandoned.append(key)
+      self._running.clear()
+
+    return self._finished, abandoned
@@ -0,0 +1,417 @@
+"""Serve a ConvertProfile over HTTP, converting files on demand.
+
+Some profiles are needed for only a small part of the collection at a
+time, e.g., a low bitrate profile for streaming to a car. Instead of
+generating the whole profile, a LazyConverter maps requests for paths
+in the profile's namespace to its sources, and converts a file only
+when it's requested. Directory listings come from select_cb, without
+converting anything. Converted files are kept in a cache directory
+that is limited in size, and the least recently used ones are deleted
+first. Concurrent requests for the same file share one conversion.
+
+The profile's parent must already be generated, and the profile itself
+isn't generated or written to. Files that select_cb doesn't convert
+are served from the source.
+
+Run:
+
+  python -m cohydra DEFINITION serve --profile NAME --cache-dir DIR
+"""
+
+import collections
+import hashlib
+import html
+import http.server
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import shutil
+import socketserver
+import threading
+import urllib.parse
+
+
+# Prefix of conversions in progress in the cache directory.
+_TMP_PREFIX = '.tmp-'
+
+
+# An entry in a directory of the profile's namespace. src_relpath is
+# the relative source path, convert is true for files that select_cb
+# converts, and fingerprint is the conversion's fingerprint.
+_Entry = collections.namedtuple(
+  '_Entry',
+  ('src_relpath', 'is_dir', 'convert', 'fingerprint'),
+  )
+
+
+class _Conversion():
+  """A conversion in progress, that other requests can wait for.
+  """
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.error = None
+
+
+class LazyConverter():
+  """Converts a ConvertProfile's files on demand, with an LRU cache.
+
+  All methods are multi-threading safe. Only one LazyConverter may use
+  a cache directory at a time.
+  """
+
+  def __init__(self, profile, cache_dir, max_bytes, concurrency=None):
+    """
+    Args:
+        profile: The ConvertProfile to serve. It must not be in a
+            ConvertGroup.
+        cache_dir: Directory to keep converted files in. It's created
+            if needed.
+        max_bytes: Size limit of the cache. The most recently used
+            file is kept even if it's larger.
+        concurrency: Maximum number of conversions at once. Defaults
+            to the number of CPUs.
+    """
+
+    if profile.convert_group is not None:
+      raise ValueError('Cannot serve %s, which is in a ConvertGroup' % profile)
+
+    self.profile = profile
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+
+    self._semaphore = threading.BoundedSemaphore(
+      concurrency or os.cpu_count() or 1)
+
+    # Protects everything below.
+    self._lock = threading.Lock()
+
+    # Map from relative source directory paths to tuples of their
+    # st_mtime_ns and a dict of their entries, by name.
+    self._listings = {}
+
+    # Map from cache names to _Conversion.
+    self._conversions = {}
+
+    # Map from cache names to sizes, least recently used first.
+    self._cache = collections.OrderedDict()
+    self._cache_bytes = 0
+
+    os.makedirs(self.cache_dir, exist_ok=True)
+    self._load_cache()
+
+  def _load_cache(self):
+    """Index the cache directory, and remove interrupted conversions.
+    """
+
+    entries = []
+    for entry in os.scandir(self.cache_dir):
+      if entry.name.startswith(_TMP_PREFIX):
+        os.remove(entry.path)
+        continue
+      entry_stat = entry.stat()
+      entries.append((entry_stat.st_mtime_ns, entry.name, entry_stat.st_size))
+
+    with self._lock:
+      for mtime_ns, name, size in sorted(entries):
+        self._cache[name] = size
+        self._cache_bytes += size
+      self._evict()
+
+  def _evict(self):
+    """Remove least recently used files until the cache fits.
+
+    The caller must hold _lock.
+    """
+
+    while self._cache_bytes > self.max_bytes and len(self._cache) > 1:
+      name, size = self._cache.popitem(last=False)
+      self._cache_bytes -= size
+      self.profile.log(logging.DEBUG, 'Evicting %r from the cache', name)
+      try:
+        os.remove(os.path.join(self.cache_dir, name))
+      except FileNotFoundError:
+        pass
+
+  def _listing(self, src_dir_relpath):
+    """Get the entries of a directory, by name.
+    """
+
+    src_dir_path = self.profile.src_path(src_dir_relpath)
+    mtime_ns = os.stat(src_dir_path).st_mtime_ns
+    with self._lock:
+      listing = self._listings.get(src_dir_relpath)
+    if listing is not None and listing[0] == mtime_ns:
+      return listing[1]
+
+    entries = {}
+    for src_entry in os.scandir(src_dir_path):
+      src_relpath = os.path.join(src_dir_relpath, src_entry.name)
+      if src_entry.is_dir():
+        entries[src_entry.name] = _Entry(src_relpath, True, False, None)
+        continue
+
+      dst_relpath = self.profile.select_cb(self.profile, src_relpath)
+      if isinstance(dst_relpath, tuple):
+        dst_relpath, fingerprint = dst_relpath
+      else:
+        fingerprint = self.profile.fingerprint
+
+      if dst_relpath is None:
+        entries[src_entry.name] = _Entry(src_relpath, False, False, None)
+      elif os.path.dirname(dst_relpath) != src_dir_relpath:
+        self.profile.log(
+          logging.WARNING,
+          'Not serving %r, which is converted to another directory',
+          src_relpath,
+          )
+      else:
+        entries[os.path.basename(dst_relpath)] = _Entry(
+          src_relpath, False, True, fingerprint)
+
+    with self._lock:
+      self._listings[src_dir_relpath] = (mtime_ns, entries)
+    return entries
+
+  def _resolve(self, relpath):
+    """Get the _Entry of a relative path in the profile's namespace.
+
+    Raises:
+        FileNotFoundError: The path isn't in the namespace.
+        NotADirectoryError: A parent of the path is a file.
+    """
+
+    entry = _Entry('', True, False, None)
+    for name in relpath.split(os.sep) if relpath else []:
+      if not entry.is_dir:
+        raise NotADirectoryError(relpath)
+      entry = self._listing(entry.src_relpath).get(name)
+      if entry is None:
+        raise FileNotFoundError(relpath)
+    return entry
+
+  def isdir(self, relpath):
+    """Check whether a relative path is a directory.
+
+    Raises:
+        See _resolve().
+    """
+
+    return self._resolve(relpath).is_dir
+
+  def listdir(self, relpath):
+    """List a directory, without converting anything.
+
+    Returns:
+        A sorted list of (name, whether it's a directory) tuples.
+
+    Raises:
+        See _resolve().
+    """
+
+    entry = self._resolve(relpath)
+    if not entry.is_dir:
+      raise NotADirectoryError(relpath)
+    return sorted(
+      (name, child.is_dir)
+      for name, child in self._listing(entry.src_relpath).items()
+      )
+
+  def open(self, relpath):
+    """Open a file, converting it first if it's not in the cache.
+
+    Returns:
+        A binary file object, which the caller must close.
+
+    Raises:
+        IsADirectoryError: The path is a directory.
+        See also _resolve(), and any exception from the conversion.
+    """
+
+    entry = self._resolve(relpath)
+    if entry.is_dir:
+      raise IsADirectoryError(relpath)
+
+    src_path = self.profile.src_path(entry.src_relpath)
+    if not entry.convert:
+      return open(src_path, 'rb')
+
+    src_stat = os.stat(src_path)
+    name = hashlib.sha256(json.dumps(
+      [
+        entry.src_relpath,
+        src_stat.st_size,
+        src_stat.st_mtime_ns,
+        entry.fingerprint,
+        ],
+      sort_keys=True,
+      ).encode('utf-8', 'surrogateescape')).hexdigest() \
+      + os.path.splitext(relpath)[1]
+    path = os.path.join(self.cache_dir, name)
+
+    while True:
+      with self._lock:
+        if name in self._cache:
+          self._cache.move_to_end(name)
+          f = open(path, 'rb')
+          # The modification time orders the cache after a restart.
+          os.utime(path)
+          self._evict()
+          return f
+      self._convert(name, src_path)
+
+  def _convert(self, name, src_path):
+    """Convert a file into the cache, or wait for another conversion.
+    """
+
+    with self._lock:
+      conversion = self._conversions.get(name)
+      if conversion is None:
+        conversion = self._conversions[name] = _Conversion()
+        owner = True
+      else:
+        owner = False
+
+    if not owner:
+      conversion.done.wait()
+      if conversion.error is not None:
+        raise conversion.error
+      return
+
+    try:
+      with self._semaphore:
+        self._convert_one(name, src_path)
+    except Exception as e:
+      conversion.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._conversions[name]
+      conversion.done.set()
+
+  def _convert_one(self, name, src_path):
+    path = os.path.join(self.cache_dir, name)
+    tmp_path = os.path.join(self.cache_dir, _TMP_PREFIX + name)
+
+    self.profile.log(logging.INFO, 'Converting %r on demand', src_path)
+    try:
+      errors = self.profile.batch_convert_cb(
+        self.profile, [(src_path, tmp_path)]) or {}
+      if tmp_path in errors:
+        raise errors[tmp_path]
+      os.replace(tmp_path, path)
+    except BaseException:
+      try:
+        os.remove(tmp_path)
+      except FileNotFoundError:
+        pass
+      raise
+
+    size = os.stat(path).st_size
+    with self._lock:
+      self._cache_bytes += size - self._cache.pop(name, 0)
+      self._cache[name] = size
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+  def do_GET(self):
+    self._serve(body=True)
+
+  def do_HEAD(self):
+    self._serve(body=False)
+
+  def log_message(self, format, *args):
+    logging.debug('%s: ' + format, self.address_string(), *args)
+
+  def _serve(self, body):
+    converter = self.server.converter
+    url_path = urllib.parse.urlsplit(self.path).path
+    # Normalizing an absolute path removes any '..' that would escape
+    # the top directory.
+    relpath = posixpath.normpath(
+      urllib.parse.unquote(url_path, errors='surrogateescape')).lstrip('/')
+    relpath = relpath.replace('/', os.sep)
+
+    try:
+      if converter.isdir(relpath):
+        if not url_path.endswith('/'):
+          self.send_response(301)
+          self.send_header('Location', url_path + '/')
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+          return
+        self._send_listing(url_path, converter.listdir(relpath), body)
+        return
+      f = converter.open(relpath)
+    except (FileNotFoundError, NotADirectoryError):
+      self.send_error(404)
+      return
+    except Exception as e:
+      converter.profile.log(
+        logging.ERROR,
+        'Failed to serve %r: %s',
+        relpath,
+        e,
+        )
+      self.send_error(500)
+      return
+
+    with f:
+      self.send_response(200)
+      self.send_header(
+        'Content-Type',
+        mimetypes.guess_type(relpath, strict=False)[0]
+          or 'application/octet-stream',
+        )
+      self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+      self.end_headers()
+      if body:
+        shutil.copyfileobj(f, self.wfile)
+
+  def _send_listing(self, url_path, entries, body):
+    title = html.escape(
+      urllib.parse.unquote(url_path, errors='surrogateescape'))
+    lines = [
+      '<!DOCTYPE html>',
+      '<html><head><meta charset="utf-8"><title>%s</title></head>' % title,
+      '<body><h1>%s</h1><ul>' % title,
+      ]
+    for name, is_dir in entries:
+      display_name = name + '/' if is_dir else name
+      lines.append('<li><a href="%s">%s</a></li>' % (
+        urllib.parse.quote(display_name, errors='surrogateescape'),
+        html.escape(display_name),
+        ))
+    lines.append('</ul></body></html>')
+    encoded = '\n'.join(lines).encode('utf-8', 'surrogateescape')
+
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/html; charset=utf-8')
+    self.send_header('Content-Length', str(len(encoded)))
+    self.end_headers()
+    if body:
+      self.wfile.write(encoded)
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  """HTTP server for a LazyConverter.
+
+  Directories are served as HTML listings, and files with their
+  converted contents. Use serve_forever() to run it, and shutdown() and
+  server_close() to stop it.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, converter, address=('127.0.0.1', 0)):
+    """
+    Args:
+        converter: LazyConverter to serve.
+        address: Tuple of host and port to listen on. Port 0 picks a
+            free port, see server_address.
+    """
+
+    self.converter = converter
+    super(Server, self).__init__(address, _Handler)
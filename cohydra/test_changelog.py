@@ -0,0 +1,143 @@
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from . import changelog
+
+
+class TestChangeSet(unittest.TestCase):
+  def test_net_changes(self):
+    changes = changelog.ChangeSet()
+    self.assertFalse(changes)
+
+    changes.added('new', changelog.SYMLINK, 'target')
+    changes.removed('old', changelog.FILE)
+    changes.removed('dir', changelog.DIR)
+    changes.added('dir', changelog.DIR)
+    changes.removed('link', changelog.SYMLINK, 'a')
+    changes.added('link', changelog.SYMLINK, 'a')
+    changes.removed('file', changelog.FILE)
+    changes.added('file', changelog.FILE)
+    changes.removed('retargeted', changelog.SYMLINK, 'a')
+    changes.added('retargeted', changelog.SYMLINK, 'b')
+    changes.removed('retyped', changelog.SYMLINK, 'a')
+    changes.added('retyped', changelog.FILE)
+    changes.added('temporary', changelog.DIR)
+    changes.removed('temporary', changelog.DIR)
+
+    self.assertTrue(changes)
+    self.assertEqual(changes.changes(), [
+      ('file', changelog.MODIFIED, changelog.FILE),
+      ('new', changelog.ADDED, changelog.SYMLINK),
+      ('old', changelog.REMOVED, changelog.FILE),
+      ('retargeted', changelog.MODIFIED, changelog.SYMLINK),
+      ('retyped', changelog.REMOVED, changelog.SYMLINK),
+      ('retyped', changelog.ADDED, changelog.FILE),
+      ])
+
+  def test_describe(self):
+    with tempfile.TemporaryDirectory() as top_dir:
+      path = os.path.join(top_dir, 'file')
+      open(path, 'w').close()
+      os.symlink('file', os.path.join(top_dir, 'link'))
+
+      self.assertEqual(changelog.describe(top_dir), (changelog.DIR, None))
+      self.assertEqual(changelog.describe(path), (changelog.FILE, None))
+      self.assertEqual(
+        changelog.describe(os.path.join(top_dir, 'link')),
+        (changelog.SYMLINK, 'file'),
+        )
+
+
+class TestJournal(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.dir.name, 'journal')
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def test_write_and_read(self):
+    journal = changelog.Journal(self.path)
+
+    self.assertEqual(
+      journal.write_run([('a', changelog.ADDED, changelog.FILE)]),
+      1,
+      )
+    self.assertEqual(journal.write_run([], complete=False), 2)
+
+    runs = list(changelog.read(self.path))
+    self.assertEqual(
+      [(header['seq'], header['complete'], header['count'])
+        for header, changes in runs],
+      [(1, True, 1), (2, False, 0)],
+      )
+    self.assertEqual(runs[0][1], [{
+      'seq': 1,
+      'change': changelog.ADDED,
+      'type': changelog.FILE,
+      'path': 'a',
+      }])
+
+    self.assertEqual(
+      [header['seq'] for header, changes
+        in changelog.read(self.path, since=1)],
+      [2],
+      )
+
+  def test_rotate(self):
+    journal = changelog.Journal(self.path, max_bytes=1, backups=2)
+
+    for i in range(4):
+      journal.write_run([('a%d' % i, changelog.ADDED, changelog.DIR)])
+
+    self.assertEqual(
+      sorted(os.listdir(self.dir.name)),
+      ['journal', 'journal.1', 'journal.2', 'journal.seq'],
+      )
+    self.assertEqual(
+      [
+        (header['seq'], [change['path'] for change in changes])
+        for header, changes in changelog.read(self.path)
+        ],
+      [(2, ['a1']), (3, ['a2']), (4, ['a3'])],
+      )
+
+  def test_partial_line(self):
+    journal = changelog.Journal(self.path)
+    journal.write_run([('a', changelog.ADDED, changelog.FILE)])
+    with open(self.path, 'a') as f:
+      f.write(json.dumps({'seq': 2, 'complete': True, 'count': 0})[:-3])
+
+    self.assertEqual(
+      [header['seq'] for header, changes in changelog.read(self.path)],
+      [1],
+      )
+    self.assertEqual(journal.write_run([]), 2)
+    self.assertEqual(
+      [header['seq'] for header, changes in changelog.read(self.path)],
+      [1, 2],
+      )
+
+  def test_interrupted_write(self):
+    journal = changelog.Journal(self.path)
+    with unittest.mock.patch.object(
+        changelog.os, 'fsync', side_effect=OSError('crash')):
+      self.assertRaises(
+        OSError,
+        journal.write_run,
+        [('a', changelog.ADDED, changelog.FILE)],
+        )
+    ((header, changes),) = changelog.read(self.path)
+    self.assertEqual(header['seq'], 1)
+
+    # The next run doesn't reuse the sequence number, so readers that
+    # saw the interrupted run still see it.
+    self.assertEqual(journal.write_run([]), 2)
+    self.assertEqual(
+      [header['seq'] for header, changes
+        in changelog.read(self.path, since=1)],
+      [2],
+      )
@@ -0,0 +1,204 @@
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from . import cli
+
+
+_DEFINITION = '''
+import os
+
+import cohydra.profile
+
+with open(os.path.join(os.path.dirname(__file__), 'loads'), 'a') as f:
+  f.write('x')
+
+def keep_all_select_cb(profile, src_relpath, dst_relpath, contents):
+  return contents
+
+master = cohydra.profile.RootProfile(top_dir={src!r})
+mirror = cohydra.profile.FilterProfile(
+  top_dir={dst!r},
+  parent=master,
+  select_cb=keep_all_select_cb,
+  )
+'''
+
+
+class TestCli(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.src = os.path.join(self.dir.name, 'src')
+    self.dst = os.path.join(self.dir.name, 'dst')
+    os.mkdir(self.src)
+    os.mkdir(self.dst)
+    self.write_src('a')
+
+    self.definition = os.path.join(self.dir.name, 'cohydra_test_def.py')
+    with open(self.definition, 'w') as f:
+      f.write(_DEFINITION.format(src=self.src, dst=self.dst))
+    self.stamp = os.path.join(self.dir.name, 'stamp.json')
+
+  def tearDown(self):
+    sys.modules.pop('cohydra_test_def', None)
+    while self.dir.name in sys.path:
+      sys.path.remove(self.dir.name)
+    self.dir.cleanup()
+
+  def write_src(self, relpath):
+    with open(os.path.join(self.src, relpath), 'w') as f:
+      f.write(relpath)
+
+  def loads(self):
+    try:
+      with open(os.path.join(self.dir.name, 'loads')) as f:
+        return len(f.read())
+    except FileNotFoundError:
+      return 0
+
+  def run_cli(self, *args):
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+      cli.main(list(args))
+    return stdout.getvalue()
+
+  def test_generate_quick_check(self):
+    self.run_cli('--stamp', self.stamp, self.definition, 'generate')
+    self.assertEqual(os.listdir(self.dst), ['a'])
+    self.assertEqual(self.loads(), 1)
+
+    self.run_cli('--stamp', self.stamp, self.definition, 'generate')
+    self.assertEqual(self.loads(), 1)
+
+    self.write_src('b')
+    self.run_cli('--stamp', self.stamp, self.definition, 'generate')
+    self.assertEqual(sorted(os.listdir(self.dst)), ['a', 'b'])
+    self.assertEqual(self.loads(), 2)
+
+    self.run_cli(
+      '--stamp', self.stamp, self.definition, 'generate', '--force')
+    self.assertEqual(self.loads(), 3)
+
+  def test_generate_relpath(self):
+    self.run_cli(self.definition, 'generate')
+    self.write_src('b')
+
+    self.run_cli(
+      '--stamp', self.stamp,
+      self.definition,
+      'generate', '--relpath', 'b',
+      )
+
+    self.assertEqual(sorted(os.listdir(self.dst)), ['a', 'b'])
+    # Partial runs don't record a stamp.
+    self.assertFalse(os.path.exists(self.stamp))
+
+  def test_plan(self):
+    output = self.run_cli(self.definition, 'plan', '--profile', 'mirror')
+    self.assertIn('FilterProfile', output)
+    self.assertIn('link 1', output)
+
+    output = self.run_cli(self.definition, 'plan', '--json')
+    self.assertEqual(json.loads(output)['totals']['link'], 1)
+
+  def test_print(self):
+    output = self.run_cli(self.definition, 'print')
+    self.assertEqual(len(output.splitlines()), 2)
+    self.assertIn('RootProfile', output.splitlines()[0])
+
+  def test_stats(self):
+    output = self.run_cli(self.definition, 'stats')
+    self.assertEqual(json.loads(output), {})
+
+  def test_failures(self):
+    with open(self.definition, 'a') as f:
+      f.write(textwrap.dedent('''
+        def convert_select_cb(profile, src_relpath):
+          return src_relpath + '.out'
+
+        def fail_convert_cb(profile, src, dst):
+          raise ValueError('Bad file')
+
+        converted = cohydra.profile.ConvertProfile(
+          top_dir={dst!r},
+          parent=master,
+          select_cb=convert_select_cb,
+          convert_cb=fail_convert_cb,
+          remember_failures=True,
+          state_dir={state!r},
+          )
+        ''').format(
+          dst=os.path.join(self.dir.name, 'converted'),
+          state=os.path.join(self.dir.name, 'state'),
+          ))
+    os.mkdir(os.path.join(self.dir.name, 'converted'))
+
+    with contextlib.redirect_stderr(io.StringIO()):
+      self.run_cli(
+        '--stamp', self.stamp,
+        self.definition,
+        'generate', '--profile', 'converted',
+        )
+    output = json.loads(self.run_cli(self.definition, 'failures'))
+    self.assertEqual(list(output.values())[0]['a.out']['src'], 'a')
+
+    self.run_cli('--stamp', self.stamp, self.definition, 'generate')
+    self.assertTrue(os.path.exists(self.stamp))
+    output = json.loads(self.run_cli(
+      '--stamp', self.stamp, self.definition, 'failures', '--clear'))
+    self.assertEqual(list(output.values()), [['a.out']])
+    self.assertFalse(os.path.exists(self.stamp))
+    output = json.loads(self.run_cli(self.definition, 'failures'))
+    self.assertEqual(list(output.values()), [{}])
+
+  def test_serve_needs_convert_profile(self):
+    self.assertRaises(
+      SystemExit,
+      self.run_cli,
+      self.definition,
+      'serve',
+      '--profile', 'mirror',
+      '--cache-dir', os.path.join(self.dir.name, 'cache'),
+      )
+
+  def test_unknown_profile(self):
+    with contextlib.redirect_stderr(io.StringIO()):
+      self.assertRaises(
+        SystemExit,
+        self.run_cli,
+        self.definition,
+        'generate',
+        '--profile',
+        'missing',
+        )
+    self.assertFalse(os.listdir(self.dst))
+
+  def test_quick_check_imports(self):
+    self.run_cli('--stamp', self.stamp, self.definition, 'generate')
+
+    output = subprocess.check_output(
+      [
+        sys.executable,
+        '-c',
+        textwrap.dedent('''
+          import sys
+          from cohydra import cli
+          cli.main(sys.argv[1:])
+          print(sorted(
+            name for name in ('cohydra.profile', 'multiprocessing', 'six')
+            if name in sys.modules))
+          '''),
+        '--stamp', self.stamp, self.definition, 'generate',
+        ],
+      cwd=os.path.dirname(os.path.dirname(os.path.abspath(cli.__file__))),
+      universal_newlines=True,
+      )
+
+    self.assertEqual(output.strip(), '[]')
+    self.assertEqual(self.loads(), 1)
@@ -0,0 +1,293 @@
+import multiprocessing
+import os
+import shutil
+import socket
+import socketserver
+import threading
+import unittest
+
+from . import distributed
+from . import profile
+from . import test_helper
+
+
+AUTHKEY = b'test key'
+
+
+def double(x):
+  return x * 2
+
+def fail(message):
+  raise ValueError(message)
+
+def convert_select_cb(profile, src_relpath):
+  if src_relpath.endswith('.in'):
+    return src_relpath + '.out'
+  return None
+
+def copy_convert_cb(profile, src, dst):
+  shutil.copyfile(src, dst)
+
+
+class FakeWorker():
+  """Worker that pulls jobs, and is then controlled by the test.
+  """
+
+  def __init__(self, address, authkey=AUTHKEY):
+    self.sock = socket.create_connection(address)
+    self.f = self.sock.makefile('rwb')
+    coordinator_nonce = distributed._receive(self.f)['nonce']
+    nonce = distributed._nonce()
+    distributed._send(self.f, {
+      'type': 'register',
+      'name': 'fake',
+      'nonce': nonce,
+      'digest': distributed._digest(
+        authkey, 'register', coordinator_nonce, nonce),
+      })
+    self.registration = distributed._receive(self.f)
+    self.session_key = distributed._session_key(
+      authkey, coordinator_nonce, nonce)
+
+  def pull(self):
+    distributed._send(self.f, {'type': 'pull'})
+    return distributed._receive(self.f)
+
+  def send_result(self, job_id, value, session_key=None):
+    payload = distributed._encode((True, value))
+    distributed._send(self.f, {
+      'type': 'result',
+      'job_id': job_id,
+      'payload': payload,
+      'mac': distributed._digest(
+        session_key or self.session_key, 'result', job_id, payload),
+      })
+
+  def close(self):
+    self.sock.close()
+
+
+class _ImpostorHandler(socketserver.StreamRequestHandler):
+  """Coordinator that doesn't know the key, but sends a job anyway.
+  """
+
+  def handle(self):
+    distributed._send(self.wfile, {'type': 'challenge', 'nonce': '00'})
+    distributed._receive(self.rfile)
+    distributed._send(self.wfile, {'type': 'registered', 'digest': '00'})
+    try:
+      self.server.pulled = distributed._receive(self.rfile)
+    except EOFError:
+      return
+    distributed._send(self.wfile, {
+      'type': 'job',
+      'job_id': 0,
+      'payload': distributed._encode((fail, ('unpickled',))),
+      })
+
+
+class TestCoordinator(unittest.TestCase):
+  def setUp(self):
+    self.coordinator = distributed.Coordinator(
+      AUTHKEY,
+      address=('127.0.0.1', 0),
+      heartbeat_timeout=0.5,
+      poll_interval=0.1,
+      )
+    self.processes = []
+
+  def tearDown(self):
+    self.coordinator.close()
+    for process in self.processes:
+      process.join(5)
+      if process.is_alive():
+        process.terminate()
+
+  def start_worker(self, authkey=AUTHKEY):
+    process = multiprocessing.Process(
+      target=distributed.run_worker,
+      args=(self.coordinator.address, authkey),
+      kwargs={'heartbeat_interval': 0.1},
+      )
+    process.start()
+    self.processes.append(process)
+    return process
+
+  def test_results(self):
+    self.start_worker()
+    self.start_worker()
+
+    results = [
+      self.coordinator.apply_async(double, (i,)) for i in range(10)]
+
+    self.assertEqual(
+      [result.get(5) for result in results],
+      [i * 2 for i in range(10)],
+      )
+
+  def test_callbacks(self):
+    self.start_worker()
+    calls = []
+
+    self.coordinator.apply_async(
+      double,
+      (1,),
+      callback=lambda value: calls.append(('ok', value)),
+      ).get(5)
+    result = self.coordinator.apply_async(
+      fail,
+      ('oops',),
+      error_callback=lambda error: calls.append(('error', str(error))),
+      )
+
+    self.assertRaisesRegex(ValueError, 'oops', result.get, 5)
+    self.assertEqual(calls, [('ok', 2), ('error', 'oops')])
+
+  def test_bad_authkey(self):
+    self.assertRaises(
+      RuntimeError,
+      distributed.run_worker,
+      self.coordinator.address,
+      b'wrong',
+      )
+    self.assertEqual(self.coordinator.workers(), [])
+
+  def test_impostor_coordinator(self):
+    server = socketserver.TCPServer(('127.0.0.1', 0), _ImpostorHandler)
+    server.pulled = None
+    self.addCleanup(server.server_close)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+
+    self.assertRaisesRegex(
+      RuntimeError,
+      'Not registered',
+      distributed.run_worker,
+      server.server_address,
+      AUTHKEY,
+      )
+    thread.join(5)
+    self.assertIsNone(server.pulled)
+
+  def test_bad_result_mac(self):
+    result = self.coordinator.apply_async(double, (3,))
+    worker = FakeWorker(self.coordinator.address)
+    job = worker.pull()
+    self.assertEqual(job['type'], 'job')
+    self.assertEqual(
+      job['mac'],
+      distributed._digest(
+        worker.session_key, 'job', job['job_id'], job['payload']),
+      )
+
+    # A result with a MAC from another connection is rejected, and the
+    # job is requeued.
+    worker.send_result(job['job_id'], 'forged', session_key=b'other')
+    self.start_worker()
+
+    self.assertEqual(result.get(5), 6)
+    worker.close()
+
+  def test_requeue_disconnected_worker(self):
+    result = self.coordinator.apply_async(double, (3,))
+    worker = FakeWorker(self.coordinator.address)
+    self.assertEqual(worker.pull()['type'], 'job')
+    worker.close()
+
+    self.start_worker()
+
+    self.assertEqual(result.get(5), 6)
+
+  def test_requeue_silent_worker(self):
+    result = self.coordinator.apply_async(double, (3,))
+    worker = FakeWorker(self.coordinator.address)
+    self.assertEqual(worker.pull()['type'], 'job')
+
+    self.start_worker()
+
+    self.assertEqual(result.get(5), 6)
+    self.assertEqual(len(self.coordinator.workers()), 1)
+    worker.close()
+
+  def test_requeue_limit(self):
+    result = self.coordinator.apply_async(double, (3,))
+
+    # Each worker dies with the job.
+    for i in range(3):
+      worker = FakeWorker(self.coordinator.address)
+      message = worker.pull()
+      while message['type'] == 'wait':
+        message = worker.pull()
+      self.assertEqual(message['type'], 'job')
+      worker.close()
+
+    self.assertRaisesRegex(
+      RuntimeError, 'lost by 3 workers', result.get, 5)
+
+  def test_close(self):
+    result = self.coordinator.apply_async(double, (3,))
+    self.coordinator.close()
+    self.assertRaises(RuntimeError, result.get, 5)
+
+
+class TestDistributedConvertProfile(
+    unittest.TestCase,
+    test_helper.SrcDstDirMixin,
+    ):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.coordinator = distributed.Coordinator(
+      AUTHKEY,
+      address=('127.0.0.1', 0),
+      poll_interval=0.1,
+      )
+    self.processes = [
+      multiprocessing.Process(
+        target=distributed.run_worker,
+        args=(self.coordinator.address, AUTHKEY),
+        )
+      for i in range(2)
+      ]
+    for process in self.processes:
+      process.start()
+
+  def tearDown(self):
+    self.coordinator.close()
+    for process in self.processes:
+      process.join(5)
+      if process.is_alive():
+        process.terminate()
+
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def test_generate(self):
+    for name in ('a.in', 'b.in', 'c'):
+      with open(os.path.join(self.src_path(), name), 'w') as f:
+        f.write(name)
+    p = profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=profile.RootProfile(top_dir=self.src_path()),
+      select_cb=convert_select_cb,
+      convert_cb=copy_convert_cb,
+      concurrency=2,
+      executor=self.coordinator,
+      )
+
+    p.generate()
+
+    for name in ('a.in', 'b.in'):
+      dst = os.path.join(self.dst_path(), name + '.out')
+      with open(dst) as f:
+        self.assertEqual(f.read(), name)
+      self.assertEqual(
+        test_helper.get_preserved_attrs(
+          os.path.join(self.src_path(), name)),
+        test_helper.get_preserved_attrs(dst),
+        )
+    self.assertTrue(os.path.islink(os.path.join(self.dst_path(), 'c')))
+
+    # Up-to-date files aren't sent to workers again.
+    submitted = self.coordinator._next_job_id
+    p.generate()
+    self.assertEqual(self.coordinator._next_job_id, submitted)
@@ -0,0 +1,216 @@
+import os
+import unittest
+
+from . import profile
+from . import test_helper
+from . import test_profile
+from . import util
+
+
+# Fixture: _DIRS directories, each with the same _FILES files.
+_DIRS = ('dir0', 'dir1', os.path.join('dir1', 'sub'), 'dir2')
+_FILES = ('a.in', 'b.in', 'c')
+
+
+class FsCallsTestMixin(test_helper.SrcDstDirMixin):
+  """Base for tests of the number of filesystem calls.
+
+  The bounds in the tests are what the code currently does. If a
+  change makes a bound too low, make sure the extra calls are needed
+  before raising it, because they're expensive on network filesystems.
+  """
+
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    for dir_relpath in _DIRS:
+      os.makedirs(os.path.join(self.src_path(), dir_relpath))
+      for name in _FILES:
+        with open(os.path.join(self.src_path(), dir_relpath, name), 'w') as f:
+          f.write(name)
+
+    self.root = profile.RootProfile(top_dir=self.src_path())
+
+  def tearDown(self):
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def change_one(self):
+    path = os.path.join(self.src_path(), 'dir1', 'a.in')
+    with open(path, 'a') as f:
+      f.write('changed')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+  def count(self, func, *args, **kwargs):
+    with test_helper.FsCallCounter() as counter:
+      func(*args, **kwargs)
+    return counter.counts
+
+  def assert_at_most(self, counts, bounds):
+    for name in sorted(set(counts) | set(bounds)):
+      with self.subTest(name=name):
+        self.assertLessEqual(counts[name], bounds.get(name, 0))
+
+
+class TestFilterProfile(unittest.TestCase, FsCallsTestMixin):
+  def setUp(self):
+    FsCallsTestMixin.setUp(self)
+
+    self.profile = profile.FilterProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=test_profile.keep_all_select_cb,
+      )
+
+  def tearDown(self):
+    FsCallsTestMixin.tearDown(self)
+
+  def test_cold(self):
+    self.assert_at_most(self.count(self.profile.generate), {
+      'os.scandir': 6,
+      'os.stat': 28,
+      'os.mkdir': 12,
+      'os.makedirs': 12,
+      'os.symlink': 12,
+      'shutil.copystat': 4,
+      })
+
+  def test_noop(self):
+    self.profile.generate()
+
+    self.assert_at_most(self.count(self.profile.generate), {
+      'os.scandir': 10,
+      'os.stat': 28,
+      'os.remove': 12,
+      'os.rmdir': 4,
+      'os.mkdir': 12,
+      'os.makedirs': 12,
+      'os.symlink': 12,
+      'shutil.copystat': 4,
+      })
+
+  def test_change_one(self):
+    self.profile.generate()
+    self.change_one()
+
+    self.assert_at_most(
+      self.count(
+        self.profile.generate,
+        relpaths=[os.path.join('dir1', 'a.in')],
+        ),
+      {
+        'os.scandir': 3,
+        'os.stat': 7,
+        'os.lstat': 1,
+        'os.remove': 1,
+        'os.mkdir': 1,
+        'os.makedirs': 1,
+        'os.symlink': 1,
+        'shutil.copystat': 1,
+        },
+      )
+
+
+class TestConvertProfile(unittest.TestCase, FsCallsTestMixin):
+  def setUp(self):
+    FsCallsTestMixin.setUp(self)
+
+    self.profile = profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=test_profile.convert_select_cb,
+      convert_cb=test_profile.copy_convert_cb,
+      concurrency=1,
+      )
+    # Conversions run in worker processes, so only the calls that
+    # finish them (copying stats and renaming into place) are counted.
+
+  def tearDown(self):
+    FsCallsTestMixin.tearDown(self)
+
+  def test_cold(self):
+    self.assert_at_most(self.count(self.profile.generate), {
+      'os.scandir': 15,
+      'os.stat': 32,
+      'os.lstat': 16,
+      'os.mkdir': 4,
+      'os.makedirs': 4,
+      'os.replace': 8,
+      'os.symlink': 4,
+      'shutil.copystat': 12,
+      })
+
+  def test_noop(self):
+    self.profile.generate()
+
+    self.assert_at_most(self.count(self.profile.generate), {
+      'os.scandir': 15,
+      'os.stat': 28,
+      'os.lstat': 28,
+      'os.remove': 4,
+      'os.mkdir': 4,
+      'os.makedirs': 4,
+      'os.symlink': 4,
+      'shutil.copystat': 4,
+      })
+
+  def test_change_one(self):
+    self.profile.generate()
+    self.change_one()
+
+    self.assert_at_most(self.count(self.profile.generate), {
+      'os.scandir': 15,
+      'os.stat': 32,
+      'os.lstat': 28,
+      'os.remove': 5,
+      'os.mkdir': 4,
+      'os.makedirs': 4,
+      'os.replace': 1,
+      'os.symlink': 4,
+      'shutil.copystat': 5,
+      })
+
+  def test_change_one_scoped(self):
+    self.profile.generate()
+    self.change_one()
+
+    self.assert_at_most(
+      self.count(
+        self.profile.generate,
+        relpaths=[os.path.join('dir1', 'a.in')],
+        ),
+      {
+        'os.scandir': 4,
+        'os.stat': 19,
+        'os.lstat': 8,
+        'os.remove': 1,
+        'os.mkdir': 1,
+        'os.makedirs': 1,
+        'os.replace': 1,
+        'shutil.copystat': 2,
+        },
+      )
+
+
+class TestFixDirStats(unittest.TestCase, FsCallsTestMixin):
+  def setUp(self):
+    FsCallsTestMixin.setUp(self)
+
+    self.profile = profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=test_profile.convert_select_cb,
+      convert_cb=test_profile.copy_convert_cb,
+      concurrency=1,
+      )
+    self.profile.generate()
+
+  def tearDown(self):
+    FsCallsTestMixin.tearDown(self)
+
+  def test_all(self):
+    self.assert_at_most(self.count(util.fix_dir_stats, self.profile), {
+      'os.scandir': 5,
+      'os.stat': 4,
+      'shutil.copystat': 4,
+      })
@@ -1,4 +1,6 @@
+import collections
 import os
+import shutil
 import tempfile
 
 
@@ -38,3 +40,53 @@ def symlink_pointee_abspath(filename):
   return os.path.abspath(os.path.join(
     os.path.dirname(filename),
     os.readlink(filename)))
+
+
+class FsCallCounter():
+  """Context manager that counts calls to filesystem functions.
+
+  Only calls in this process are counted, not in e.g. conversion
+  processes. Calls made by the counted functions themselves (e.g.,
+  os.makedirs() calling os.stat()) are counted too.
+
+  Attributes:
+    counts: collections.Counter of calls, keyed by name, e.g.,
+        'os.stat'.
+  """
+
+  FUNCTIONS = (
+    (os, 'os', 'scandir'),
+    (os, 'os', 'stat'),
+    (os, 'os', 'lstat'),
+    (os, 'os', 'symlink'),
+    (os, 'os', 'readlink'),
+    (os, 'os', 'remove'),
+    (os, 'os', 'replace'),
+    (os, 'os', 'mkdir'),
+    (os, 'os', 'makedirs'),
+    (os, 'os', 'rmdir'),
+    (shutil, 'shutil', 'copystat'),
+    (shutil, 'shutil', 'rmtree'),
+    )
+
+  def __init__(self):
+    self.counts = collections.Counter()
+    self._originals = []
+
+  def _wrap(self, name, func):
+    def wrapper(*args, **kwargs):
+      self.counts[name] += 1
+      return func(*args, **kwargs)
+    return wrapper
+
+  def __enter__(self):
+    for module, module_name, name in FsCallCounter.FUNCTIONS:
+      func = getattr(module, name)
+      self._originals.append((module, name, func))
+      setattr(module, name, self._wrap(module_name + '.' + name, func))
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    for module, name, func in reversed(self._originals):
+      setattr(module, name, func)
+    self._originals = []
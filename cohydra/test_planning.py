@@ -0,0 +1,181 @@
+import json
+import os
+import tempfile
+import unittest
+
+from . import planning
+from . import profile
+from . import test_helper
+from . import test_profile
+
+
+def tree_snapshot(top_dir):
+  """Get everything about a tree that generate() might change.
+  """
+
+  snapshot = {}
+  for dirpath, dirnames, filenames in os.walk(top_dir):
+    for name in dirnames + filenames:
+      path = os.path.join(dirpath, name)
+      snapshot[os.path.relpath(path, top_dir)] = (
+        test_helper.get_preserved_attrs(path),
+        os.readlink(path) if os.path.islink(path) else None,
+        )
+  return snapshot
+
+
+class TestPlan(unittest.TestCase):
+  def test_totals_and_json(self):
+    plan = planning.Plan('p', bytes_per_second=10)
+    plan.add(planning.LINK, 'a', target='../a')
+    plan.add(planning.CONVERT, 'b.out', src='b', size=100)
+    plan.add(planning.CONVERT, 'c.out', src='c', size=50)
+
+    self.assertEqual(plan.totals()[planning.CONVERT], 2)
+    self.assertEqual(plan.totals()['convert_bytes'], 150)
+    self.assertEqual(plan.estimated_seconds(), 15)
+
+    data = json.loads(planning.to_json([plan, planning.Plan('q')]))
+    self.assertEqual(data['totals'][planning.LINK], 1)
+    self.assertEqual(data['estimated_seconds'], 15)
+    self.assertEqual(
+      data['profiles'][0]['actions'][1],
+      {'action': 'convert', 'path': 'b.out', 'src': 'b', 'size': 100},
+      )
+
+  def test_unknown_estimate(self):
+    plan = planning.Plan('p')
+    plan.add(planning.CONVERT, 'b.out', src='b', size=100)
+
+    self.assertIsNone(plan.estimated_seconds())
+    self.assertIsNone(json.loads(planning.to_json([plan]))['estimated_seconds'])
+
+
+class TestFilterProfilePlan(unittest.TestCase, test_helper.SrcDstDirMixin):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    os.mkdir(os.path.join(self.src_path(), 'dir'))
+    open(os.path.join(self.src_path(), 'dir', 'keep'), 'w').close()
+    open(os.path.join(self.src_path(), 'dir', 'skip'), 'w').close()
+    os.mkdir(os.path.join(self.src_path(), 'empty'))
+
+    self.profile = profile.FilterProfile(
+      top_dir=self.dst_path(),
+      parent=profile.RootProfile(top_dir=self.src_path()),
+      select_cb=lambda profile, src_relpath, dst_relpath, contents: [
+        entry for entry in contents if entry.name != 'skip'],
+      )
+
+  def tearDown(self):
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def test_plan_from_empty(self):
+    plan = self.profile.plan()
+
+    self.assertEqual(
+      plan.actions,
+      [
+        (planning.MKDIR, 'dir', {}),
+        (planning.LINK, os.path.join('dir', 'keep'),
+          {'target': os.path.join('..', '..', os.path.basename(
+            self.src_path()), 'dir', 'keep')}),
+        (planning.COPYSTAT, 'dir', {}),
+        ],
+      )
+    self.assertEqual(os.listdir(self.dst_path()), [])
+
+  def test_plan_up_to_date(self):
+    self.profile.generate()
+    snapshot = tree_snapshot(self.dst_path())
+
+    self.assertEqual(self.profile.plan().actions, [])
+    self.assertEqual(tree_snapshot(self.dst_path()), snapshot)
+
+  def test_plan_removal(self):
+    self.profile.generate()
+    os.remove(os.path.join(self.src_path(), 'dir', 'keep'))
+
+    self.assertEqual(
+      self.profile.plan().actions,
+      [
+        (planning.REMOVE, os.path.join('dir', 'keep'), {}),
+        (planning.RMDIR, 'dir', {}),
+        ],
+      )
+
+
+class TestConvertProfilePlan(
+    unittest.TestCase,
+    test_helper.SrcDstDirMixin,
+    ):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.state_dir = tempfile.TemporaryDirectory()
+
+    os.mkdir(os.path.join(self.src_path(), 'dir'))
+    with open(os.path.join(self.src_path(), 'dir', 'a.in'), 'w') as f:
+      f.write('abc')
+    open(os.path.join(self.src_path(), 'dir', 'b'), 'w').close()
+
+    self.profile = profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=profile.RootProfile(top_dir=self.src_path()),
+      select_cb=test_profile.convert_select_cb,
+      convert_cb=test_profile.copy_convert_cb,
+      state_dir=self.state_dir.name,
+      )
+
+  def tearDown(self):
+    self.state_dir.cleanup()
+
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def test_plan_from_empty(self):
+    plan = self.profile.plan()
+
+    self.assertEqual(
+      plan.totals(),
+      {
+        planning.MKDIR: 1,
+        planning.RMDIR: 0,
+        planning.LINK: 1,
+        planning.REMOVE: 0,
+        planning.CONVERT: 1,
+        planning.COPYSTAT: 1,
+        planning.COPY: 0,
+        'convert_bytes': 3,
+        'copy_bytes': 0,
+        },
+      )
+    self.assertIn(
+      (
+        planning.CONVERT,
+        os.path.join('dir', 'a.in.out'),
+        {'src': os.path.join('dir', 'a.in'), 'size': 3},
+        ),
+      plan.actions,
+      )
+    self.assertEqual(os.listdir(self.dst_path()), [])
+    self.assertEqual(os.listdir(self.state_dir.name), [])
+
+  def test_plan_changes(self):
+    self.profile.generate()
+    snapshot = tree_snapshot(self.dst_path())
+    self.assertEqual(self.profile.plan().actions, [])
+
+    os.utime(os.path.join(self.src_path(), 'dir', 'a.in'), (0, 0))
+    os.remove(os.path.join(self.src_path(), 'dir', 'b'))
+    plan = self.profile.plan()
+
+    self.assertEqual(
+      sorted(action for action, relpath, details in plan.actions),
+      sorted([
+        planning.REMOVE,
+        planning.CONVERT,
+        planning.REMOVE,
+        planning.COPYSTAT,
+        ]),
+      )
+    self.assertEqual(tree_snapshot(self.dst_path()), snapshot)
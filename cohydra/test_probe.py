@@ -0,0 +1,148 @@
+import os
+import pickle
+import tempfile
+import unittest
+import unittest.mock
+
+from . import probe
+from . import profile
+from . import test_helper
+
+
+class TestSniffMime(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def test_sniff(self):
+    for contents, mime in (
+        (b'fLaC\x00\x00', 'audio/flac'),
+        (b'\x89PNG\r\n\x1a\n...', 'image/png'),
+        (b'RIFF\x00\x00\x00\x00WAVEfmt ', 'audio/x-wav'),
+        (b'plain text', None),
+        (b'', None),
+        ):
+      with self.subTest(mime=mime):
+        path = os.path.join(self.dir.name, 'file')
+        with open(path, 'wb') as f:
+          f.write(contents)
+        self.assertEqual(probe.sniff_mime(path), mime)
+
+
+class TestProbeCache(unittest.TestCase, test_helper.SrcDstDirMixin):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.file = os.path.join(self.src_path(), 'file')
+    with open(self.file, 'w') as f:
+      f.write('foo')
+
+    self.cache_path = os.path.join(self.dst_path(), 'cache.json')
+
+    self.probe_cb = unittest.mock.Mock(return_value='result')
+
+  def tearDown(self):
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def test_memoize_through_symlink(self):
+    link = os.path.join(self.src_path(), 'link')
+    os.symlink('file', link)
+
+    cache = probe.ProbeCache()
+    self.assertEqual(cache.probe(self.file, self.probe_cb, 'p'), 'result')
+    self.assertEqual(cache.probe(link, self.probe_cb, 'p'), 'result')
+
+    self.probe_cb.assert_called_once_with(self.file)
+
+  def test_changed_file(self):
+    cache = probe.ProbeCache()
+    cache.probe(self.file, self.probe_cb, 'p')
+    with open(self.file, 'w') as f:
+      f.write('foobar')
+    cache.probe(self.file, self.probe_cb, 'p')
+
+    self.assertEqual(self.probe_cb.call_count, 2)
+
+  def test_persist(self):
+    cache = probe.ProbeCache(self.cache_path)
+    cache.probe(self.file, self.probe_cb, 'p')
+    cache.save()
+
+    cache = probe.ProbeCache(self.cache_path)
+    self.assertEqual(cache.probe(self.file, self.probe_cb, 'p'), 'result')
+
+    self.probe_cb.assert_called_once_with(self.file)
+
+  def test_evict_removed(self):
+    other = os.path.join(self.src_path(), 'other')
+    open(other, 'w').close()
+
+    cache = probe.ProbeCache(self.cache_path)
+    cache.probe(self.file, self.probe_cb, 'p')
+    cache.probe(other, self.probe_cb, 'p')
+    cache.save()
+
+    os.remove(other)
+    cache = probe.ProbeCache(self.cache_path)
+    self.assertEqual(len(cache), 2)
+    cache.save()
+    self.assertEqual(len(cache), 1)
+
+  def test_pickle(self):
+    cache = probe.ProbeCache(self.cache_path)
+    cache.probe(self.file, str, 'p')
+    cache.save()
+
+    # Pickled copies start empty, and aren't saved.
+    unpickled = pickle.loads(pickle.dumps(cache))
+    self.assertEqual(len(unpickled), 0)
+    self.assertEqual(
+      unpickled.probe(self.file, self.probe_cb, 'p'), 'result')
+    unpickled.save()
+    self.assertEqual(
+      probe.ProbeCache(self.cache_path).probe(
+        self.file, self.probe_cb, 'p'),
+      self.file,
+      )
+
+
+class TestProfileProbe(unittest.TestCase, test_helper.SrcDstDirMixin):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.state_dir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.state_dir.cleanup()
+
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def test_shared_and_saved(self):
+    open(os.path.join(self.src_path(), 'file'), 'w').close()
+    probe_cb = unittest.mock.Mock(return_value='result')
+
+    def select_cb(profile, src_relpath, dst_relpath, contents):
+      for entry in contents:
+        profile.probe(entry.path, probe_cb, 'p')
+      return contents
+
+    root = profile.RootProfile(
+      top_dir=self.src_path(),
+      state_dir=self.state_dir.name,
+      )
+    for name in ('a', 'b'):
+      os.mkdir(os.path.join(self.dst_path(), name))
+      profile.FilterProfile(
+        top_dir=os.path.join(self.dst_path(), name),
+        parent=root,
+        select_cb=select_cb,
+        )
+
+    root.generate_all()
+
+    probe_cb.assert_called_once_with(
+      os.path.join(self.src_path(), 'file'))
+    self.assertTrue(os.path.exists(
+      os.path.join(self.state_dir.name, 'probe-cache.json')))
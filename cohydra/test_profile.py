@@ -1,9 +1,18 @@
+import errno
+import json
+import multiprocessing.pool
 import os
+import pickle
+import shutil
 import tempfile
+import time
 import unittest
 import unittest.mock
 
+from . import changelog
+from . import planning
 from . import profile
+from . import schedule
 from . import test_helper
 
 
@@ -36,6 +45,43 @@ class TestProfile(unittest.TestCase):
       mock_generate.mock_calls,
       [unittest.mock.call(x) for x in (p, p0, p00, p1)])
 
+  def test_generate_all_resume(self, mock_generate):
+    state_dir = os.path.join(self.dir.name, 'state')
+    p = profile.Profile(self.dir.name, None, state_dir=state_dir)
+    p0 = profile.Profile(os.path.join(self.dir.name, '0'), p)
+    p1 = profile.Profile(os.path.join(self.dir.name, '1'), p)
+
+    def generate(self):
+      if self is p1:
+        raise KeyboardInterrupt()
+    mock_generate.side_effect = generate
+    self.assertRaises(KeyboardInterrupt, p.generate_all)
+
+    mock_generate.reset_mock()
+    mock_generate.side_effect = None
+    p.generate_all(resume=True)
+
+    self.assertEqual(mock_generate.mock_calls, [unittest.mock.call(p1)])
+    self.assertEqual(os.listdir(state_dir), [])
+
+    mock_generate.reset_mock()
+    p.generate_all(resume=True)
+
+    self.assertEqual(
+      mock_generate.mock_calls,
+      [unittest.mock.call(x) for x in (p, p0, p1)])
+
+  def test_generate_all_resume_requires_state_dir(self, mock_generate):
+    p = profile.Profile(self.dir.name, None)
+
+    self.assertRaisesRegex(
+      ValueError,
+      '^resume requires a state_dir',
+      p.generate_all,
+      resume=True,
+      )
+    self.assertEqual(mock_generate.mock_calls, [])
+
 
 class TestFilterProfile(
     unittest.TestCase,
@@ -404,6 +450,55 @@ class TestSanitizeFilenameProfile(
       self.profile.generate,
       )
 
+  def test_threads_same_as_serial(self):
+    for dir_relpath in ('a:', os.path.join('a:', 'b'), 'c', 'empty'):
+      os.mkdir(os.path.join(self.src_path(), dir_relpath))
+    for file_relpath in (
+        'f?',
+        os.path.join('a:', 'f'),
+        os.path.join('a:', 'b', 'CON'),
+        os.path.join('c', 'g.'),
+        ):
+      open(os.path.join(self.src_path(), file_relpath), 'w').close()
+    for dir_relpath in ('a:', os.path.join('a:', 'b'), 'c'):
+      os.utime(os.path.join(self.src_path(), dir_relpath), (0, 0))
+
+    root = profile.RootProfile(top_dir=self.src_path())
+    contents = []
+    dir_attrs = []
+    for threads in (None, 4):
+      top_dir = os.path.join(self.dst_path(), str(threads))
+      os.mkdir(top_dir)
+      profile.SanitizeFilenameProfile(
+        top_dir=top_dir,
+        parent=root,
+        threads=threads,
+        ).generate()
+      contents.append(tree_contents(top_dir))
+      dir_attrs.append({
+        relpath: test_helper.get_preserved_attrs(
+          os.path.join(top_dir, relpath))
+        for relpath, value in contents[-1].items()
+        if value == ('dir',)
+        })
+
+    self.assertEqual(contents[0], contents[1])
+    self.assertEqual(dir_attrs[0], dir_attrs[1])
+    self.assertIn(os.path.join('a_', 'b', 'CON_'), contents[1])
+    self.assertNotIn('empty', contents[1])
+
+  def test_threads_duplicate_filename_error(self):
+    os.mkdir(os.path.join(self.src_path(), 'dir'))
+    open(os.path.join(self.src_path(), 'dir', ':'), 'w').close()
+    open(os.path.join(self.src_path(), 'dir', '?'), 'w').close()
+    self.profile.threads = 4
+
+    self.assertRaisesRegex(
+      RuntimeError,
+      '^Sanitizing would create duplicate file: ',
+      self.profile.generate,
+      )
+
   def test_duplicate_filename_case_error(self):
     open(os.path.join(self.src_path(), 'A'), 'w').close()
     open(os.path.join(self.src_path(), 'a'), 'w').close()
@@ -413,3 +508,1815 @@ class TestSanitizeFilenameProfile(
       '^Sanitizing would create duplicate file: ',
       self.profile.generate,
       )
+
+  def test_name_index(self):
+    os.mkdir(os.path.join(self.src_path(), 'a:'))
+    open(os.path.join(self.src_path(), 'a:', 'CON'), 'w').close()
+    open(os.path.join(self.src_path(), 'ok'), 'w').close()
+
+    self.profile.generate()
+
+    self.assertEqual(self.profile.src_to_dst('a:'), 'a_')
+    self.assertEqual(
+      self.profile.src_to_dst(os.path.join('a:', 'CON')),
+      os.path.join('a_', 'CON_'),
+      )
+    self.assertEqual(self.profile.src_to_dst('ok'), 'ok')
+    self.assertIsNone(self.profile.src_to_dst('missing'))
+    self.assertEqual(
+      self.profile.dst_to_src(os.path.join('a_', 'CON_')),
+      os.path.join('a:', 'CON'),
+      )
+    self.assertIsNone(self.profile.dst_to_src(os.path.join('a_', 'con_')))
+    self.assertIsNone(self.profile.dst_to_src(os.path.join('a:', 'CON')))
+
+  def test_name_index_persistent(self):
+    open(os.path.join(self.src_path(), 'a:'), 'w').close()
+    with tempfile.TemporaryDirectory() as state_dir:
+      def make_profile():
+        return profile.SanitizeFilenameProfile(
+          top_dir=self.dst_path(),
+          parent=profile.RootProfile(top_dir=self.src_path()),
+          state_dir=state_dir,
+          )
+      make_profile().generate()
+
+      p = make_profile()
+      self.assertEqual(p.dst_to_src('a_'), 'a:')
+
+      open(os.path.join(self.src_path(), 'b?'), 'w').close()
+      with unittest.mock.patch.object(
+          p,
+          '_sanitize_name',
+          wraps=p._sanitize_name,
+          ) as sanitize_name:
+        p.generate()
+      sanitize_name.assert_called_once_with('b?')
+      self.assertEqual(
+        sorted(os.listdir(self.dst_path())), ['a_', 'b_'])
+
+      # Collisions with indexed names are still found.
+      open(os.path.join(self.src_path(), 'A:'), 'w').close()
+      self.assertRaisesRegex(
+        RuntimeError,
+        '^Sanitizing would create duplicate file: ',
+        make_profile().generate,
+        )
+
+  def test_name_index_settings_changed(self):
+    open(os.path.join(self.src_path(), 'a;'), 'w').close()
+    with tempfile.TemporaryDirectory() as state_dir:
+      def make_profile():
+        return profile.SanitizeFilenameProfile(
+          top_dir=self.dst_path(),
+          parent=profile.RootProfile(top_dir=self.src_path()),
+          state_dir=state_dir,
+          )
+      make_profile().generate()
+      self.assertEqual(os.listdir(self.dst_path()), ['a;'])
+
+      forbidden_chars_map = dict(
+        profile.SanitizeFilenameProfile._forbidden_chars_map)
+      forbidden_chars_map[ord(';')] = '_'
+      with unittest.mock.patch.object(
+          profile.SanitizeFilenameProfile,
+          '_forbidden_chars_map',
+          forbidden_chars_map,
+          ):
+        p = make_profile()
+        self.assertIsNone(p.dst_to_src('a;'))
+        p.generate()
+      self.assertEqual(os.listdir(self.dst_path()), ['a_'])
+
+  def test_name_index_unversioned(self):
+    open(os.path.join(self.src_path(), 'a:'), 'w').close()
+    with tempfile.TemporaryDirectory() as state_dir:
+      with open(os.path.join(state_dir, 'names.json'), 'w') as f:
+        json.dump({'': ['', {'a:': 'stale'}]}, f)
+
+      p = profile.SanitizeFilenameProfile(
+        top_dir=self.dst_path(),
+        parent=profile.RootProfile(top_dir=self.src_path()),
+        state_dir=state_dir,
+        )
+      self.assertIsNone(p.dst_to_src('stale'))
+      p.generate()
+      self.assertEqual(os.listdir(self.dst_path()), ['a_'])
+
+  def test_name_index_forgets_removed(self):
+    for dir_relpath in ('a', os.path.join('a', 'b:'), 'c'):
+      os.mkdir(os.path.join(self.src_path(), dir_relpath))
+    open(os.path.join(self.src_path(), 'a', 'b:', 'f'), 'w').close()
+    open(os.path.join(self.src_path(), 'c', 'g'), 'w').close()
+    self.profile.generate()
+
+    shutil.rmtree(os.path.join(self.src_path(), 'a', 'b:'))
+    self.profile.generate(relpaths=[os.path.join('a', 'b:')])
+
+    self.assertIsNone(
+      self.profile.src_to_dst(os.path.join('a', 'b:', 'f')))
+    self.assertIsNone(self.profile.dst_to_src(os.path.join('a', 'b_')))
+    self.assertEqual(
+      self.profile.src_to_dst(os.path.join('c', 'g')),
+      os.path.join('c', 'g'),
+      )
+
+    shutil.rmtree(os.path.join(self.src_path(), 'c'))
+    self.profile.generate()
+
+    self.assertIsNone(self.profile.src_to_dst(os.path.join('c', 'g')))
+
+
+def keep_all_select_cb(profile, src_relpath, dst_relpath, contents):
+  return contents
+
+
+def convert_select_cb(profile, src_relpath):
+  if src_relpath.endswith('.in'):
+    return src_relpath + '.out'
+  return None
+
+
+def copy_convert_cb(profile, src, dst):
+  if os.path.basename(src).startswith('bad'):
+    raise ValueError('Bad file %r' % src)
+  shutil.copyfile(src, dst)
+
+
+class CountingConverter():
+  """convert_cb that copies the source and logs calls to a file.
+  """
+
+  def __init__(self, log_path):
+    self.log_path = log_path
+
+  def __call__(self, profile, src, dst):
+    with open(self.log_path, 'a') as f:
+      f.write(os.path.basename(src) + '\n')
+    copy_convert_cb(profile, src, dst)
+
+  def calls(self):
+    if not os.path.exists(self.log_path):
+      return []
+    with open(self.log_path) as f:
+      return f.read().split()
+
+
+class FingerprintSelector():
+  """select_cb that returns per-file fingerprints from a dict.
+  """
+
+  def __init__(self, fingerprints):
+    self.fingerprints = fingerprints
+
+  def __call__(self, profile, src_relpath):
+    dst_relpath = convert_select_cb(profile, src_relpath)
+    if src_relpath in self.fingerprints:
+      return dst_relpath, self.fingerprints[src_relpath]
+    return dst_relpath
+
+
+def partial_convert_cb(profile, src, dst):
+  """Write part of the destination, and then fail.
+  """
+
+  with open(dst, 'w') as f:
+    f.write('partial')
+  raise ValueError('Bad file %r' % src)
+
+
+def slow_convert_cb(profile, src, dst):
+  if os.path.basename(src).startswith('slow'):
+    time.sleep(30)
+  copy_convert_cb(profile, src, dst)
+
+
+def late_convert_cb(profile, src, dst):
+  if os.path.basename(src).startswith('late'):
+    time.sleep(1)
+  copy_convert_cb(profile, src, dst)
+
+
+def no_placeholder_cb(profile, src_relpath):
+  return False
+
+
+def dst_name_convert_cb(profile, src, dst):
+  with open(dst, 'w') as f:
+    f.write(os.path.basename(dst))
+
+
+def batch_size_convert_cb(profile, pairs):
+  """Write the size of the batch to each destination.
+  """
+
+  errors = {}
+  for src, dst in pairs:
+    if os.path.basename(src).startswith('bad'):
+      errors[dst] = ValueError('Bad file %r' % src)
+      continue
+    with open(dst, 'w') as f:
+      f.write(str(len(pairs)))
+  return errors
+
+
+class TestConvertProfile(
+    unittest.TestCase,
+    test_helper.SrcDstDirMixin,
+    ):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.root = profile.RootProfile(top_dir=self.src_path())
+
+  def tearDown(self):
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def make_profile(self, **kwargs):
+    kwargs.setdefault('convert_cb', copy_convert_cb)
+    return profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=convert_select_cb,
+      **kwargs)
+
+  def write_src(self, relpath, contents=''):
+    path = os.path.join(self.src_path(), relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(contents)
+    return path
+
+  def read_dst(self, relpath):
+    with open(os.path.join(self.dst_path(), relpath)) as f:
+      return f.read()
+
+  def test_convert_and_symlink(self):
+    self.write_src(os.path.join('dir', 'a.in'), 'a')
+    self.write_src(os.path.join('dir', 'b'), 'b')
+    p = self.make_profile()
+
+    p.generate()
+
+    self.assertEqual(self.read_dst(os.path.join('dir', 'a.in.out')), 'a')
+    self.assertEqual(
+      test_helper.get_preserved_attrs(
+        os.path.join(self.src_path(), 'dir', 'a.in')),
+      test_helper.get_preserved_attrs(
+        os.path.join(self.dst_path(), 'dir', 'a.in.out')),
+      )
+    self.assertEqual(
+      test_helper.symlink_pointee_abspath(
+        os.path.join(self.dst_path(), 'dir', 'b')),
+      os.path.join(self.src_path(), 'dir', 'b'),
+      )
+
+  def test_clean(self):
+    self.write_src('a.in', 'a')
+    p = self.make_profile()
+    p.generate()
+
+    os.remove(os.path.join(self.src_path(), 'a.in'))
+    p.generate()
+
+    self.assertEqual(os.listdir(self.dst_path()), [])
+
+  def test_failure(self):
+    self.write_src('bad.in')
+    p = self.make_profile()
+
+    with self.assertLogs(level='ERROR'):
+      self.assertRaisesRegex(ValueError, '^Bad file ', p.generate)
+
+  def test_atomic_failure(self):
+    self.write_src('a.in')
+    p = self.make_profile(convert_cb=partial_convert_cb)
+
+    with self.assertLogs(level='ERROR'):
+      self.assertRaises(ValueError, p.generate)
+
+    self.assertEqual(os.listdir(self.dst_path()), [])
+
+  def test_tmp_dst_path(self):
+    self.write_src('a.in')
+    p = self.make_profile(convert_cb=dst_name_convert_cb)
+
+    p.generate()
+
+    tmp_name = self.read_dst('a.in.out')
+    self.assertNotEqual(tmp_name, 'a.in.out')
+    self.assertTrue(tmp_name.endswith('.out'))
+
+  def test_clean_leftover_tmp(self):
+    self.write_src('a.in', 'a')
+    p = self.make_profile()
+    p.generate()
+    leftover = os.path.basename(p.tmp_dst_path('a.in.out'))
+    with open(os.path.join(self.dst_path(), leftover), 'w') as f:
+      f.write('partial')
+
+    p.generate()
+
+    self.assertEqual(os.listdir(self.dst_path()), ['a.in.out'])
+
+  def test_time_budget(self):
+    self.write_src('fast.in', 'fast')
+    self.write_src('slow.in', 'slow')
+    p = self.make_profile(convert_cb=slow_convert_cb)
+
+    start = time.monotonic()
+    p.generate(time_budget=2)
+    self.assertLess(time.monotonic() - start, 10)
+
+    self.assertEqual(p.pending, ['slow.in.out'])
+    self.assertEqual(self.read_dst('fast.in.out'), 'fast')
+    self.assertEqual(
+      test_helper.symlink_pointee_abspath(
+        os.path.join(self.dst_path(), 'slow.in.out')),
+      os.path.join(self.src_path(), 'slow.in'),
+      )
+    self.assertEqual(
+      sorted(os.listdir(self.dst_path())),
+      ['fast.in.out', 'slow.in.out'],
+      )
+
+  def test_time_budget_executor(self):
+    self.write_src('fast.in', 'fast')
+    self.write_src('late.in', 'late')
+    executor = multiprocessing.pool.ThreadPool(2)
+    self.addCleanup(executor.terminate)
+    p = self.make_profile(
+      convert_cb=late_convert_cb,
+      executor=executor,
+      batch_size=1,
+      concurrency=2,
+      )
+
+    p.generate(time_budget=0.5)
+    # The executor's jobs can't be terminated, so let the late one
+    # finish.
+    executor.close()
+    executor.join()
+
+    self.assertEqual(p.pending, ['late.in.out'])
+    self.assertEqual(self.read_dst('fast.in.out'), 'fast')
+    self.assertEqual(
+      test_helper.symlink_pointee_abspath(
+        os.path.join(self.dst_path(), 'late.in.out')),
+      os.path.join(self.src_path(), 'late.in'),
+      )
+    self.assertEqual(
+      sorted(os.listdir(self.dst_path())),
+      ['fast.in.out', 'late.in.out'],
+      )
+
+  def test_time_budget_no_placeholder(self):
+    self.write_src('a.in', 'a')
+    p = self.make_profile(placeholder_cb=no_placeholder_cb)
+
+    p.generate(time_budget=0)
+
+    self.assertEqual(p.pending, ['a.in.out'])
+    self.assertEqual(os.listdir(self.dst_path()), [])
+
+    p.generate()
+
+    self.assertEqual(p.pending, [])
+    self.assertEqual(self.read_dst('a.in.out'), 'a')
+
+  def test_adaptive_concurrency(self):
+    for i in range(4):
+      self.write_src('%d.in' % i, str(i))
+    p = self.make_profile(
+      concurrency=schedule.AdaptiveConcurrency(max_jobs=2),
+      nice=1,
+      )
+
+    p.generate()
+
+    for i in range(4):
+      self.assertEqual(self.read_dst('%d.in.out' % i), str(i))
+
+  def test_batch(self):
+    for i in range(5):
+      self.write_src(os.path.join('dir1', '%d.in' % i))
+    self.write_src(os.path.join('dir2', '0.in'))
+    p = self.make_profile(
+      convert_cb=None,
+      batch_convert_cb=batch_size_convert_cb,
+      batch_size=3,
+      )
+
+    p.generate()
+
+    self.assertEqual(
+      sorted(
+        self.read_dst(os.path.join('dir1', '%d.in.out' % i))
+        for i in range(5)),
+      ['2', '2', '3', '3', '3'],
+      )
+    self.assertEqual(
+      self.read_dst(os.path.join('dir2', '0.in.out')), '1')
+
+  def test_batch_bytes(self):
+    for i in range(4):
+      self.write_src('%d.in' % i, 'xx')
+    p = self.make_profile(
+      convert_cb=None,
+      batch_convert_cb=batch_size_convert_cb,
+      batch_bytes=4,
+      )
+
+    p.generate()
+
+    for i in range(4):
+      self.assertEqual(self.read_dst('%d.in.out' % i), '2')
+
+  def test_batch_partial_failure(self):
+    self.write_src('bad.in')
+    self.write_src('good.in')
+    p = self.make_profile(
+      convert_cb=None,
+      batch_convert_cb=batch_size_convert_cb,
+      )
+
+    with self.assertLogs(level='ERROR'):
+      self.assertRaisesRegex(ValueError, '^Bad file ', p.generate)
+
+    self.assertEqual(self.read_dst('good.in.out'), '2')
+
+  def test_fingerprint(self):
+    self.write_src('a.in')
+    self.write_src('b.in')
+    with tempfile.TemporaryDirectory() as state_dir:
+      converter = CountingConverter(os.path.join(state_dir, 'log'))
+      fingerprints = {'b.in': 1}
+      def make_profile(fingerprint):
+        return profile.ConvertProfile(
+          top_dir=self.dst_path(),
+          parent=self.root,
+          select_cb=FingerprintSelector(fingerprints),
+          convert_cb=converter,
+          fingerprint=fingerprint,
+          state_dir=state_dir,
+          )
+
+      make_profile('q8').convert()
+      self.assertEqual(sorted(converter.calls()), ['a.in', 'b.in'])
+
+      make_profile('q8').convert()
+      self.assertEqual(len(converter.calls()), 2)
+
+      # Change the profile-wide fingerprint.
+      make_profile('q6').convert()
+      self.assertEqual(sorted(converter.calls()), ['a.in', 'a.in', 'b.in'])
+
+      # Change a per-file fingerprint.
+      fingerprints['b.in'] = 2
+      make_profile('q6').convert()
+      self.assertEqual(converter.calls()[-1], 'b.in')
+      self.assertEqual(len(converter.calls()), 4)
+
+  def test_fingerprint_tuple(self):
+    self.write_src('a.in')
+    self.write_src('b.in')
+    with tempfile.TemporaryDirectory() as state_dir:
+      converter = CountingConverter(os.path.join(state_dir, 'log'))
+      fingerprints = {'b.in': ('oggenc', '-q', 6)}
+      def make_profile():
+        return profile.ConvertProfile(
+          top_dir=self.dst_path(),
+          parent=self.root,
+          select_cb=FingerprintSelector(fingerprints),
+          convert_cb=converter,
+          fingerprint=('oggenc', '-q', 8),
+          state_dir=state_dir,
+          )
+
+      make_profile().convert()
+      self.assertEqual(len(converter.calls()), 2)
+
+      # Fingerprints loaded from the state directory are lists.
+      make_profile().convert()
+      self.assertEqual(len(converter.calls()), 2)
+
+  def test_pickle_drops_state(self):
+    with tempfile.TemporaryDirectory() as state_dir:
+      p = self.make_profile(state_dir=state_dir)
+      p.fingerprints()['a.in.out'] = 'q8'
+      p._pending_fingerprints['b.in.out'] = 'q8'
+
+      unpickled = pickle.loads(pickle.dumps(p))
+
+    self.assertIsNone(unpickled._fingerprints)
+    self.assertEqual(unpickled._pending_fingerprints, {})
+    self.assertEqual(p._pending_fingerprints, {'b.in.out': 'q8'})
+
+  def test_fingerprint_requires_state_dir(self):
+    self.assertRaisesRegex(
+      ValueError,
+      '^Fingerprints require a state_dir',
+      self.make_profile,
+      fingerprint='foo',
+      )
+
+  def test_both_callbacks_error(self):
+    self.assertRaisesRegex(
+      ValueError,
+      'mutually exclusive',
+      self.make_profile,
+      batch_convert_cb=batch_size_convert_cb,
+      )
+
+  def test_dedup(self):
+    for relpath in ('a.in', os.path.join('dir', 'b.in'), 'c.in'):
+      os.utime(self.write_src(relpath, 'same'), ns=(0, 10**9))
+    self.write_src('d.in', 'diff')
+    with tempfile.TemporaryDirectory() as state_dir:
+      converter = CountingConverter(os.path.join(state_dir, 'log'))
+      p = self.make_profile(
+        convert_cb=converter,
+        dedup='hardlink',
+        state_dir=state_dir,
+        )
+
+      p.generate()
+
+      # Only one of the identical sources is converted, whichever is
+      # found first.
+      calls = converter.calls()
+      self.assertEqual(len(calls), 2)
+      self.assertIn('d.in', calls)
+      a_out = os.path.join(self.dst_path(), 'a.in.out')
+      self.assertTrue(os.path.samefile(
+        a_out, os.path.join(self.dst_path(), 'dir', 'b.in.out')))
+      self.assertTrue(os.path.samefile(
+        a_out, os.path.join(self.dst_path(), 'c.in.out')))
+      self.assertEqual(
+        p.dedup_savings,
+        {'duplicates': 2, 'src_bytes': 8, 'seconds': unittest.mock.ANY,
+         'bytes': 8},
+        )
+
+      p.generate()
+      self.assertEqual(len(converter.calls()), 2)
+
+  def test_dedup_different_stats(self):
+    os.utime(self.write_src('a.in', 'same'), ns=(0, 10**9))
+    os.utime(self.write_src('b.in', 'same'), ns=(0, 2 * 10**9))
+    with tempfile.TemporaryDirectory() as state_dir:
+      converter = CountingConverter(os.path.join(state_dir, 'log'))
+      p = self.make_profile(convert_cb=converter, dedup='hardlink')
+
+      p.generate()
+
+      self.assertEqual(len(converter.calls()), 1)
+      for name in ('a.in', 'b.in'):
+        self.assertEqual(self.read_dst(name + '.out'), 'same')
+        self.assertEqual(
+          test_helper.get_preserved_attrs(
+            os.path.join(self.src_path(), name)),
+          test_helper.get_preserved_attrs(
+            os.path.join(self.dst_path(), name + '.out')),
+          )
+      self.assertEqual(p.dedup_savings['bytes'], 0)
+
+  def test_dedup_failure(self):
+    self.write_src('bad1.in', 'same')
+    self.write_src('bad2.in', 'same')
+    with tempfile.TemporaryDirectory() as state_dir:
+      converter = CountingConverter(os.path.join(state_dir, 'log'))
+      p = self.make_profile(convert_cb=converter, dedup='copy')
+
+      with self.assertLogs(level='ERROR') as logs:
+        self.assertRaises(ValueError, p.generate)
+
+      self.assertEqual(len(converter.calls()), 1)
+      self.assertEqual(len(logs.output), 2)
+      self.assertEqual(os.listdir(self.dst_path()), [])
+
+  def test_dedup_digest_cache(self):
+    self.write_src('a.in', 'same')
+    self.write_src('b.in', 'same')
+    with tempfile.TemporaryDirectory() as state_dir:
+      p = self.make_profile(dedup='copy', state_dir=state_dir)
+      with unittest.mock.patch.object(
+          profile.util,
+          'file_digest',
+          wraps=profile.util.file_digest,
+          ) as file_digest:
+        p.source_digest('a.in')
+        p.source_digest('b.in')
+        p._save_digests()
+        p.source_digest('a.in')
+        self.assertEqual(file_digest.call_count, 2)
+
+        os.utime(os.path.join(self.src_path(), 'a.in'), ns=(0, 0))
+        p.source_digest('a.in')
+        self.assertEqual(file_digest.call_count, 3)
+
+  def test_dedup_unknown(self):
+    self.assertRaisesRegex(
+      ValueError,
+      '^Unknown dedup ',
+      self.make_profile,
+      dedup='symlink',
+      )
+
+  def test_remember_failures(self):
+    self.write_src('a.in')
+    bad_path = self.write_src('bad.in')
+    with tempfile.TemporaryDirectory() as state_dir:
+      converter = CountingConverter(os.path.join(state_dir, 'log'))
+      p = self.make_profile(
+        convert_cb=converter,
+        remember_failures=True,
+        state_dir=state_dir,
+        )
+
+      with self.assertLogs(level='ERROR'):
+        p.generate()
+      self.assertEqual(sorted(converter.calls()), ['a.in', 'bad.in'])
+      self.assertEqual(sorted(os.listdir(self.dst_path())), ['a.in.out'])
+      failure = p.load_failures()['bad.in.out']
+      self.assertEqual(failure['src'], 'bad.in')
+      self.assertEqual(failure['count'], 1)
+      self.assertIn('Bad file', failure['error'])
+
+      # Known failures are skipped, with a warning.
+      with self.assertLogs(level='WARNING') as logs:
+        p.generate()
+      self.assertEqual(len(converter.calls()), 2)
+      self.assertEqual(p.skipped_failures, ['bad.in.out'])
+      self.assertIn('Skipped 1 files', logs.output[0])
+
+      # Until the source changes.
+      os.utime(bad_path, ns=(0, 0))
+      with self.assertLogs(level='ERROR'):
+        p.generate()
+      self.assertEqual(converter.calls()[-1], 'bad.in')
+      self.assertEqual(p.load_failures()['bad.in.out']['count'], 1)
+
+      self.assertEqual(p.clear_failures(), ['bad.in.out'])
+      with self.assertLogs(level='ERROR'):
+        p.generate()
+      self.assertEqual(converter.calls()[-1], 'bad.in')
+
+      # Failures of sources that are gone are forgotten.
+      os.remove(bad_path)
+      p.generate()
+      self.assertEqual(p.load_failures(), {})
+
+  def test_remember_failures_tuple_fingerprint(self):
+    self.write_src('bad.in')
+    with tempfile.TemporaryDirectory() as state_dir:
+      converter = CountingConverter(os.path.join(state_dir, 'log'))
+      def make_profile():
+        return self.make_profile(
+          convert_cb=converter,
+          fingerprint=('oggenc', '-q', 8),
+          remember_failures=True,
+          state_dir=state_dir,
+          )
+
+      with self.assertLogs(level='ERROR'):
+        make_profile().generate()
+      with self.assertLogs(level='WARNING'):
+        make_profile().generate()
+      self.assertEqual(converter.calls(), ['bad.in'])
+
+  def test_failure_backoff(self):
+    self.write_src('bad.in')
+    with tempfile.TemporaryDirectory() as state_dir:
+      converter = CountingConverter(os.path.join(state_dir, 'log'))
+      p = self.make_profile(
+        convert_cb=converter,
+        remember_failures=True,
+        failure_backoff=60,
+        state_dir=state_dir,
+        )
+
+      def generate_after(seconds):
+        p.load_failures()['bad.in.out']['time'] -= seconds
+        with self.assertLogs(level='WARNING'):
+          p.generate()
+        return len(converter.calls())
+
+      with self.assertLogs(level='ERROR'):
+        p.generate()
+      self.assertEqual(generate_after(30), 1)
+      self.assertEqual(generate_after(30), 2)
+      self.assertEqual(p.load_failures()['bad.in.out']['count'], 2)
+      # The wait doubled.
+      self.assertEqual(generate_after(61), 2)
+      self.assertEqual(generate_after(60), 3)
+
+  def test_remember_failures_requires_state_dir(self):
+    self.assertRaisesRegex(
+      ValueError,
+      '^remember_failures requires a state_dir',
+      self.make_profile,
+      remember_failures=True,
+      )
+
+
+class CountingDecoder():
+  """decode_cb that copies the source and counts calls in a file.
+  """
+
+  def __init__(self, count_path):
+    self.count_path = count_path
+
+  def __call__(self, src, dst):
+    with open(self.count_path, 'a') as f:
+      f.write('x')
+    shutil.copyfile(src, dst)
+
+
+def tag_convert_cb(profile, src, dst):
+  with open(src) as f:
+    contents = f.read()
+  with open(dst, 'w') as f:
+    f.write(os.path.basename(profile.dst_path()) + ':' + contents)
+
+
+def multi_convert_cb(src, outputs):
+  for p, dst in outputs:
+    tag_convert_cb(p, src, dst)
+
+
+class TestConvertGroup(
+    unittest.TestCase,
+    test_helper.SrcDstDirMixin,
+    ):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.root = profile.RootProfile(top_dir=self.src_path())
+
+    with open(os.path.join(self.src_path(), 'a.in'), 'w') as f:
+      f.write('a')
+    open(os.path.join(self.src_path(), 'b'), 'w').close()
+
+    self.count_path = os.path.join(self.dst_path(), 'count')
+
+  def tearDown(self):
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def make_members(self, group, member_kwargs=({}, {})):
+    members = []
+    for name, kwargs in zip(('p0', 'p1'), member_kwargs):
+      os.mkdir(os.path.join(self.dst_path(), name))
+      members.append(profile.ConvertProfile(
+        top_dir=os.path.join(self.dst_path(), name),
+        parent=self.root,
+        select_cb=convert_select_cb,
+        convert_cb=tag_convert_cb,
+        convert_group=group,
+        **kwargs))
+    return members
+
+  def read_dst(self, *relpath):
+    with open(os.path.join(self.dst_path(), *relpath)) as f:
+      return f.read()
+
+  def test_decode_once(self):
+    group = profile.ConvertGroup(
+      decode_cb=CountingDecoder(self.count_path))
+    self.make_members(group)
+
+    self.root.generate_all()
+
+    self.assertEqual(self.read_dst('count'), 'x')
+    self.assertEqual(self.read_dst('p0', 'a.in.out'), 'p0:a')
+    self.assertEqual(self.read_dst('p1', 'a.in.out'), 'p1:a')
+    self.assertTrue(os.path.islink(os.path.join(self.dst_path(), 'p1', 'b')))
+
+    # Everything is up to date.
+    self.root.generate_all()
+    self.assertEqual(self.read_dst('count'), 'x')
+
+  def test_only_out_of_date_member(self):
+    group = profile.ConvertGroup(
+      decode_cb=CountingDecoder(self.count_path))
+    p0, p1 = self.make_members(group)
+    self.root.generate_all()
+
+    os.remove(os.path.join(self.dst_path(), 'p1', 'a.in.out'))
+    os.remove(os.path.join(self.dst_path(), 'p0', 'b'))
+    self.root.generate_all()
+
+    self.assertEqual(self.read_dst('count'), 'xx')
+    self.assertTrue(os.path.islink(os.path.join(self.dst_path(), 'p0', 'b')))
+    self.assertEqual(self.read_dst('p1', 'a.in.out'), 'p1:a')
+
+  def test_multi_convert(self):
+    group = profile.ConvertGroup(multi_convert_cb=multi_convert_cb)
+    self.make_members(group)
+
+    self.root.generate_all()
+
+    self.assertEqual(self.read_dst('p0', 'a.in.out'), 'p0:a')
+    self.assertEqual(self.read_dst('p1', 'a.in.out'), 'p1:a')
+
+  def test_generate_member_alone(self):
+    group = profile.ConvertGroup(
+      decode_cb=CountingDecoder(self.count_path))
+    p0, p1 = self.make_members(group)
+    p0.generate()
+    self.assertEqual(self.read_dst('p1', 'a.in.out'), 'p1:a')
+
+    # Outside of generate_all(), each call generates the group again.
+    os.remove(os.path.join(self.dst_path(), 'p1', 'a.in.out'))
+    p1.generate()
+
+    self.assertEqual(self.read_dst('p1', 'a.in.out'), 'p1:a')
+    self.assertEqual(self.read_dst('count'), 'xx')
+
+  def test_executor(self):
+    executor = multiprocessing.pool.ThreadPool(2)
+    self.addCleanup(executor.terminate)
+    group = profile.ConvertGroup(multi_convert_cb=multi_convert_cb)
+    kwargs = {'executor': executor, 'concurrency': 2}
+    self.make_members(group, (kwargs, kwargs))
+
+    with unittest.mock.patch.object(
+        executor, 'apply_async', wraps=executor.apply_async) as apply_async:
+      self.root.generate_all()
+
+    self.assertEqual(apply_async.call_count, 1)
+    self.assertEqual(self.read_dst('p1', 'a.in.out'), 'p1:a')
+
+  def test_settings_mismatch_error(self):
+    group = profile.ConvertGroup(multi_convert_cb=multi_convert_cb)
+    self.make_members(group, ({'concurrency': 1}, {'concurrency': 2}))
+
+    self.assertRaisesRegex(
+      ValueError,
+      'different concurrency',
+      self.root.generate_all,
+      )
+
+  def test_time_budget_error(self):
+    group = profile.ConvertGroup(multi_convert_cb=multi_convert_cb)
+    self.make_members(group)
+
+    self.assertRaisesRegex(
+      ValueError,
+      'time budgets',
+      self.root.generate_all,
+      time_budget=60,
+      )
+
+  def test_not_siblings_error(self):
+    group = profile.ConvertGroup(multi_convert_cb=multi_convert_cb)
+    profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=convert_select_cb,
+      convert_group=group,
+      )
+
+    self.assertRaisesRegex(
+      ValueError,
+      ' is not a sibling of ',
+      profile.ConvertProfile,
+      top_dir=self.dst_path(),
+      parent=profile.RootProfile(top_dir=self.src_path()),
+      select_cb=convert_select_cb,
+      convert_group=group,
+      )
+
+
+def tree_contents(top_dir):
+  """Get a dict describing every entry under a directory.
+  """
+
+  contents = {}
+  for dirpath, dirnames, filenames in os.walk(top_dir):
+    for name in dirnames + filenames:
+      path = os.path.join(dirpath, name)
+      relpath = os.path.relpath(path, top_dir)
+      if os.path.islink(path):
+        contents[relpath] = ('link', os.readlink(path))
+      elif os.path.isdir(path):
+        contents[relpath] = ('dir',)
+      else:
+        with open(path) as f:
+          contents[relpath] = ('file', f.read())
+  return contents
+
+
+class TestScopedGenerate(
+    unittest.TestCase,
+    test_helper.SrcDstDirMixin,
+    ):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.root = profile.RootProfile(top_dir=self.src_path())
+    self.sanitized_dir = os.path.join(self.dst_path(), 'sanitized')
+    os.mkdir(self.sanitized_dir)
+    self.sanitized = profile.SanitizeFilenameProfile(
+      top_dir=self.sanitized_dir,
+      parent=self.root,
+      )
+    self.converted_dir = os.path.join(self.dst_path(), 'converted')
+    os.mkdir(self.converted_dir)
+    self.converter = CountingConverter(
+      os.path.join(self.dst_path(), 'calls'))
+    self.converted = profile.ConvertProfile(
+      top_dir=self.converted_dir,
+      parent=self.sanitized,
+      select_cb=convert_select_cb,
+      convert_cb=self.converter,
+      )
+
+    self.write_src(os.path.join('artist', 'old', '1.in'), '1')
+    self.write_src(os.path.join('artist', 'old', 'cover'))
+    self.root.generate_all()
+    os.remove(self.converter.log_path)
+
+  def tearDown(self):
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def write_src(self, relpath, contents=''):
+    path = os.path.join(self.src_path(), relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(contents)
+
+  def assert_same_as_full(self):
+    scoped = (
+      tree_contents(self.sanitized_dir),
+      tree_contents(self.converted_dir),
+      )
+    self.root.generate_all()
+    self.assertEqual(
+      scoped,
+      (
+        tree_contents(self.sanitized_dir),
+        tree_contents(self.converted_dir),
+        ),
+      )
+
+  def test_add(self):
+    self.write_src(os.path.join('artist', 'new:', '2.in'), '2')
+    self.write_src(os.path.join('artist', 'new:', 'cover'))
+    self.write_src(os.path.join('other', '3.in'), '3')
+
+    self.root.generate_all(relpaths=[os.path.join('artist', 'new:')])
+
+    self.assertEqual(self.converter.calls(), ['2.in'])
+    self.assertEqual(
+      sorted(os.listdir(os.path.join(self.converted_dir, 'artist'))),
+      ['new_', 'old'])
+    self.assertFalse(
+      os.path.exists(os.path.join(self.converted_dir, 'other')))
+
+    os.remove(os.path.join(self.src_path(), 'other', '3.in'))
+    os.rmdir(os.path.join(self.src_path(), 'other'))
+    self.assert_same_as_full()
+
+  def test_file(self):
+    self.write_src(os.path.join('artist', 'old', '1.in'), 'changed')
+    self.write_src(os.path.join('artist', 'old', '2.in'), '2')
+
+    self.root.generate_all(relpaths=[os.path.join('artist', 'old', '1.in')])
+
+    self.assertEqual(self.converter.calls(), ['1.in'])
+    self.assertFalse(os.path.exists(
+      os.path.join(self.converted_dir, 'artist', 'old', '2.in.out')))
+
+  def test_delete(self):
+    self.write_src(os.path.join('artist', 'new', '2.in'), '2')
+    self.root.generate_all()
+    shutil.rmtree(os.path.join(self.src_path(), 'artist', 'old'))
+
+    self.root.generate_all(
+      relpaths=[os.path.join('artist', 'old', 'cover')])
+
+    self.assertEqual(
+      os.listdir(os.path.join(self.converted_dir, 'artist')),
+      ['new'])
+    self.assert_same_as_full()
+
+  def test_delete_last(self):
+    shutil.rmtree(os.path.join(self.src_path(), 'artist'))
+
+    self.root.generate_all(relpaths=[os.path.join('artist', 'old')])
+
+    self.assertEqual(os.listdir(self.sanitized_dir), [])
+    self.assertEqual(os.listdir(self.converted_dir), [])
+
+  def test_resume_error(self):
+    self.assertRaises(
+      ValueError,
+      self.root.generate_all,
+      resume=True,
+      relpaths=['artist'],
+      )
+
+
+class TestJournal(
+    unittest.TestCase,
+    test_helper.SrcDstDirMixin,
+    ):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.state = tempfile.TemporaryDirectory()
+    self.journal_path = os.path.join(self.state.name, 'journal')
+    self.root = profile.RootProfile(top_dir=self.src_path())
+
+  def tearDown(self):
+    self.state.cleanup()
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def write_src(self, relpath, contents=''):
+    path = os.path.join(self.src_path(), relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(contents)
+    return path
+
+  def last_run(self):
+    header, changes = list(changelog.read(self.journal_path))[-1]
+    return header['complete'], [
+      (change['path'], change['change'], change['type'])
+      for change in changes
+      ]
+
+  def test_filter(self):
+    self.write_src(os.path.join('dir', 'a'))
+    self.write_src('b')
+    p = profile.FilterProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=keep_all_select_cb,
+      journal=changelog.Journal(self.journal_path),
+      )
+
+    self.root.generate_all()
+    self.assertEqual(self.last_run(), (True, [
+      ('b', changelog.ADDED, changelog.SYMLINK),
+      ('dir', changelog.ADDED, changelog.DIR),
+      (os.path.join('dir', 'a'), changelog.ADDED, changelog.SYMLINK),
+      ]))
+
+    # The whole tree is rebuilt, but nothing changed.
+    self.root.generate_all()
+    self.assertEqual(self.last_run(), (True, []))
+
+    os.remove(os.path.join(self.src_path(), 'b'))
+    self.write_src(os.path.join('dir', 'c'))
+    self.root.generate_all()
+    self.assertEqual(self.last_run(), (True, [
+      ('b', changelog.REMOVED, changelog.SYMLINK),
+      (os.path.join('dir', 'c'), changelog.ADDED, changelog.SYMLINK),
+      ]))
+
+    shutil.rmtree(os.path.join(self.src_path(), 'dir'))
+    self.root.generate_all(relpaths=['dir'])
+    self.assertEqual(self.last_run(), (True, [
+      ('dir', changelog.REMOVED, changelog.DIR),
+      (os.path.join('dir', 'a'), changelog.REMOVED, changelog.SYMLINK),
+      (os.path.join('dir', 'c'), changelog.REMOVED, changelog.SYMLINK),
+      ]))
+
+  def test_filter_threads(self):
+    expected = []
+    for i in range(8):
+      dir_relpath = os.path.join('dir%d' % i, 'sub')
+      expected.append(('dir%d' % i, changelog.ADDED, changelog.DIR))
+      expected.append((dir_relpath, changelog.ADDED, changelog.DIR))
+      for name in ('a', 'b', 'c'):
+        self.write_src(os.path.join(dir_relpath, name))
+        expected.append(
+          (os.path.join(dir_relpath, name), changelog.ADDED,
+            changelog.SYMLINK))
+    profile.FilterProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=keep_all_select_cb,
+      journal=changelog.Journal(self.journal_path),
+      threads=4,
+      )
+
+    self.root.generate_all()
+
+    self.assertEqual(self.last_run(), (True, sorted(expected)))
+
+  def test_convert(self):
+    self.write_src(os.path.join('dir', 'a.in'), 'a')
+    self.write_src('b')
+    p = profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=convert_select_cb,
+      convert_cb=copy_convert_cb,
+      journal=changelog.Journal(self.journal_path),
+      )
+
+    self.root.generate_all()
+    self.assertEqual(self.last_run(), (True, [
+      ('b', changelog.ADDED, changelog.SYMLINK),
+      ('dir', changelog.ADDED, changelog.DIR),
+      (os.path.join('dir', 'a.in.out'), changelog.ADDED, changelog.FILE),
+      ]))
+
+    self.root.generate_all()
+    self.assertEqual(self.last_run(), (True, []))
+
+    os.utime(os.path.join(self.src_path(), 'dir', 'a.in'), ns=(0, 0))
+    self.root.generate_all()
+    self.assertEqual(self.last_run(), (True, [
+      (os.path.join('dir', 'a.in.out'), changelog.MODIFIED, changelog.FILE),
+      ]))
+
+  def test_failed_run(self):
+    self.write_src('bad.in')
+    self.write_src('b')
+    p = profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=convert_select_cb,
+      convert_cb=copy_convert_cb,
+      journal=changelog.Journal(self.journal_path),
+      )
+
+    self.assertRaises(ValueError, self.root.generate_all)
+
+    self.assertEqual(self.last_run(), (False, [
+      ('b', changelog.ADDED, changelog.SYMLINK),
+      ]))
+
+  def test_union(self):
+    other = tempfile.TemporaryDirectory()
+    self.addCleanup(other.cleanup)
+    self.write_src('a')
+    open(os.path.join(other.name, 'b'), 'w').close()
+    p = profile.UnionProfile(
+      top_dir=self.dst_path(),
+      parents=[self.root, profile.RootProfile(top_dir=other.name)],
+      journal=changelog.Journal(self.journal_path),
+      )
+
+    self.root.generate_all()
+    self.assertEqual(self.last_run(), (True, [
+      ('a', changelog.ADDED, changelog.SYMLINK),
+      ('b', changelog.ADDED, changelog.SYMLINK),
+      ]))
+
+    os.remove(os.path.join(other.name, 'b'))
+    self.root.generate_all()
+    self.assertEqual(self.last_run(), (True, [
+      ('b', changelog.REMOVED, changelog.SYMLINK),
+      ]))
+
+
+class TestTrash(
+    unittest.TestCase,
+    test_helper.SrcDstDirMixin,
+    ):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.state = tempfile.TemporaryDirectory()
+    self.trash_dir = os.path.join(self.state.name, 'trash')
+    self.root = profile.RootProfile(top_dir=self.src_path())
+
+  def tearDown(self):
+    self.state.cleanup()
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def write_src(self, relpath, contents=''):
+    path = os.path.join(self.src_path(), relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(contents)
+    return path
+
+  def test_filter(self):
+    self.write_src(os.path.join('dir', 'sub', 'a'))
+    self.write_src('b')
+    p = profile.FilterProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=keep_all_select_cb,
+      trash_dir=self.trash_dir,
+      )
+    self.root.generate_all()
+    p.wait_for_trash()
+
+    shutil.rmtree(os.path.join(self.src_path(), 'dir'))
+    # Don't delete anything in the background yet.
+    with unittest.mock.patch.object(profile._Trash, 'empty'):
+      self.root.generate_all()
+    self.assertEqual(os.listdir(self.dst_path()), ['b'])
+    (trashed,) = os.listdir(self.trash_dir)
+    self.assertEqual(
+      os.listdir(os.path.join(self.trash_dir, trashed)),
+      ['sub'],
+      )
+
+    # The next run deletes what's left in the trash.
+    self.root.generate_all()
+    p.wait_for_trash()
+    self.assertEqual(os.listdir(self.trash_dir), [])
+    self.assertEqual(os.listdir(self.dst_path()), ['b'])
+    self.assertTrue(os.path.exists(os.path.join(self.src_path(), 'b')))
+
+  def test_filter_keeps_files(self):
+    self.write_src(os.path.join('dir', 'a'))
+    p = profile.FilterProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=keep_all_select_cb,
+      trash_dir=self.trash_dir,
+      )
+    self.root.generate_all()
+    with open(os.path.join(self.dst_path(), 'dir', 'stray'), 'w') as f:
+      f.write('stray')
+
+    shutil.rmtree(os.path.join(self.src_path(), 'dir'))
+    with self.assertLogs(level='ERROR'):
+      self.root.generate_all()
+      p.wait_for_trash()
+
+    self.assertEqual(os.listdir(self.dst_path()), [])
+    (trashed,) = os.listdir(self.trash_dir)
+    self.assertEqual(
+      os.listdir(os.path.join(self.trash_dir, trashed)),
+      ['stray'],
+      )
+
+  def test_convert(self):
+    self.write_src(os.path.join('dir', 'sub', 'a.in'), 'a')
+    self.write_src(os.path.join('dir', 'b'))
+    self.write_src('c.in', 'c')
+    journal_path = os.path.join(self.state.name, 'journal')
+    p = profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=convert_select_cb,
+      convert_cb=copy_convert_cb,
+      journal=changelog.Journal(journal_path),
+      trash_dir=self.trash_dir,
+      )
+    self.root.generate_all()
+
+    shutil.rmtree(os.path.join(self.src_path(), 'dir'))
+    with unittest.mock.patch.object(
+        profile.os,
+        'remove',
+        side_effect=AssertionError('Deleted in place'),
+        ):
+      self.root.generate_all()
+    self.assertEqual(os.listdir(self.dst_path()), ['c.in.out'])
+
+    p.wait_for_trash()
+    self.assertEqual(os.listdir(self.trash_dir), [])
+    header, changes = list(changelog.read(journal_path))[-1]
+    self.assertEqual(
+      [(change['path'], change['change']) for change in changes],
+      [
+        ('dir', changelog.REMOVED),
+        (os.path.join('dir', 'b'), changelog.REMOVED),
+        (os.path.join('dir', 'sub'), changelog.REMOVED),
+        (os.path.join('dir', 'sub', 'a.in.out'), changelog.REMOVED),
+        ],
+      )
+
+  def test_leftovers(self):
+    os.makedirs(os.path.join(self.trash_dir, 'old', 'dir'))
+    p = profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=convert_select_cb,
+      convert_cb=copy_convert_cb,
+      trash_dir=self.trash_dir,
+      )
+
+    self.root.generate_all()
+    p.wait_for_trash()
+
+    self.assertEqual(os.listdir(self.trash_dir), [])
+
+  def test_add_while_emptying(self):
+    trash = profile._Trash(self.trash_dir, False, lambda *args: None)
+
+    for i in range(50):
+      path = os.path.join(self.dst_path(), 'dir')
+      os.makedirs(os.path.join(path, 'sub'))
+      self.assertTrue(trash.add(path))
+    trash.wait()
+
+    self.assertEqual(os.listdir(self.trash_dir), [])
+
+  def test_other_filesystem(self):
+    self.write_src(os.path.join('dir', 'a.in'))
+    p = profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      select_cb=convert_select_cb,
+      convert_cb=copy_convert_cb,
+      trash_dir=self.trash_dir,
+      )
+    self.root.generate_all()
+
+    shutil.rmtree(os.path.join(self.src_path(), 'dir'))
+    with unittest.mock.patch.object(
+        profile.os,
+        'rename',
+        side_effect=OSError(errno.EXDEV, 'Invalid cross-device link'),
+        ), self.assertLogs(level='WARNING'):
+      self.root.generate_all()
+
+    self.assertEqual(os.listdir(self.dst_path()), [])
+    self.assertEqual(os.listdir(self.trash_dir), [])
+
+
+def last_conflict_cb(profile, relpath, candidates):
+  return candidates[-1][0]
+
+
+class TestUnionProfile(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.roots = []
+    for name in ('lossless', 'lossy'):
+      os.mkdir(os.path.join(self.dir.name, name))
+      self.roots.append(profile.RootProfile(
+        top_dir=os.path.join(self.dir.name, name)))
+    self.union_dir = os.path.join(self.dir.name, 'union')
+    os.mkdir(self.union_dir)
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def make_profile(self, **kwargs):
+    return profile.UnionProfile(
+      top_dir=self.union_dir,
+      parents=self.roots,
+      **kwargs)
+
+  def write(self, root, relpath, contents=''):
+    path = os.path.join(self.dir.name, root, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(contents)
+
+  def target(self, root, relpath):
+    return os.path.relpath(
+      os.path.join(self.dir.name, root, relpath),
+      os.path.dirname(os.path.join(self.union_dir, relpath)),
+      )
+
+  def test_merge(self):
+    self.write('lossless', os.path.join('a', 'x'))
+    self.write('lossy', os.path.join('a', 'y'))
+    self.write('lossy', 'b')
+    self.write('lossless', 'c')
+    self.write('lossy', 'c')
+    self.write('lossless', 'd')
+    self.write('lossy', os.path.join('d', 'z'))
+    os.mkdir(os.path.join(self.dir.name, 'lossy', 'empty'))
+    os.utime(os.path.join(self.dir.name, 'lossless', 'a'), (0, 0))
+
+    self.make_profile().generate()
+
+    self.assertEqual(
+      tree_contents(self.union_dir),
+      {
+        'a': ('dir',),
+        os.path.join('a', 'x'):
+          ('link', self.target('lossless', os.path.join('a', 'x'))),
+        os.path.join('a', 'y'):
+          ('link', self.target('lossy', os.path.join('a', 'y'))),
+        'b': ('link', self.target('lossy', 'b')),
+        'c': ('link', self.target('lossless', 'c')),
+        'd': ('link', self.target('lossless', 'd')),
+        'empty': ('dir',),
+        },
+      )
+    self.assertEqual(
+      test_helper.get_preserved_attrs(
+        os.path.join(self.dir.name, 'lossless', 'a')),
+      test_helper.get_preserved_attrs(os.path.join(self.union_dir, 'a')),
+      )
+
+  def test_conflict_cb(self):
+    self.write('lossless', 'c')
+    self.write('lossy', 'c')
+    self.write('lossless', 'd')
+    self.write('lossy', os.path.join('d', 'z'))
+
+    self.make_profile(conflict_cb=last_conflict_cb).generate()
+
+    self.assertEqual(
+      tree_contents(self.union_dir),
+      {
+        'c': ('link', self.target('lossy', 'c')),
+        'd': ('dir',),
+        os.path.join('d', 'z'):
+          ('link', self.target('lossy', os.path.join('d', 'z'))),
+        },
+      )
+
+  def test_incremental(self):
+    self.write('lossless', os.path.join('a', 'x'))
+    self.write('lossy', os.path.join('a', 'y'))
+    self.write('lossy', os.path.join('b', 'z'))
+    p = self.make_profile()
+    p.generate()
+    x_ino = os.lstat(os.path.join(self.union_dir, 'a', 'x')).st_ino
+
+    os.remove(os.path.join(self.dir.name, 'lossy', 'a', 'y'))
+    shutil.rmtree(os.path.join(self.dir.name, 'lossy', 'b'))
+    self.write('lossless', 'b')
+    self.write('lossy', os.path.join('a', 'w'))
+    totals = p.plan().totals()
+    self.assertEqual(totals[planning.REMOVE], 2)
+    self.assertEqual(totals[planning.LINK], 2)
+
+    p.generate()
+
+    self.assertEqual(
+      tree_contents(self.union_dir),
+      {
+        'a': ('dir',),
+        os.path.join('a', 'w'):
+          ('link', self.target('lossy', os.path.join('a', 'w'))),
+        os.path.join('a', 'x'):
+          ('link', self.target('lossless', os.path.join('a', 'x'))),
+        'b': ('link', self.target('lossless', 'b')),
+        },
+      )
+    self.assertEqual(
+      os.lstat(os.path.join(self.union_dir, 'a', 'x')).st_ino, x_ino)
+    self.assertEqual(p.plan().actions, [])
+
+  def test_scoped(self):
+    self.write('lossless', os.path.join('a', 'x'))
+    p = self.make_profile()
+    p.generate()
+
+    self.write('lossy', os.path.join('a', 'y'))
+    self.write('lossy', os.path.join('new', 'z'))
+    self.write('lossless', 'unscoped')
+
+    self.assertEqual(
+      p.generate(relpaths=[
+        os.path.join('a', 'y'), os.path.join('new', 'z')]),
+      [os.path.join('a', 'y'), os.path.join('new', 'z')],
+      )
+
+    self.assertEqual(
+      sorted(tree_contents(self.union_dir)),
+      [
+        'a',
+        os.path.join('a', 'x'),
+        os.path.join('a', 'y'),
+        'new',
+        os.path.join('new', 'z'),
+        ],
+      )
+
+  def test_child_of_every_parent(self):
+    self.write('lossless', 'x')
+    p = self.make_profile()
+    self.assertIn(p, self.roots[0]._children)
+    self.assertIn(p, self.roots[1]._children)
+
+    self.roots[1].generate_all()
+
+    self.assertEqual(os.listdir(self.union_dir), ['x'])
+
+  def test_shared_ancestor(self):
+    self.write('lossless', 'x')
+    filters = []
+    for name in ('a', 'b', 'child'):
+      os.mkdir(os.path.join(self.dir.name, name))
+    for name in ('a', 'b'):
+      filters.append(profile.FilterProfile(
+        top_dir=os.path.join(self.dir.name, name),
+        parent=self.roots[0],
+        select_cb=keep_all_select_cb,
+        ))
+    p = profile.UnionProfile(top_dir=self.union_dir, parents=filters)
+    child = profile.FilterProfile(
+      top_dir=os.path.join(self.dir.name, 'child'),
+      parent=p,
+      select_cb=keep_all_select_cb,
+      )
+    self.assertEqual(
+      self.roots[0]._walk(),
+      [(self.roots[0], 0), (filters[0], 1), (filters[1], 1), (p, 2),
+        (child, 3)],
+      )
+
+    # Listings of the parents when the union is generated.
+    calls = []
+    generate = profile.UnionProfile.generate
+    def generate_cb(self, *args, **kwargs):
+      calls.append([
+        os.listdir(self.parent_path(index))
+        for index in range(len(filters))
+        ])
+      return generate(self, *args, **kwargs)
+    with unittest.mock.patch.object(
+        profile.UnionProfile,
+        'generate',
+        autospec=True,
+        side_effect=generate_cb,
+        ):
+      self.roots[0].generate_all()
+
+    self.assertEqual(calls, [[['x'], ['x']]])
+    self.assertEqual(
+      os.listdir(os.path.join(self.dir.name, 'child')), ['x'])
+
+  def test_clean_error_file(self):
+    with open(os.path.join(self.union_dir, 'file'), 'w'):
+      pass
+
+    self.assertRaisesRegex(
+      RuntimeError,
+      '^Cannot clean ',
+      self.make_profile().generate,
+      )
+
+
+class TestMaterializeProfile(
+    unittest.TestCase,
+    test_helper.SrcDstDirMixin,
+    ):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.root = profile.RootProfile(top_dir=self.src_path())
+    self.links_dir = os.path.join(self.dst_path(), 'links')
+    os.mkdir(self.links_dir)
+    self.links = profile.FilterProfile(
+      top_dir=self.links_dir,
+      parent=self.root,
+      select_cb=keep_all_select_cb,
+      )
+
+    os.mkdir(os.path.join(self.src_path(), 'dir'))
+    self.src_file = os.path.join(self.src_path(), 'dir', 'file')
+    with open(self.src_file, 'w') as f:
+      f.write('contents')
+
+  def tearDown(self):
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def make_profile(self, **kwargs):
+    top_dir = os.path.join(self.dst_path(), 'materialized')
+    os.makedirs(top_dir, exist_ok=True)
+    self.dst_file = os.path.join(top_dir, 'dir', 'file')
+    return profile.MaterializeProfile(
+      top_dir=top_dir,
+      parent=self.links,
+      **kwargs)
+
+  def read_dst(self):
+    with open(self.dst_file) as f:
+      return f.read()
+
+  def test_hardlink(self):
+    self.make_profile()
+
+    self.root.generate_all()
+
+    self.assertFalse(os.path.islink(self.dst_file))
+    self.assertTrue(os.path.samefile(self.src_file, self.dst_file))
+
+  def test_copy(self):
+    self.make_profile(link_mode='copy')
+
+    self.root.generate_all()
+
+    self.assertFalse(os.path.islink(self.dst_file))
+    self.assertFalse(os.path.samefile(self.src_file, self.dst_file))
+    self.assertEqual(self.read_dst(), 'contents')
+    self.assertEqual(
+      test_helper.get_preserved_attrs(self.src_file),
+      test_helper.get_preserved_attrs(self.dst_file),
+      )
+
+  def test_only_changed(self):
+    self.make_profile(link_mode='copy')
+    self.root.generate_all()
+    inode = os.stat(self.dst_file).st_ino
+
+    self.root.generate_all()
+    self.assertEqual(os.stat(self.dst_file).st_ino, inode)
+
+    # Same mtime, different size.
+    stat = os.stat(self.src_file)
+    with open(self.src_file, 'w') as f:
+      f.write('changed')
+    os.utime(self.src_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    self.root.generate_all()
+    self.assertEqual(self.read_dst(), 'changed')
+
+  def test_mode_change_unlinks(self):
+    p = self.make_profile()
+    self.root.generate_all()
+
+    self.links._children.remove(p)
+    self.make_profile(link_mode='reflink')
+    self.root.generate_all()
+
+    self.assertFalse(os.path.samefile(self.src_file, self.dst_file))
+    self.assertEqual(self.read_dst(), 'contents')
+
+  def test_clean(self):
+    self.make_profile()
+    self.root.generate_all()
+
+    os.remove(self.src_file)
+    self.root.generate_all()
+
+    self.assertFalse(os.path.lexists(self.dst_file))
+
+  def test_plan(self):
+    p = self.make_profile()
+    self.links.generate()
+
+    plan = p.plan()
+
+    self.assertEqual(plan.totals()[planning.COPY], 1)
+    self.assertEqual(plan.totals()['copy_bytes'], len('contents'))
+
+  def test_unknown_link_mode_error(self):
+    self.assertRaisesRegex(
+      ValueError,
+      '^Unknown link_mode ',
+      self.make_profile,
+      link_mode='symlink',
+      )
+
+
+class TestMaterializer(
+    unittest.TestCase,
+    test_helper.SrcDstDirMixin,
+    ):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.src = os.path.join(self.src_path(), 'file')
+    with open(self.src, 'w') as f:
+      f.write('contents')
+    self.dst = os.path.join(self.dst_path(), 'file')
+
+  def tearDown(self):
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def test_fallback_to_copy(self):
+    materializer = profile._Materializer('auto')
+    error = OSError(errno.EXDEV, 'Cross-device link')
+
+    with unittest.mock.patch.object(os, 'link', side_effect=error), \
+        unittest.mock.patch.object(
+          profile.util, 'reflink', side_effect=error):
+      self.assertEqual(materializer.materialize(self.src, self.dst), 'copy')
+      os.remove(self.dst)
+      self.assertEqual(materializer.materialize(self.src, self.dst), 'copy')
+      self.assertEqual(os.link.call_count, 1)
+      self.assertEqual(profile.util.reflink.call_count, 1)
+
+    with open(self.dst) as f:
+      self.assertEqual(f.read(), 'contents')
+
+  def test_per_file_eperm(self):
+    materializer = profile._Materializer('auto')
+    real_link = os.link
+    calls = []
+
+    def link(src, dst):
+      calls.append(dst)
+      if len(calls) == 1:
+        raise OSError(errno.EPERM, 'Operation not permitted')
+      real_link(src, dst)
+
+    with unittest.mock.patch.object(os, 'link', side_effect=link):
+      self.assertIn(
+        materializer.materialize(self.src, self.dst), ('reflink', 'copy'))
+      os.remove(self.dst)
+      # Hardlinks are still tried for other files.
+      self.assertEqual(
+        materializer.materialize(self.src, self.dst), 'hardlink')
+
+    self.assertEqual(len(calls), 2)
+
+
+class TestSyncProfile(
+    unittest.TestCase,
+    test_helper.SrcDstDirMixin,
+    ):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.root = profile.RootProfile(top_dir=self.src_path())
+
+    os.mkdir(os.path.join(self.src_path(), 'album'))
+    self.src_file = os.path.join(self.src_path(), 'album', 'track')
+    with open(self.src_file, 'w') as f:
+      f.write('contents')
+    self.dst_file = os.path.join(self.dst_path(), 'album', 'track')
+
+  def tearDown(self):
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def make_profile(self, **kwargs):
+    return profile.SyncProfile(
+      top_dir=self.dst_path(),
+      parent=self.root,
+      **kwargs)
+
+  def set_src_mtime(self, delta_ns):
+    stat = os.stat(self.src_file)
+    os.utime(
+      self.src_file,
+      ns=(stat.st_atime_ns, stat.st_mtime_ns + delta_ns),
+      )
+
+  def test_copy_and_delete(self):
+    p = self.make_profile()
+
+    p.generate()
+    self.assertFalse(os.path.samefile(self.src_file, self.dst_file))
+    self.assertEqual(
+      test_helper.get_preserved_attrs(self.src_file),
+      test_helper.get_preserved_attrs(self.dst_file),
+      )
+
+    os.remove(self.src_file)
+    p.generate()
+    self.assertEqual(os.listdir(os.path.join(self.dst_path(), 'album')), [])
+
+  def test_mtime_tolerance(self):
+    p = self.make_profile(mtime_tolerance=2.0)
+    p.generate()
+    inode = os.stat(self.dst_file).st_ino
+
+    self.set_src_mtime(10**9)
+    p.generate()
+    self.assertEqual(os.stat(self.dst_file).st_ino, inode)
+
+    self.set_src_mtime(2 * 10**9)
+    p.generate()
+    self.assertEqual(
+      os.stat(self.src_file).st_mtime_ns,
+      os.stat(self.dst_file).st_mtime_ns,
+      )
+
+  def test_checksum(self):
+    p = self.make_profile(checksum=True)
+    p.generate()
+    inode = os.stat(self.dst_file).st_ino
+
+    self.set_src_mtime(10**9)
+    plan = p.plan()
+    self.assertEqual(
+      [action for action, relpath, details in plan.actions],
+      [planning.COPYSTAT],
+      )
+    p.generate()
+
+    self.assertEqual(os.stat(self.dst_file).st_ino, inode)
+    self.assertEqual(
+      os.stat(self.src_file).st_mtime_ns,
+      os.stat(self.dst_file).st_mtime_ns,
+      )
+
+  def test_copy_stats_without_permissions(self):
+    p = self.make_profile()
+    p.generate()
+    self.set_src_mtime(10**9)
+
+    error = OSError(errno.EPERM, 'Operation not permitted')
+    with unittest.mock.patch.object(
+        profile.shutil, 'copystat', side_effect=error):
+      p.copy_stats(self.src_file, self.dst_file)
+
+    self.assertEqual(
+      os.stat(self.src_file).st_mtime_ns,
+      os.stat(self.dst_file).st_mtime_ns,
+      )
+
+  def test_scoped(self):
+    p = self.make_profile()
+    p.generate()
+    os.mkdir(os.path.join(self.src_path(), 'new'))
+    open(os.path.join(self.src_path(), 'new', 'track'), 'w').close()
+    os.remove(self.src_file)
+
+    p.generate(relpaths=['new'])
+
+    self.assertTrue(os.path.exists(self.dst_file))
+    self.assertTrue(
+      os.path.exists(os.path.join(self.dst_path(), 'new', 'track')))
@@ -0,0 +1,149 @@
+import os
+import tempfile
+import unittest
+
+from . import profile
+from . import readme_example
+from . import rules
+from . import test_helper
+
+
+class TestExtension(unittest.TestCase):
+  def test_matches_splitext(self):
+    for name in (
+        'a.flac',
+        'a.b.flac',
+        'a',
+        'a.',
+        'a..',
+        '.flac',
+        '..flac',
+        '...',
+        '.a.flac',
+        '..a.flac',
+        '',
+        ):
+      with self.subTest(name=name):
+        self.assertEqual(
+          rules._extension(name),
+          os.path.splitext(name)[1][1:],
+          )
+
+
+class TestFilterRules(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def make_files(self, names):
+    for name in names:
+      open(os.path.join(self.dir.name, name), 'w').close()
+    return sorted(os.scandir(self.dir.name), key=lambda e: e.name)
+
+  def select(self, select_cb, contents, src_relpath=''):
+    return sorted(
+      entry.name
+      for entry in select_cb(None, src_relpath, src_relpath, contents))
+
+  def test_matches_readme(self):
+    file_sets = [
+      ['01.flac', '02.FLAC', 'a.cue', 'notes.txt', 'video.mkv'],
+      ['back.jpg', 'front.jpg', 'cover.png', '01.ogg'],
+      ['cover.x.png', 'booklet.png', 'x.gif', '01.mp3'],
+      ['back.jpeg', 'scan.tif', 'other.bmp'],
+      ['img.bmp', 'img2.bmp', 'README'],
+      ]
+    for names in file_sets:
+      with self.subTest(names=names):
+        for entry in os.scandir(self.dir.name):
+          os.remove(entry.path)
+        contents = self.make_files(names)
+        self.assertEqual(
+          self.select(readme_example.select_cb, contents),
+          self.select(readme_example.select_rules, contents),
+          )
+
+  def test_globs(self):
+    select_cb = rules.FilterRules(
+      [
+        rules.Rule(rules.SKIP, globs=['.*', '*~']),
+        rules.Rule(rules.KEEP, globs=['[!x]*.log']),
+        rules.Rule(rules.SKIP, extensions=['log']),
+        ],
+      )
+    contents = self.make_files(
+      ['.hidden', 'foo~', 'a.log', 'x.log', 'b.txt'])
+    self.assertEqual(
+      self.select(select_cb, contents),
+      ['a.log', 'b.txt'],
+      )
+
+  def test_size_and_depth(self):
+    select_cb = rules.FilterRules(
+      [
+        rules.Rule(rules.SKIP, extensions=['bin'], min_size=2),
+        rules.Rule(rules.SKIP, extensions=['txt'], max_depth=0),
+        ],
+      )
+    with open(os.path.join(self.dir.name, 'big.bin'), 'w') as f:
+      f.write('xx')
+    contents = self.make_files(['small.bin', 'a.txt'])
+    self.assertEqual(self.select(select_cb, contents), ['small.bin'])
+    self.assertEqual(
+      self.select(select_cb, contents, src_relpath='sub'),
+      ['a.txt', 'small.bin'],
+      )
+
+  def test_unknown_action(self):
+    select_cb = rules.FilterRules([rules.Rule('bogus')])
+    contents = self.make_files(['a'])
+    self.assertRaisesRegex(
+      ValueError,
+      '^Unknown action ',
+      select_cb,
+      None,
+      '',
+      '',
+      contents,
+      )
+
+
+class TestConvertRules(unittest.TestCase, test_helper.SrcDstDirMixin):
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.profile = profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=profile.RootProfile(top_dir=self.src_path()),
+      select_cb=rules.ConvertRules(
+        [
+          rules.Rule('.ogg', extensions=['flac']),
+          rules.Rule('.small.jpg', extensions=['jpg'], min_size=1),
+          ],
+        ),
+      convert_cb=None,
+      )
+
+  def tearDown(self):
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def test_select(self):
+    os.mkdir(os.path.join(self.src_path(), 'dir'))
+    with open(os.path.join(self.src_path(), 'dir', 'big.jpg'), 'w') as f:
+      f.write('x')
+    open(os.path.join(self.src_path(), 'dir', 'empty.jpg'), 'w').close()
+
+    select_cb = self.profile.select_cb
+    self.assertEqual(
+      select_cb(self.profile, os.path.join('dir', 'a.flac')),
+      os.path.join('dir', 'a.flac.ogg'),
+      )
+    self.assertEqual(
+      select_cb(self.profile, os.path.join('dir', 'big.jpg')),
+      os.path.join('dir', 'big.jpg.small.jpg'),
+      )
+    self.assertIsNone(
+      select_cb(self.profile, os.path.join('dir', 'empty.jpg')))
+    self.assertIsNone(select_cb(self.profile, 'a.txt'))
@@ -0,0 +1,153 @@
+import multiprocessing.pool
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from . import schedule
+
+
+class TestReadCpuTimes(unittest.TestCase):
+  def test_parse(self):
+    with tempfile.NamedTemporaryFile('w') as f:
+      f.write('cpu  10 0 20 60 10 0 0 0 0 0\ncpu0 1 2 3 4 5\n')
+      f.flush()
+      self.assertEqual(schedule.read_cpu_times(f.name), (10, 100))
+
+  def test_missing(self):
+    self.assertIsNone(schedule.read_cpu_times('/nonexistent'))
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+  def setUp(self):
+    self.now = 0.0
+    self.load = 0.0
+    self.cpu_times = (0, 0)
+
+    self.concurrency = schedule.AdaptiveConcurrency(
+      min_jobs=1,
+      max_jobs=4,
+      max_load=4.0,
+      max_iowait=0.5,
+      interval=1.0,
+      clock=lambda: self.now,
+      read_load_average=lambda: self.load,
+      read_cpu_times=lambda: self.cpu_times,
+      )
+    self.concurrency._limit = 2
+
+  def run_interval(self, jobs, iowait=0, total=100):
+    for i in range(jobs):
+      self.concurrency.job_done()
+    self.now += 1.0
+    self.cpu_times = (
+      self.cpu_times[0] + iowait,
+      self.cpu_times[1] + total,
+      )
+    return self.concurrency.limit
+
+  def test_increase_while_throughput_improves(self):
+    self.assertEqual(self.run_interval(2), 3)
+    self.assertEqual(self.run_interval(3), 4)
+    self.assertEqual(self.run_interval(4), 4)
+
+  def test_reverse_when_throughput_drops(self):
+    self.assertEqual(self.run_interval(4), 3)
+    self.assertEqual(self.run_interval(2), 2)
+    self.assertEqual(self.run_interval(1), 3)
+
+  def test_decrease_on_load(self):
+    self.load = 8.0
+    self.assertEqual(self.run_interval(10), 1)
+    self.assertEqual(self.run_interval(10), 1)
+
+  def test_decrease_on_iowait(self):
+    self.assertEqual(self.run_interval(10, iowait=80), 1)
+
+  def test_no_change_within_interval(self):
+    self.concurrency.job_done()
+    self.now += 0.5
+    self.assertEqual(self.concurrency.limit, 2)
+
+
+class TestDispatcher(unittest.TestCase):
+  def setUp(self):
+    self.pool = multiprocessing.pool.ThreadPool(4)
+    self.lock = threading.Lock()
+    self.running = 0
+    self.max_running = 0
+
+  def tearDown(self):
+    self.pool.terminate()
+
+  def job(self, x, sleep=0.05):
+    with self.lock:
+      self.running += 1
+      self.max_running = max(self.max_running, self.running)
+    time.sleep(sleep)
+    with self.lock:
+      self.running -= 1
+    return x * 2
+
+  def test_limit(self):
+    dispatcher = schedule.Dispatcher(
+      self.pool, schedule.FixedConcurrency(2))
+
+    for i in range(6):
+      self.assertTrue(dispatcher.submit(i, self.job, (i,)))
+    finished, abandoned = dispatcher.finish()
+
+    self.assertEqual(sorted(finished), [(i, i * 2) for i in range(6)])
+    self.assertEqual(abandoned, [])
+    self.assertEqual(self.max_running, 2)
+
+  def test_deadline(self):
+    dispatcher = schedule.Dispatcher(
+      self.pool,
+      schedule.FixedConcurrency(1),
+      deadline=time.monotonic() + 0.5,
+      )
+
+    self.assertTrue(dispatcher.submit('fast', self.job, (1,)))
+    self.assertTrue(dispatcher.submit('slow', self.job, (2, 5)))
+    self.assertFalse(dispatcher.submit('late', self.job, (3,)))
+    finished, abandoned = dispatcher.finish()
+
+    self.assertEqual(finished, [('fast', 2)])
+    self.assertEqual(abandoned, ['slow'])
+
+  def test_callbacks(self):
+    late = []
+    done = threading.Event()
+
+    def abandoned_cb(key, result):
+      late.append((key, result))
+      done.set()
+
+    dispatcher = schedule.Dispatcher(
+      self.pool,
+      schedule.FixedConcurrency(2),
+      deadline=time.monotonic() + 0.5,
+      finished_cb=lambda key, result: result + 1,
+      abandoned_cb=abandoned_cb,
+      )
+
+    self.assertTrue(dispatcher.submit('fast', self.job, (1,)))
+    self.assertTrue(dispatcher.submit('slow', self.job, (2, 1)))
+    finished, abandoned = dispatcher.finish()
+
+    self.assertEqual(finished, [('fast', 3)])
+    self.assertEqual(abandoned, ['slow'])
+    self.assertTrue(done.wait(5))
+    self.assertEqual(late, [('slow', 4)])
+
+
+class TestInitWorker(unittest.TestCase):
+  def test_nice(self):
+    with multiprocessing.Pool(
+        1,
+        initializer=schedule.init_worker,
+        initargs=(1, None),
+        ) as pool:
+      self.assertEqual(pool.apply(os.nice, (0,)), os.nice(0) + 1)
@@ -0,0 +1,230 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+from . import profile
+from . import serve
+from . import test_helper
+
+
+def convert_select_cb(profile, src_relpath):
+  if src_relpath.endswith('.in'):
+    return src_relpath + '.out'
+  return None
+
+
+class UpperConverter():
+  """convert_cb that upper-cases the source, and logs calls to a file.
+  """
+
+  def __init__(self, log_path, delay=0):
+    self.log_path = log_path
+    self.delay = delay
+
+  def __call__(self, profile, src, dst):
+    with open(self.log_path, 'a') as f:
+      f.write(os.path.basename(src) + '\n')
+    time.sleep(self.delay)
+    if os.path.basename(src).startswith('bad'):
+      raise ValueError('Bad file %r' % src)
+    with open(src) as f:
+      contents = f.read()
+    with open(dst, 'w') as f:
+      f.write(contents.upper())
+
+  def calls(self):
+    if not os.path.exists(self.log_path):
+      return []
+    with open(self.log_path) as f:
+      return f.read().split()
+
+
+class LazyConverterMixin(test_helper.SrcDstDirMixin):
+  """Fixture mixin with a source tree and a LazyConverter factory.
+  """
+
+  def setUp(self):
+    test_helper.SrcDstDirMixin.setUp(self)
+
+    self.state = tempfile.TemporaryDirectory()
+    self.cache_dir = os.path.join(self.state.name, 'cache')
+    self.converter_cb = UpperConverter(os.path.join(self.state.name, 'log'))
+
+    self.write_src(os.path.join('dir', 'a.in'), 'a')
+    self.write_src(os.path.join('dir', 'b'), 'b')
+
+  def tearDown(self):
+    self.state.cleanup()
+    test_helper.SrcDstDirMixin.tearDown(self)
+
+  def write_src(self, relpath, contents=''):
+    path = os.path.join(self.src_path(), relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+      f.write(contents)
+    return path
+
+  def make_converter(self, max_bytes=1024, **kwargs):
+    p = profile.ConvertProfile(
+      top_dir=self.dst_path(),
+      parent=profile.RootProfile(top_dir=self.src_path()),
+      select_cb=convert_select_cb,
+      convert_cb=self.converter_cb,
+      **kwargs)
+    return serve.LazyConverter(p, self.cache_dir, max_bytes)
+
+  def read(self, converter, relpath):
+    with converter.open(relpath) as f:
+      return f.read().decode('utf-8')
+
+
+class TestLazyConverter(unittest.TestCase, LazyConverterMixin):
+  def setUp(self):
+    LazyConverterMixin.setUp(self)
+
+  def tearDown(self):
+    LazyConverterMixin.tearDown(self)
+
+  def test_listdir(self):
+    converter = self.make_converter()
+
+    self.assertEqual(converter.listdir(''), [('dir', True)])
+    self.assertEqual(
+      converter.listdir('dir'),
+      [('a.in.out', False), ('b', False)],
+      )
+    self.assertEqual(self.converter_cb.calls(), [])
+    self.assertEqual(os.listdir(self.dst_path()), [])
+
+    self.assertRaises(FileNotFoundError, converter.listdir, 'missing')
+    self.assertRaises(
+      NotADirectoryError,
+      converter.listdir,
+      os.path.join('dir', 'b'),
+      )
+
+    # Listings are updated when the source directory changes.
+    self.write_src(os.path.join('dir', 'c.in'))
+    self.assertIn(('c.in.out', False), converter.listdir('dir'))
+
+  def test_open(self):
+    converter = self.make_converter()
+
+    self.assertEqual(self.read(converter, os.path.join('dir', 'b')), 'b')
+    self.assertEqual(
+      self.read(converter, os.path.join('dir', 'a.in.out')), 'A')
+    self.assertEqual(
+      self.read(converter, os.path.join('dir', 'a.in.out')), 'A')
+    self.assertEqual(self.converter_cb.calls(), ['a.in'])
+
+    self.assertRaises(FileNotFoundError, converter.open, 'dir/a.in')
+    self.assertRaises(IsADirectoryError, converter.open, 'dir')
+
+    # The cache is reused after a restart, until the source changes.
+    converter = self.make_converter()
+    self.read(converter, os.path.join('dir', 'a.in.out'))
+    self.assertEqual(self.converter_cb.calls(), ['a.in'])
+    self.write_src(os.path.join('dir', 'a.in'), 'new')
+    self.assertEqual(
+      self.read(converter, os.path.join('dir', 'a.in.out')), 'NEW')
+    self.assertEqual(self.converter_cb.calls(), ['a.in', 'a.in'])
+
+  def test_failure(self):
+    self.write_src(os.path.join('dir', 'bad.in'))
+    converter = self.make_converter()
+
+    self.assertRaises(
+      ValueError,
+      converter.open,
+      os.path.join('dir', 'bad.in.out'),
+      )
+    self.assertEqual(os.listdir(self.cache_dir), [])
+
+  def test_evict(self):
+    for name in ('c', 'd', 'e'):
+      self.write_src(os.path.join('dir', name + '.in'), name * 10)
+    converter = self.make_converter(max_bytes=25)
+
+    for name in ('c', 'd', 'c', 'e'):
+      self.read(converter, os.path.join('dir', name + '.in.out'))
+    self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    # d was the least recently used.
+    self.read(converter, os.path.join('dir', 'c.in.out'))
+    self.read(converter, os.path.join('dir', 'e.in.out'))
+    self.assertEqual(self.converter_cb.calls(), ['c.in', 'd.in', 'e.in'])
+    self.read(converter, os.path.join('dir', 'd.in.out'))
+    self.assertEqual(len(self.converter_cb.calls()), 4)
+
+  def test_concurrent_requests(self):
+    self.converter_cb.delay = 0.2
+    converter = self.make_converter()
+    results = []
+
+    def read():
+      results.append(self.read(converter, os.path.join('dir', 'a.in.out')))
+
+    threads = [threading.Thread(target=read) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(results, ['A'] * 4)
+    self.assertEqual(self.converter_cb.calls(), ['a.in'])
+
+  def test_convert_group_error(self):
+    group = profile.ConvertGroup(multi_convert_cb=lambda src, outputs: None)
+    self.assertRaisesRegex(
+      ValueError,
+      'ConvertGroup',
+      self.make_converter,
+      convert_group=group,
+      )
+
+
+class TestServer(unittest.TestCase, LazyConverterMixin):
+  def setUp(self):
+    LazyConverterMixin.setUp(self)
+
+    self.server = serve.Server(self.make_converter())
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+    self.url = 'http://%s:%d/' % self.server.server_address[:2]
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+
+    LazyConverterMixin.tearDown(self)
+
+  def get(self, path):
+    with urllib.request.urlopen(self.url + path) as response:
+      return response.read().decode('utf-8')
+
+  def test_http(self):
+    self.assertIn('href="dir/"', self.get(''))
+    listing = self.get('dir')
+    self.assertIn('href="a.in.out"', listing)
+    self.assertIn('href="b"', listing)
+
+    self.assertEqual(self.get('dir/a.in.out'), 'A')
+    self.assertEqual(self.get('dir/b'), 'b')
+    self.assertEqual(self.get('dir/../../dir/b'), 'b')
+
+    with self.assertRaises(urllib.error.HTTPError) as e:
+      self.get('dir/a.in')
+    self.assertEqual(e.exception.code, 404)
+    e.exception.close()
+
+    self.write_src(os.path.join('dir', 'bad.in'))
+    with self.assertLogs(level='ERROR'):
+      with self.assertRaises(urllib.error.HTTPError) as e:
+        self.get('dir/bad.in.out')
+    self.assertEqual(e.exception.code, 500)
+    e.exception.close()
@@ -1,6 +1,8 @@
+import errno
 import os
 import tempfile
 import unittest
+import unittest.mock
 
 from . import profile
 from . import test_helper
@@ -107,3 +109,66 @@ class TestFixDirStats(unittest.TestCase, test_helper.SrcDstDirMixin):
       test_helper.get_preserved_attrs(src_dir),
       test_helper.get_preserved_attrs(dst_dir),
       )
+
+
+class TestJson(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def test_load_missing(self):
+    self.assertEqual(
+      util.load_json(os.path.join(self.dir.name, 'missing'), {}),
+      {},
+      )
+
+  def test_save_load(self):
+    path = os.path.join(self.dir.name, 'dir', 'file.json')
+    util.save_json(path, {'foo': [1, 2]})
+    util.save_json(path, {'foo': [3]})
+
+    self.assertEqual(util.load_json(path), {'foo': [3]})
+    self.assertEqual(os.listdir(os.path.dirname(path)), ['file.json'])
+
+
+class TestCopyFileData(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+
+    self.src = os.path.join(self.dir.name, 'src')
+    self.contents = os.urandom(300000)
+    with open(self.src, 'wb') as f:
+      f.write(self.contents)
+    self.dst = os.path.join(self.dir.name, 'dst')
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def read_dst(self):
+    with open(self.dst, 'rb') as f:
+      return f.read()
+
+  def test_copy(self):
+    util.copy_file_data(self.src, self.dst)
+
+    self.assertEqual(self.read_dst(), self.contents)
+
+  def test_unsupported_fallback(self):
+    error = OSError(errno.EXDEV, 'Cross-device link')
+    with unittest.mock.patch.object(
+        os, 'copy_file_range', side_effect=error, create=True), \
+        unittest.mock.patch.object(
+          os, 'sendfile', side_effect=error, create=True):
+      util.copy_file_data(self.src, self.dst)
+
+    self.assertEqual(self.read_dst(), self.contents)
+
+  def test_reflink_or_unsupported(self):
+    try:
+      util.reflink(self.src, self.dst)
+    except OSError as e:
+      self.assertIn(e.errno, util.FALLBACK_ERRNOS)
+    else:
+      self.assertEqual(self.read_dst(), self.contents)
@@ -1,5 +1,34 @@
+import errno
+import hashlib
+import json
 import os
 import shutil
+import stat
+import tempfile
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+
+# ioctl request to clone a file's extents, from linux/fs.h.
+_FICLONE = 0x40049409
+
+# Errors that mean a way of copying is not supported at all, as opposed
+# to failing for a particular file.
+UNSUPPORTED_ERRNOS = frozenset((
+  errno.EXDEV,
+  errno.EINVAL,
+  errno.ENOSYS,
+  errno.ENOTTY,
+  errno.EOPNOTSUPP,
+  ))
+
+# Errors after which another way of copying is worth trying. EPERM can
+# be specific to a file, e.g., a hardlink that fs.protected_hardlinks
+# forbids because the file has another owner.
+FALLBACK_ERRNOS = UNSUPPORTED_ERRNOS | frozenset((errno.EPERM,))
 
 
 def recursive_scandir(top_dir, dir_first=True):
@@ -38,7 +67,7 @@ def recursive_scandir(top_dir, dir_first=True):
   return f('', None)
 
 
-def fix_dir_stats(profile):
+def fix_dir_stats(profile, relpaths=None, copystat=shutil.copystat):
   """Fix directory stats for a profile.
 
   This function assumes that every directory in the output corresponds
@@ -47,15 +76,259 @@ def fix_dir_stats(profile):
 
   For each directory in profile.dst_path(), this will copy stats from
   the corresponding directory in profile.src_path().
+
+  Args:
+      profile: The profile.
+      relpaths: If not None, only fix directories within these
+          relative paths, and their ancestors. See normalize_relpaths().
+      copystat: Function to copy stats from a source path to a
+          destination path.
   """
 
-  for dst_relpath, dst_entry in recursive_scandir(profile.dst_path()):
-    if not dst_entry.is_dir():
-      continue
+  if relpaths is None:
+    dst_relpaths = (
+      dst_relpath
+      for dst_relpath, dst_entry in recursive_scandir(profile.dst_path())
+      if dst_entry.is_dir()
+      )
+  else:
+    dst_relpaths = []
+    for relpath in relpaths:
+      dst_relpaths.extend(ancestors(relpath))
+      if relpath and os.path.isdir(profile.dst_path(relpath)) \
+          and not os.path.islink(profile.dst_path(relpath)):
+        dst_relpaths.append(relpath)
+        dst_relpaths.extend(
+          os.path.join(relpath, dst_relpath)
+          for dst_relpath, dst_entry
+          in recursive_scandir(profile.dst_path(relpath))
+          if dst_entry.is_dir()
+          )
+    dst_relpaths = sorted(set(dst_relpaths))
 
+  for dst_relpath in dst_relpaths:
     src_relpath = dst_relpath
 
-    shutil.copystat(
+    if relpaths is not None and not (
+        os.path.isdir(profile.src_path(src_relpath)) and
+        os.path.isdir(profile.dst_path(dst_relpath))):
+      continue
+
+    copystat(
       profile.src_path(src_relpath),
       profile.dst_path(dst_relpath),
       )
+
+
+def normalize_relpaths(relpaths):
+  """Normalize a list of relative paths that scope an operation.
+
+  Returns:
+      A sorted list of normalized relative paths, without duplicates or
+      paths that are within other paths in the list. The top directory
+      is ''.
+  """
+
+  normalized = set()
+  for relpath in relpaths:
+    relpath = os.path.normpath(relpath)
+    if relpath == '.':
+      relpath = ''
+    if os.path.isabs(relpath) or relpath.split(os.sep)[0] == '..':
+      raise ValueError('Not a relative path within a profile: %r' % relpath)
+    normalized.add(relpath)
+
+  if '' in normalized:
+    return ['']
+
+  result = []
+  for relpath in sorted(normalized):
+    if result and relpath.startswith(result[-1] + os.sep):
+      continue
+    result.append(relpath)
+  return result
+
+
+def ancestors(relpath):
+  """Get the ancestor directories of a relative path, excluding ''.
+
+  E.g., ancestors('a/b/c') is ['a', 'a/b'].
+  """
+
+  result = []
+  dirname = os.path.dirname(relpath)
+  while dirname:
+    result.append(dirname)
+    dirname = os.path.dirname(dirname)
+  result.reverse()
+  return result
+
+
+def is_within(relpath, top_relpath):
+  """Check whether a relative path is top_relpath or inside it.
+
+  Everything is within ''.
+  """
+
+  return (
+    not top_relpath
+    or relpath == top_relpath
+    or relpath.startswith(top_relpath + os.sep)
+    )
+
+
+def truncate_to_existing(top_dir, relpath):
+  """Truncate a relative path after its first missing component.
+
+  Returns:
+      A relative path whose parent directory exists in top_dir. It is
+      relpath itself if its parent exists.
+  """
+
+  components = relpath.split(os.sep) if relpath else []
+  for i in range(len(components) - 1):
+    prefix = os.path.join(*components[:i + 1])
+    if not os.path.isdir(os.path.join(top_dir, prefix)):
+      return prefix
+  return relpath
+
+
+def scandir_entry(dir_path, name):
+  """Get the os.DirEntry for a name in a directory, or None.
+  """
+
+  try:
+    for entry in os.scandir(dir_path):
+      if entry.name == name:
+        return entry
+  except (FileNotFoundError, NotADirectoryError):
+    pass
+  return None
+
+
+def load_json(path, default=None):
+  """Load a JSON file, or return default if it does not exist.
+  """
+
+  try:
+    with open(path, 'r') as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return default
+
+
+def save_json(path, data):
+  """Atomically save data to a JSON file.
+
+  The data is written to a temporary file in the same directory, which
+  is then renamed over path, so that a crash never leaves a partially
+  written file behind.
+  """
+
+  dirname = os.path.dirname(os.path.abspath(path))
+  os.makedirs(dirname, exist_ok=True)
+  fd, tmp_path = tempfile.mkstemp(
+    dir=dirname,
+    prefix='.' + os.path.basename(path) + '.',
+    suffix='.tmp',
+    )
+  try:
+    with os.fdopen(fd, 'w') as f:
+      json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+  except BaseException:
+    os.remove(tmp_path)
+    raise
+
+
+def json_round_trip(data):
+  """Get data as it would be loaded after being saved as JSON.
+
+  E.g., tuples become lists. Use this before comparing data with what
+  load_json() returns.
+  """
+
+  return json.loads(json.dumps(data))
+
+
+def stats_match(src_path, dst_path):
+  """Check whether copystat() from src_path to dst_path is a no-op.
+
+  This compares the permission bits and modification time.
+  """
+
+  try:
+    src_stat = os.stat(src_path)
+    dst_stat = os.stat(dst_path)
+  except FileNotFoundError:
+    return False
+
+  return (
+    stat.S_IMODE(src_stat.st_mode) == stat.S_IMODE(dst_stat.st_mode)
+    and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+    )
+
+
+def reflink(src_path, dst_path):
+  """Make dst_path a copy-on-write clone of src_path.
+
+  This works on filesystems that support FICLONE, e.g., btrfs and XFS.
+
+  Raises:
+      OSError: Cloning is not supported, e.g., with errno EOPNOTSUPP or
+          EXDEV. dst_path may have been created anyway.
+  """
+
+  if fcntl is None:
+    raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported')
+
+  with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+    fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+
+
+def copy_file_data(src_path, dst_path):
+  """Copy the contents of a file, in the kernel if possible.
+
+  This uses os.copy_file_range() or os.sendfile(), where available,
+  and falls back to copying through user space.
+  """
+
+  with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    size = os.fstat(src_fd).st_size
+    offset = 0
+
+    for name in ('copy_file_range', 'sendfile'):
+      if offset >= size or not hasattr(os, name):
+        continue
+      try:
+        while offset < size:
+          if name == 'copy_file_range':
+            copied = os.copy_file_range(
+              src_fd, dst_fd, size - offset, offset, offset)
+          else:
+            copied = os.sendfile(dst_fd, src_fd, offset, size - offset)
+          if not copied:
+            break
+          offset += copied
+      except OSError as e:
+        if offset or e.errno not in FALLBACK_ERRNOS:
+          raise
+
+    # Copy anything left, e.g., if the file grew, or neither of the
+    # above is supported.
+    src.seek(offset)
+    dst.seek(offset)
+    shutil.copyfileobj(src, dst)
+
+
+def file_digest(path):
+  """Get the SHA-256 digest of a file's contents, as hex.
+  """
+
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      digest.update(block)
+  return digest.hexdigest()